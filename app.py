@@ -1,25 +1,37 @@
 import os
 import requests
 import json
+import hashlib
+import click
+import time
+import queue
+import threading
 import csv
 import io
 import uuid
 import random
 import secrets
+import sqlite3
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, Response, copy_current_request_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy import or_, and_, func, desc, case, text
-from datetime import datetime
+from sqlalchemy import or_, and_, func, desc, case, text, select, insert, update, literal, false
+from sqlalchemy import event as sa_event, inspect as sa_inspect
+from sqlalchemy.exc import IntegrityError
+from datetime import datetime, timedelta
+from collections import namedtuple
+from itertools import groupby
 from authlib.integrations.flask_client import OAuth
 from io import BytesIO
 from PIL import Image, ImageDraw
 from dotenv import load_dotenv
+from stats_matrix import PlayerActionMatrix, dot as matrix_dot, touches as matrix_touches, mask as matrix_mask, masked as matrix_masked
+from scoring import compute_points, normalize_criteria, STRATEGIES as SCORING_STRATEGIES, STRATEGY_LABELS as SCORING_STRATEGY_LABELS, DEFAULT_STRATEGY as DEFAULT_SCORING_STRATEGY
 
 # Cargar variables de entorno desde archivo .env
 load_dotenv()
@@ -44,6 +56,9 @@ app.config['SESSION_COOKIE_SECURE'] = os.getenv('SESSION_COOKIE_SECURE', 'False'
 app.config['UPLOAD_FOLDER'] = os.path.join(basedir, 'static', 'uploads')
 app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_CONTENT_LENGTH', 50 * 1024 * 1024))
 
+# Caché del portal público (SQLite local compartido por los workers)
+app.config['PUBLIC_CACHE_PATH'] = os.getenv('PUBLIC_CACHE_PATH') or os.path.join(basedir, 'public_cache.db')
+
 # Configuración de Google OAuth
 app.config['GOOGLE_CLIENT_ID'] = os.getenv('GOOGLE_CLIENT_ID', '')
 app.config['GOOGLE_CLIENT_SECRET'] = os.getenv('GOOGLE_CLIENT_SECRET', '')
@@ -110,6 +125,8 @@ class User(UserMixin, db.Model):
     is_admin = db.Column(db.Boolean, default=False)
     theme_color = db.Column(db.String(7), nullable=True)
     last_blocks_config = db.Column(db.String(500), nullable=True, default="Calentamiento,Técnica Individual,Tiro,Táctica,Físico,Vuelta a la Calma")
+    # Sube con cada cambio en sus acciones: invalida el registro de acciones cacheado en cada worker
+    action_config_version = db.Column(db.Integer, nullable=False, default=0)
     favoritos = db.relationship('Drill', secondary=favorites, backref=db.backref('favorited_by', lazy='dynamic'))
     owned_teams = db.relationship('Team', backref='owner', lazy=True)
     staff_memberships = db.relationship('TeamStaff', backref='user', lazy=True)
@@ -155,6 +172,9 @@ class Team(db.Model):
     # Configuración de Analytics en portal público
     analytics_visible = db.Column(db.Boolean, default=False)
     analytics_players_count = db.Column(db.Integer, default=5)
+    training_load_ready = db.Column(db.Boolean, default=False)  # PlayerDailyLoad ya incluye el histórico
+    drill_usage_ready = db.Column(db.Boolean, default=True)  # DrillUsage ya incluye el histórico (equipos previos: 0)
+    data_version = db.Column(db.Integer, nullable=False, default=0)  # Sube con cada cambio visible en el portal público
     # Gráficos individuales visibles en portal
     chart_all_visible = db.Column(db.Boolean, default=True)  # Ataque y defensa
     chart_attack_visible = db.Column(db.Boolean, default=False)  # Ataque
@@ -199,7 +219,10 @@ class TrainingSession(db.Model):
     plan_id = db.Column(db.Integer, db.ForeignKey('training_plan.id'), nullable=True)
     date = db.Column(db.DateTime, default=datetime.utcnow)
     status = db.Column(db.String(20), default='active')
+    # Versión del marcador materializado (SessionPlayerPoints); 0 = aún sin materializar
+    scores_version = db.Column(db.Integer, nullable=False, default=1)
     plan = db.relationship('TrainingPlan', backref='sessions')
+    __table_args__ = (db.Index('ix_training_session_team_status_date', 'team_id', 'status', 'date'),)
     attendance = db.relationship('SessionAttendance', backref='session', lazy=True, cascade="all, delete-orphan")
     scores = db.relationship('SessionScore', backref='session', lazy=True, cascade="all, delete-orphan")
 
@@ -208,7 +231,9 @@ class SessionAttendance(db.Model):
     session_id = db.Column(db.Integer, db.ForeignKey('training_session.id'), nullable=False)
     player_id = db.Column(db.Integer, db.ForeignKey('player.id'), nullable=False)
     is_present = db.Column(db.Boolean, default=False)
+    rpe = db.Column(db.Integer, nullable=True)  # Esfuerzo percibido (escala CR-10), opcional
     player = db.relationship('Player', backref='session_attendances')
+    __table_args__ = (db.Index('ix_session_attendance_session_player', 'session_id', 'player_id'),)
 
 class SessionScore(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -217,11 +242,86 @@ class SessionScore(db.Model):
     player_id = db.Column(db.Integer, db.ForeignKey('player.id'), nullable=False)
     raw_score = db.Column(db.Float, default=0.0)
     points = db.Column(db.Integer, default=0)
+    player = db.relationship('Player')
+
+class SessionPlayerPoints(db.Model):
+    """Marcador materializado de la sesión: suma de SessionScore.points por jugador.
+    Se mantiene de forma incremental desde _write_drill_scores."""
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.Integer, db.ForeignKey('training_session.id'), nullable=False)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id'), nullable=False)
+    total_points = db.Column(db.Integer, nullable=False, default=0)
+    drills_scored = db.Column(db.Integer, nullable=False, default=0)
+    session = db.relationship('TrainingSession', backref=db.backref('player_points', lazy=True, cascade="all, delete-orphan"))
+    __table_args__ = (db.UniqueConstraint('session_id', 'player_id', name='uq_session_player_points'),)
+
+class TeamWeeklyPoints(db.Model):
+    """Acumulado por semana ISO (lunes) de los puntos de entrenamiento de cada jugador.
+    Se mantiene junto a SessionPlayerPoints y sirve los rankings de temporada y de mes."""
+    id = db.Column(db.Integer, primary_key=True)
+    team_id = db.Column(db.Integer, db.ForeignKey('team.id'), nullable=False)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id'), nullable=False)
+    week_start = db.Column(db.Date, nullable=False)
+    total_points = db.Column(db.Integer, nullable=False, default=0)
+    sessions = db.Column(db.Integer, nullable=False, default=0)  # sesiones con puntos esa semana
+    team = db.relationship('Team', backref=db.backref('weekly_points', lazy=True, cascade="all, delete-orphan"))
+    __table_args__ = (db.UniqueConstraint('team_id', 'week_start', 'player_id', name='uq_team_weekly_points'),)
+
+class PlayerDailyLoad(db.Model):
+    """Carga diaria de entrenamiento por jugador: minutos entrenados y carga (minutos × RPE si
+    se registró, si no minutos). La mantiene refresh_training_load() día a día."""
+    id = db.Column(db.Integer, primary_key=True)
+    team_id = db.Column(db.Integer, db.ForeignKey('team.id'), nullable=False)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id'), nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    minutes = db.Column(db.Integer, nullable=False, default=0)
+    load = db.Column(db.Float, nullable=False, default=0.0)
+    team = db.relationship('Team', backref=db.backref('daily_loads', lazy=True, cascade="all, delete-orphan"))
+    __table_args__ = (db.UniqueConstraint('team_id', 'player_id', 'day', name='uq_player_daily_load'),
+                      db.Index('ix_player_daily_load_team_day', 'team_id', 'day'))
+
+class DrillUsage(db.Model):
+    """Uso acumulado de cada ejercicio por equipo: veces planificado en sesiones, realizado y saltado,
+    y desviación entre la duración real y la planificada. Se mantiene por deltas (apply_drill_usage_delta)."""
+    id = db.Column(db.Integer, primary_key=True)
+    team_id = db.Column(db.Integer, db.ForeignKey('team.id'), nullable=False)
+    drill_id = db.Column(db.Integer, db.ForeignKey('drill.id'), nullable=False)
+    times_planned = db.Column(db.Integer, nullable=False, default=0)
+    times_executed = db.Column(db.Integer, nullable=False, default=0)
+    times_skipped = db.Column(db.Integer, nullable=False, default=0)
+    duration_delta_sum = db.Column(db.Integer, nullable=False, default=0)  # minutos (real - planificado)
+    duration_samples = db.Column(db.Integer, nullable=False, default=0)  # ejecuciones con duración real
+    team = db.relationship('Team', backref=db.backref('drill_usage', lazy=True, cascade="all, delete-orphan"))
+    __table_args__ = (db.UniqueConstraint('team_id', 'drill_id', name='uq_drill_usage_team_drill'),
+                      db.Index('ix_drill_usage_drill', 'drill_id'))
+
+class SessionDrillScoring(db.Model):
+    """Estrategia y criterio con los que se puntuó un ejercicio en una sesión (ver scoring.py)."""
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.Integer, db.ForeignKey('training_session.id'), nullable=False)
+    drill_id = db.Column(db.Integer, db.ForeignKey('drill.id'), nullable=False)
+    strategy = db.Column(db.String(20), default='ladder')
+    criteria = db.Column(db.String(10), default='high')  # high | low
+    session = db.relationship('TrainingSession', backref=db.backref('drill_scorings', lazy=True, cascade="all, delete-orphan"))
+    __table_args__ = (db.UniqueConstraint('session_id', 'drill_id', name='uq_session_drill_scoring'),)
+
+class SessionPlannedDrill(db.Model):
+    """Ejercicios del plan tal como estaba al abrir la sesión (veces que aparece cada uno). Es lo que suma
+    times_planned en DrillUsage, así que editar el plan después no cambia el histórico."""
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.Integer, db.ForeignKey('training_session.id'), nullable=False)
+    drill_id = db.Column(db.Integer, db.ForeignKey('drill.id'), nullable=False)
+    n = db.Column(db.Integer, nullable=False, default=0)
+    session = db.relationship('TrainingSession', backref=db.backref('planned_drills', lazy=True, cascade="all, delete-orphan"))
+    __table_args__ = (db.UniqueConstraint('session_id', 'drill_id', name='uq_session_planned_drill'),)
 
 class SessionItemExecution(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     session_id = db.Column(db.Integer, db.ForeignKey('training_session.id'), nullable=False)
     training_item_id = db.Column(db.Integer, db.ForeignKey('training_item.id'), nullable=False)
+    # Copia del ejercicio y la duración planificada al registrarla: edit_plan recrea los TrainingItem
+    drill_id = db.Column(db.Integer, db.ForeignKey('drill.id'), nullable=True)
+    planned_duration = db.Column(db.Integer, nullable=True)
     was_completed = db.Column(db.Boolean, default=True)
     actual_duration = db.Column(db.Integer, nullable=True)  # minutos, null si no se hizo
     notes = db.Column(db.Text, nullable=True)
@@ -229,6 +329,18 @@ class SessionItemExecution(db.Model):
     session = db.relationship('TrainingSession', backref='executions')
     training_item = db.relationship('TrainingItem', backref='executions')
 
+class SessionSyncOp(db.Model):
+    """Operación del diario offline ya procesada (clave de idempotencia del cliente)."""
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.Integer, db.ForeignKey('training_session.id'), nullable=False)
+    op_key = db.Column(db.String(64), nullable=False)
+    op_type = db.Column(db.String(20), nullable=False)
+    status = db.Column(db.String(10), default='applied')  # applied | rejected
+    error = db.Column(db.String(255), nullable=True)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+    session = db.relationship('TrainingSession', backref=db.backref('sync_ops', lazy=True, cascade="all, delete-orphan"))
+    __table_args__ = (db.UniqueConstraint('session_id', 'op_key', name='uq_session_sync_op_key'),)
+
 class ActionCategory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), nullable=False)
@@ -272,6 +384,10 @@ class Match(db.Model):
     result_them = db.Column(db.Integer, default=0)
     current_period = db.Column(db.Integer, default=1)
     court_lineup = db.Column(db.Text, nullable=True)
+    # MatchPlayerLive ya refleja todos los eventos (los partidos previos quedan a 0 y se reconstruyen al leerlos)
+    live_ready = db.Column(db.Boolean, nullable=False, default=True)
+    # MatchLineupStat (+/- y minutos por jugador y quinteto) está al día con los eventos
+    lineup_ready = db.Column(db.Boolean, nullable=False, default=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     team_id = db.Column(db.Integer, db.ForeignKey('team.id'), nullable=False) 
     roster = db.relationship('Player', secondary=match_roster, backref='matches_played')
@@ -286,8 +402,90 @@ class MatchEvent(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     game_minute = db.Column(db.Integer, default=0)
     period = db.Column(db.Integer, default=1)
+    # Eventos llegados por lotes del tracker: dispositivo y número de secuencia del cliente.
+    # (match_id, device_id, seq) es único, así que reenviar un lote no duplica eventos
+    device_id = db.Column(db.String(64), nullable=True)
+    seq = db.Column(db.Integer, nullable=True)
+    # Cambio de quinteto: ids de los jugadores en pista desde este momento ("3,7,12,15,21"); sin jugador ni acción
+    lineup = db.Column(db.String(80), nullable=True)
     player = db.relationship('Player', backref='events')
     action = db.relationship('ActionDefinition', backref='events')
+    __table_args__ = (db.Index('uq_match_event_device_seq', 'match_id', 'device_id', 'seq', unique=True),)
+
+class MatchPlayerLive(db.Model):
+    """Marcador en vivo por jugador y partido: valoración total, de ataque y de defensa, faltas y puntos.
+    Lo mantienen por deltas los endpoints que crean, editan o borran eventos (apply_match_events)."""
+    id = db.Column(db.Integer, primary_key=True)
+    match_id = db.Column(db.Integer, db.ForeignKey('match.id'), nullable=False)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id'), nullable=False)
+    val = db.Column(db.Float, nullable=False, default=0.0)
+    ata = db.Column(db.Float, nullable=False, default=0.0)
+    defense = db.Column('def', db.Float, nullable=False, default=0.0)
+    fouls = db.Column(db.Integer, nullable=False, default=0)
+    points = db.Column(db.Integer, nullable=False, default=0)
+    match = db.relationship('Match', backref=db.backref('live_stats', lazy=True, cascade="all, delete-orphan"))
+    __table_args__ = (db.UniqueConstraint('match_id', 'player_id', name='uq_match_player_live'),)
+
+class PlayerMatchStat(db.Model):
+    """Cuántas veces hizo cada jugador cada acción en el partido. Con MatchPlayerLive (valoración, ataque,
+    defensa y puntos) es la fuente de las estadísticas de equipo, portal público y partidos; se mantiene en
+    apply_match_events y se rehace con rebuild_match_live. Solo hay filas con n > 0."""
+    id = db.Column(db.Integer, primary_key=True)
+    match_id = db.Column(db.Integer, db.ForeignKey('match.id'), nullable=False)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id'), nullable=False)
+    action_id = db.Column(db.Integer, db.ForeignKey('action_definition.id'), nullable=False)
+    n = db.Column(db.Integer, nullable=False, default=0)
+    match = db.relationship('Match', backref=db.backref('player_action_stats', lazy=True, cascade="all, delete-orphan"))
+    __table_args__ = (db.UniqueConstraint('match_id', 'player_id', 'action_id', name='uq_player_match_stat'),)
+
+class MatchPeriodLive(db.Model):
+    """Parcial de cada periodo: puntos propios y del rival. Tiene fila todo periodo con acciones de jugador
+    o puntos del rival (los cambios de quinteto no cuentan); se mantiene junto a MatchPlayerLive (apply_match_live_deltas)."""
+    id = db.Column(db.Integer, primary_key=True)
+    match_id = db.Column(db.Integer, db.ForeignKey('match.id'), nullable=False)
+    period = db.Column(db.Integer, nullable=False)
+    points_us = db.Column(db.Integer, nullable=False, default=0)
+    points_them = db.Column(db.Integer, nullable=False, default=0)
+    events = db.Column(db.Integer, nullable=False, default=0)  # la fila se borra al quedarse sin eventos
+    match = db.relationship('Match', backref=db.backref('period_scores', lazy=True, cascade="all, delete-orphan"))
+    __table_args__ = (db.UniqueConstraint('match_id', 'period', name='uq_match_period_live'),)
+
+class MatchPeriodPlayerLive(db.Model):
+    """Valoración y puntos de cada jugador en cada periodo del partido."""
+    id = db.Column(db.Integer, primary_key=True)
+    match_id = db.Column(db.Integer, db.ForeignKey('match.id'), nullable=False)
+    period = db.Column(db.Integer, nullable=False)
+    player_id = db.Column(db.Integer, db.ForeignKey('player.id'), nullable=False)
+    val = db.Column(db.Float, nullable=False, default=0.0)
+    points = db.Column(db.Integer, nullable=False, default=0)
+    events = db.Column(db.Integer, nullable=False, default=0)  # la fila se borra al quedarse sin eventos
+    match = db.relationship('Match', backref=db.backref('period_player_stats', lazy=True, cascade="all, delete-orphan"))
+    __table_args__ = (db.UniqueConstraint('match_id', 'period', 'player_id', name='uq_match_period_player_live'),)
+
+class MatchLineupStat(db.Model):
+    """+/- y tiempo en pista de un partido por jugador (size=1) o por quinteto (size=5).
+    unit son los ids ordenados y separados por comas. Lo rehace compute_match_lineups cuando cambian los eventos."""
+    id = db.Column(db.Integer, primary_key=True)
+    match_id = db.Column(db.Integer, db.ForeignKey('match.id'), nullable=False)
+    unit = db.Column(db.String(80), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    seconds = db.Column(db.Float, nullable=False, default=0.0)
+    points_for = db.Column(db.Integer, nullable=False, default=0)
+    points_against = db.Column(db.Integer, nullable=False, default=0)
+    match = db.relationship('Match', backref=db.backref('lineup_stats', lazy=True, cascade="all, delete-orphan"))
+    __table_args__ = (db.UniqueConstraint('match_id', 'unit', name='uq_match_lineup_stat'),)
+
+class MatchStreamEvent(db.Model):
+    """Cambios de un partido en vivo (evento, deshacer, edición, periodo/quinteto) para los streams SSE.
+    Se escribe en la misma transacción que el cambio; el id es el cursor que el cliente reenvía como Last-Event-ID."""
+    id = db.Column(db.Integer, primary_key=True)
+    match_id = db.Column(db.Integer, db.ForeignKey('match.id'), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    match = db.relationship('Match', backref=db.backref('stream_events', lazy=True, cascade="all, delete-orphan"))
+    # AUTOINCREMENT en SQLite: tras purgar filas antiguas los ids nunca se reutilizan (el cursor solo avanza)
+    __table_args__ = (db.Index('ix_match_stream_event_match', 'match_id', 'id'), {'sqlite_autoincrement': True})
 
 class SiteConfig(db.Model):
     key = db.Column(db.String(50), primary_key=True) 
@@ -352,7 +550,9 @@ class TrainingPlan(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     structure = db.Column(db.String(500), nullable=True) 
     is_public = db.Column(db.Boolean, default=False)
-    items = db.relationship('TrainingItem', backref='plan', lazy=True, cascade="all, delete-orphan")
+    version = db.Column(db.Integer, default=1, nullable=False)  # Se incrementa en cada cambio de ejercicios (concurrencia optimista)
+    items = db.relationship('TrainingItem', backref='plan', lazy=True, cascade="all, delete-orphan",
+                            order_by=lambda: (TrainingItem.order, TrainingItem.id))
 
 class TrainingItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -475,6 +675,7 @@ def create_default_game_config(user_id):
         act = ActionDefinition(name=name, value=val, is_positive=is_pos, user_id=user_id)
         db.session.add(act)
         created_actions[name] = act
+    bump_action_config(user_id, live=False)
     db.session.commit()
     r_mvp = RankingDefinition(name="Valoración", icon="star", user_id=user_id)
     r_mvp.ingredients.extend(list(created_actions.values()))
@@ -535,6 +736,92 @@ def run_migrations():
     )''')
     # Orden de etiquetas dentro de grupos
     _run_alter('ALTER TABLE tag ADD COLUMN display_order INTEGER DEFAULT 0')
+    # Versión del plan para edición por lotes con concurrencia optimista
+    _run_alter('ALTER TABLE training_plan ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+    # Marcador materializado de sesión: las sesiones existentes quedan a 0 y se materializan al leerlas
+    _run_alter('ALTER TABLE training_session ADD COLUMN scores_version INTEGER NOT NULL DEFAULT 0')
+    # Carga de entrenamiento: RPE por jugador y sesión, y marca de histórico ya acumulado
+    _run_alter('ALTER TABLE session_attendance ADD COLUMN rpe INTEGER')
+    _run_alter('ALTER TABLE team ADD COLUMN training_load_ready BOOLEAN DEFAULT 0')
+    # Uso de ejercicios: marca de histórico ya acumulado en drill_usage
+    _run_alter('ALTER TABLE team ADD COLUMN drill_usage_ready BOOLEAN DEFAULT 0')
+    # Uso de ejercicios: copia del plan al abrir cada sesión y del ejercicio en cada ejecución. Solo al añadir
+    # las columnas, las sesiones y ejecuciones existentes toman el plan actual (lo único que queda de ellas)
+    insp = sa_inspect(db.engine)
+    backfill_usage = insp.has_table('session_item_execution') and \
+        'planned_duration' not in {c['name'] for c in insp.get_columns('session_item_execution')}
+    _run_alter('''CREATE TABLE IF NOT EXISTS session_planned_drill (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id INTEGER NOT NULL REFERENCES training_session(id),
+        drill_id INTEGER NOT NULL REFERENCES drill(id),
+        n INTEGER NOT NULL DEFAULT 0,
+        CONSTRAINT uq_session_planned_drill UNIQUE (session_id, drill_id)
+    )''')
+    _run_alter('ALTER TABLE session_item_execution ADD COLUMN drill_id INTEGER REFERENCES drill(id)')
+    _run_alter('ALTER TABLE session_item_execution ADD COLUMN planned_duration INTEGER')
+    if backfill_usage:
+        _run_alter('INSERT INTO session_planned_drill (session_id, drill_id, n) '
+                   'SELECT s.id, ti.drill_id, COUNT(ti.id) FROM training_session s '
+                   'JOIN training_item ti ON ti.training_plan_id = s.plan_id '
+                   'WHERE s.id NOT IN (SELECT session_id FROM session_planned_drill) GROUP BY s.id, ti.drill_id')
+        _run_alter('UPDATE session_item_execution SET '
+                   'drill_id = (SELECT drill_id FROM training_item WHERE training_item.id = training_item_id), '
+                   'planned_duration = (SELECT duration FROM training_item WHERE training_item.id = training_item_id) '
+                   'WHERE drill_id IS NULL')
+    # Marcador en vivo agregado: los partidos existentes se reconstruyen desde sus eventos al consultarlos
+    _run_alter('ALTER TABLE match ADD COLUMN live_ready BOOLEAN NOT NULL DEFAULT 0')
+    # Versión de la configuración de acciones (registro de acciones en memoria por worker)
+    _run_alter('ALTER TABLE user ADD COLUMN action_config_version INTEGER NOT NULL DEFAULT 0')
+    # Ingesta por lotes del tracker: dispositivo + secuencia únicos por partido
+    _run_alter('ALTER TABLE match_event ADD COLUMN device_id VARCHAR(64)')
+    _run_alter('ALTER TABLE match_event ADD COLUMN seq INTEGER')
+    _run_alter('CREATE UNIQUE INDEX IF NOT EXISTS uq_match_event_device_seq ON match_event (match_id, device_id, seq)')
+    # Cambios de quinteto en el flujo de eventos y +/- por partido (los existentes se calculan al consultarlos)
+    _run_alter('ALTER TABLE match_event ADD COLUMN lineup VARCHAR(80)')
+    _run_alter('ALTER TABLE match ADD COLUMN lineup_ready BOOLEAN NOT NULL DEFAULT 0')
+    # Parciales por periodo: los partidos con eventos y sin parciales (o con filas sin conteo de eventos)
+    # se reconstruyen al consultarlos. Las tablas se crean antes para que el UPDATE no se salte en el primer arranque
+    _run_alter('''CREATE TABLE IF NOT EXISTS match_period_live (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        match_id INTEGER NOT NULL REFERENCES match(id),
+        period INTEGER NOT NULL,
+        points_us INTEGER NOT NULL DEFAULT 0,
+        points_them INTEGER NOT NULL DEFAULT 0,
+        events INTEGER NOT NULL DEFAULT 0,
+        CONSTRAINT uq_match_period_live UNIQUE (match_id, period)
+    )''')
+    _run_alter('''CREATE TABLE IF NOT EXISTS match_period_player_live (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        match_id INTEGER NOT NULL REFERENCES match(id),
+        period INTEGER NOT NULL,
+        player_id INTEGER NOT NULL REFERENCES player(id),
+        val FLOAT NOT NULL DEFAULT 0.0,
+        points INTEGER NOT NULL DEFAULT 0,
+        events INTEGER NOT NULL DEFAULT 0,
+        CONSTRAINT uq_match_period_player_live UNIQUE (match_id, period, player_id)
+    )''')
+    _run_alter('ALTER TABLE match_period_live ADD COLUMN events INTEGER NOT NULL DEFAULT 0')
+    _run_alter('ALTER TABLE match_period_player_live ADD COLUMN events INTEGER NOT NULL DEFAULT 0')
+    _run_alter('UPDATE match SET live_ready = 0 WHERE live_ready = 1 AND (id IN (SELECT match_id FROM match_event) '
+               'AND id NOT IN (SELECT match_id FROM match_period_live) '
+               'OR id IN (SELECT match_id FROM match_period_live WHERE events = 0) '
+               'OR id IN (SELECT match_id FROM match_period_player_live WHERE events = 0))')
+    # Versión de los datos del equipo (caché del portal público)
+    _run_alter('ALTER TABLE team ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0')
+    # Conteos por partido, jugador y acción: los partidos con eventos y sin conteos se reconstruyen al consultarlos
+    _run_alter('''CREATE TABLE IF NOT EXISTS player_match_stat (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        match_id INTEGER NOT NULL REFERENCES match(id),
+        player_id INTEGER NOT NULL REFERENCES player(id),
+        action_id INTEGER NOT NULL REFERENCES action_definition(id),
+        n INTEGER NOT NULL DEFAULT 0,
+        CONSTRAINT uq_player_match_stat UNIQUE (match_id, player_id, action_id)
+    )''')
+    _run_alter('UPDATE match SET live_ready = 0 WHERE live_ready = 1 AND id IN (SELECT match_id FROM match_event '
+               'WHERE player_id IS NOT NULL AND action_id IS NOT NULL) AND id NOT IN (SELECT match_id FROM player_match_stat)')
+    # Índices para estadísticas de asistencia e historial de sesiones
+    _run_alter('CREATE INDEX IF NOT EXISTS ix_training_session_team_status_date ON training_session (team_id, status, date)')
+    _run_alter('CREATE INDEX IF NOT EXISTS ix_session_attendance_session_player ON session_attendance (session_id, player_id)')
 
 # Posiciones de doble ancho: (display_section, is_positive, grid_row, grid_col)
 DOUBLE_WIDTH_POSITIONS = [("ATAQUE", True, 1, 1), ("ATAQUE", False, 1, 1)]
@@ -601,6 +888,7 @@ def create_default_actions_for_user(user_id):
             grid_col=gcol
         )
         db.session.add(a)
+    bump_action_config(user_id, live=False)
     db.session.commit()
 
 def copy_actions_from_admin_to_user(target_user_id):
@@ -634,6 +922,7 @@ def copy_actions_from_admin_to_user(target_user_id):
             grid_col=getattr(src, 'grid_col', 1) or 1
         )
         db.session.add(a)
+    bump_action_config(target_user_id, live=False)
     db.session.commit()
 
 def seed_team_actions(team_id):
@@ -683,6 +972,7 @@ def seed_team_actions(team_id):
     r2.ingredients = off_actions[:4]
     db.session.add(r1)
     db.session.add(r2)
+    bump_action_config(team.user_id, live=False)
     db.session.commit()
 
 def _action_sort_key(a):
@@ -698,13 +988,82 @@ def _action_sort_key(a):
     gcol = getattr(a, 'grid_col', 0) or 0
     return (bi, grow, gcol)
 
-def get_actions_for_user(user_id, include_hidden=False):
-    """Acciones del usuario ordenadas por bloque y posición en rejilla. Por defecto excluye no visibles."""
+def _query_actions_for_user(user_id, include_hidden=False):
+    """Como get_actions_for_user pero con filas ORM, para las vistas que las modifican (game_config)."""
     q = ActionDefinition.query.filter_by(user_id=user_id, team_id=None).all()
     if not include_hidden:
         q = [a for a in q if a.visible]
     return sorted(q, key=_action_sort_key)
 
+# --- REGISTRO DE ACCIONES (CACHÉ POR WORKER Y VERSIÓN DE CONFIGURACIÓN) ---
+# Cada worker guarda una foto inmutable de las acciones de cada usuario etiquetada con
+# User.action_config_version. Leerla cuesta una consulta de la versión; si otra petición (de
+# cualquier worker) ha cambiado la configuración con bump_action_config, la versión no coincide
+# y la foto se rehace.
+
+ACTION_INFO_FIELDS = ('id', 'name', 'value', 'score_value', 'is_positive', 'icon', 'display_section',
+                      'display_order', 'user_id', 'team_id', 'is_system', 'system_key', 'custom_slot',
+                      'visible', 'description', 'grid_row', 'grid_col')
+ActionInfo = namedtuple('ActionInfo', ACTION_INFO_FIELDS)
+
+class ActionRegistry:
+    """Acciones de un usuario (las globales y las de sus equipos) en una versión de su configuración.
+
+    by_id da la acción por id; ids/values/scores/sections/names son listas paralelas (mismo índice,
+    index[action_id] -> posición) para que el código de estadísticas sume sin tocar objetos."""
+
+    def __init__(self, version, rows):
+        self.version = version
+        self.by_id = {a.id: a for a in rows}
+        self.ordered = sorted((a for a in rows if a.team_id is None), key=_action_sort_key)
+        self.visible = [a for a in self.ordered if a.visible]
+        self._by_team = {}
+        for a in sorted((a for a in rows if a.team_id is not None),
+                        key=lambda a: (a.display_section or '', a.display_order or 0)):
+            self._by_team.setdefault(a.team_id, []).append(a)
+        self._global_by_section = sorted(self.ordered, key=lambda a: (a.display_section or '', a.display_order or 0))
+        self.ids = [a.id for a in rows]
+        self.index = {aid: i for i, aid in enumerate(self.ids)}
+        self.values = [float(a.value or 0.0) for a in rows]
+        self.scores = [int(a.score_value or 0) for a in rows]
+        self.sections = [a.display_section for a in rows]
+        self.names = [a.name for a in rows]
+
+    def get(self, action_id):
+        return self.by_id.get(action_id)
+
+    def for_team(self, team_id):
+        """Acciones propias del equipo o, si no tiene, las globales del usuario (por sección y orden)."""
+        return self._by_team.get(team_id) or self._global_by_section
+
+_action_registries = {}
+
+def get_action_registry(user_id):
+    version = db.session.query(User.action_config_version).filter_by(id=user_id).scalar() or 0
+    registry = _action_registries.get(user_id)
+    if registry is None or registry.version != version:
+        rows = db.session.query(*[getattr(ActionDefinition, f) for f in ACTION_INFO_FIELDS]) \
+            .filter(ActionDefinition.user_id == user_id).all()
+        registry = ActionRegistry(version, [ActionInfo(*r) for r in rows])
+        _action_registries[user_id] = registry
+    return registry
+
+def bump_action_config(user_id, live=True):
+    """Marca como cambiada la configuración de acciones del usuario. Con live=True (cambian valores,
+    nombres o desaparecen acciones) sus partidos se reconstruyen también. No hace commit."""
+    db.session.execute(update(User).where(User.id == user_id)
+                       .values(action_config_version=User.action_config_version + 1),
+                       execution_options={'synchronize_session': False})
+    if live:
+        invalidate_match_live(user_id)
+    bump_team_data(user_id=user_id)
+
+def get_actions_for_user(user_id, include_hidden=False):
+    """Acciones del usuario ordenadas por bloque y posición en rejilla. Por defecto excluye no visibles.
+    Devuelve ActionInfo (solo lectura) del registro en memoria; para modificarlas usar _query_actions_for_user."""
+    registry = get_action_registry(user_id)
+    return list(registry.ordered if include_hidden else registry.visible)
+
 def get_actions_for_team(team_id, user_id):
     """Acciones para partidos: siempre usa las acciones del usuario (configuración global).
     Esto garantiza que el tracker sea un espejo exacto de /game_config."""
@@ -761,6 +1120,9 @@ def home():
     elif sort_by == 'views_desc': drills.sort(key=lambda x: x.views, reverse=True)
     elif sort_by == 'favs_desc': drills.sort(key=lambda x: x.favorited_by.count(), reverse=True)
     elif sort_by == 'date_desc': drills.sort(key=lambda x: x.date_posted, reverse=True)
+    elif sort_by == 'usage_desc':
+        usage = drill_usage_totals()
+        drills.sort(key=lambda x: (usage.get(x.id, 0), x.views or 0), reverse=True)
     for d in drills:
         if not d.cover_image and d.primary_tag:
             d.cover_fallback = pick_cover_from_tag(d.primary_tag)
@@ -875,12 +1237,19 @@ def delete_drill(id):
     drill = Drill.query.get(id)
     if drill and (drill.user_id == current_user.id or current_user.is_admin):
         # Eliminar todas las referencias antes de borrar el ejercicio
+        bump_team_data(gallery_team_ids([id]))
         TeamGalleryItem.query.filter_by(drill_id=id).delete()
         db.session.execute(team_gallery_drills.delete().where(team_gallery_drills.c.drill_id == id))
         db.session.execute(favorites.delete().where(favorites.c.drill_id == id))
         db.session.execute(drill_primary_tags.delete().where(drill_primary_tags.c.drill_id == id))
         db.session.execute(drill_secondary_tags.delete().where(drill_secondary_tags.c.drill_id == id))
+        scored_sessions = [sid for (sid,) in db.session.query(SessionScore.session_id).filter_by(drill_id=id).distinct()]
         SessionScore.query.filter_by(drill_id=id).delete()
+        SessionDrillScoring.query.filter_by(drill_id=id).delete()
+        rebuild_session_points(scored_sessions)
+        DrillUsage.query.filter_by(drill_id=id).delete()
+        SessionPlannedDrill.query.filter_by(drill_id=id).delete()
+        SessionItemExecution.query.filter_by(drill_id=id).update({'drill_id': None})
         DrillView.query.filter_by(drill_id=id).delete()
         TrainingItem.query.filter_by(drill_id=id).delete()
         # Ahora eliminar el ejercicio
@@ -889,6 +1258,83 @@ def delete_drill(id):
         flash('Ejercicio eliminado correctamente')
     return redirect('/')
 
+PLAN_ITEM_MAX_DURATION = 240
+
+def parse_plan_payload(exercises_json, blocks_csv, user_id):
+    """Valida el JSON de ejercicios del formulario de plan.
+
+    Formato: {"<bloque>": [{"drill_id": int, "duration": int?}, ...], ...}
+    Devuelve (filas, errores). Las filas están listas para bulk_insert_plan_items.
+    La visibilidad de todos los drill_id se comprueba con una única consulta IN.
+    """
+    try:
+        data = json.loads(exercises_json or '{}')
+    except json.JSONDecodeError:
+        return [], ['Los ejercicios del plan no tienen un formato válido']
+    if not isinstance(data, dict):
+        return [], ['Los ejercicios del plan deben agruparse por bloque']
+    allowed_blocks = {b for b in (blocks_csv or '').split(',') if b}
+    rows, errors = [], []
+    for block_name, exercises in data.items():
+        if not block_name or len(block_name) > 50:
+            errors.append(f'Nombre de bloque inválido: "{block_name[:50]}"')
+            continue
+        if not isinstance(exercises, list):
+            errors.append(f'Bloque "{block_name}": se esperaba una lista de ejercicios')
+            continue
+        if not exercises:
+            continue
+        if allowed_blocks and block_name not in allowed_blocks:
+            errors.append(f'El bloque "{block_name}" no está en la estructura del plan')
+            continue
+        for idx, ex in enumerate(exercises):
+            if not isinstance(ex, dict):
+                errors.append(f'Bloque "{block_name}", ejercicio {idx + 1}: formato inválido')
+                continue
+            try:
+                drill_id = int(ex['drill_id'])
+                duration = int(ex.get('duration', 10))
+            except KeyError:
+                errors.append(f'Bloque "{block_name}", ejercicio {idx + 1}: falta drill_id')
+                continue
+            except (TypeError, ValueError):
+                errors.append(f'Bloque "{block_name}", ejercicio {idx + 1}: valores no numéricos')
+                continue
+            if not 0 < duration <= PLAN_ITEM_MAX_DURATION:
+                errors.append(f'Bloque "{block_name}", ejercicio {idx + 1}: duración fuera de rango')
+                continue
+            rows.append({'drill_id': drill_id, 'block_name': block_name, 'order': idx, 'duration': duration})
+    if rows and not errors:
+        drill_ids = {r['drill_id'] for r in rows}
+        visible = {d for (d,) in db.session.query(Drill.id).filter(
+            Drill.id.in_(drill_ids), or_(Drill.is_public == True, Drill.user_id == user_id)).all()}
+        missing = sorted(drill_ids - visible)
+        if missing:
+            errors.append(f'Ejercicios inexistentes o no disponibles: {", ".join(map(str, missing))}')
+    return (rows, errors) if not errors else ([], errors)
+
+def bulk_insert_plan_items(plan_id, rows):
+    """Inserta todos los TrainingItem de un plan con un único INSERT multi-fila."""
+    if rows:
+        db.session.execute(insert(TrainingItem), [dict(r, training_plan_id=plan_id) for r in rows])
+
+def plan_form_draft(form):
+    """Plan enviado con errores tal como venía del navegador: campos, orden de bloques y ejercicios por bloque."""
+    try:
+        exercises = json.loads(form.get('exercises_json') or '{}')
+    except json.JSONDecodeError:
+        exercises = {}
+    if not isinstance(exercises, dict):
+        exercises = {}
+    exercises = {block: [ex for ex in lst if isinstance(ex, dict)]
+                 for block, lst in exercises.items() if block and isinstance(lst, list)}
+    blocks = [b for b in (form.get('blocks_csv') or '').split(',') if b]
+    blocks += [b for b in exercises if b not in blocks]
+    for block in blocks:
+        exercises.setdefault(block, [])
+    return {'name': form.get('name') or '', 'team': form.get('team') or '', 'date': form.get('date') or '',
+            'notes': form.get('notes') or '', 'blocks': blocks, 'exercises': exercises}
+
 @app.route('/create_plan', methods=['GET', 'POST'])
 @login_required
 def create_plan():
@@ -900,28 +1346,21 @@ def create_plan():
         notes = request.form.get('notes')
         blocks_csv = request.form.get('blocks_csv')
         exercises_json = request.form.get('exercises_json', '{}')
+        items_rows, errors = parse_plan_payload(exercises_json, blocks_csv, current_user.id)
+        if errors:
+            for err in errors[:5]:
+                flash(err)
+            # Volver a pintar el formulario con lo enviado para no perder el plan montado en el navegador
+            tags = Tag.query.order_by(Tag.display_order.asc(), Tag.name.asc()).all()
+            draft = plan_form_draft(request.form)
+            return render_template('create_plan.html', blocks=draft['blocks'], standard_blocks=STANDARD_BLOCKS, tags=tags,
+                                   now=datetime.utcnow().strftime('%Y-%m-%d'), draft=draft)
         current_user.last_blocks_config = blocks_csv
         plan_date = datetime.strptime(date_str, '%Y-%m-%d') if date_str else datetime.utcnow()
         new_plan = TrainingPlan(name=name, team_name=team, date=plan_date, notes=notes, structure=blocks_csv, user_id=current_user.id, is_public=False)
         db.session.add(new_plan)
         db.session.flush()  # Para obtener el ID del plan
-        
-        # Añadir ejercicios si hay
-        try:
-            exercises_data = json.loads(exercises_json)
-            for block_name, exercises in exercises_data.items():
-                for idx, ex in enumerate(exercises):
-                    item = TrainingItem(
-                        training_plan_id=new_plan.id,
-                        drill_id=ex['drill_id'],
-                        block_name=block_name,
-                        order=idx,
-                        duration=ex.get('duration', 10)
-                    )
-                    db.session.add(item)
-        except (json.JSONDecodeError, KeyError, TypeError):
-            pass  # Si hay error, simplemente no añadimos ejercicios
-        
+        bulk_insert_plan_items(new_plan.id, items_rows)
         db.session.commit()
         return redirect(url_for('view_plan', id=new_plan.id))
     user_blocks = current_user.last_blocks_config if current_user.last_blocks_config else STANDARD_BLOCKS
@@ -960,6 +1399,7 @@ def add_item_to_plan():
     if not plan or plan.user_id != current_user.id: return "Error", 403
     item = TrainingItem(training_plan_id=plan.id, drill_id=drill_id, block_name=block_name, duration=10)
     db.session.add(item)
+    _bump_plan_version(plan)
     db.session.commit()
     return redirect(url_for('view_plan', id=plan.id))
 
@@ -981,6 +1421,7 @@ def api_add_item_to_plan():
     
     item = TrainingItem(training_plan_id=plan.id, drill_id=drill_id, block_name=block_name, duration=duration)
     db.session.add(item)
+    _bump_plan_version(plan)
     db.session.commit()
     return jsonify({'status': 'ok', 'item_id': item.id})
 
@@ -1045,6 +1486,7 @@ def update_item_duration():
     item = TrainingItem.query.get(item_id)
     if item and item.plan.user_id == current_user.id:
         item.duration = int(duration)
+        _bump_plan_version(item.plan)
         db.session.commit()
         return jsonify({'status': 'ok'})
     return jsonify({'status': 'error'})
@@ -1055,20 +1497,243 @@ def delete_plan_item(id):
     item = TrainingItem.query.get_or_404(id)
     if item.plan.user_id == current_user.id:
         plan_id = item.plan.id
+        _bump_plan_version(item.plan)
         db.session.delete(item)
         db.session.commit()
         return redirect(url_for('view_plan', id=plan_id))
     return redirect('/')
 
+def _bump_plan_version(plan):
+    plan.version = (plan.version or 1) + 1
+
+PLAN_ITEM_OPS = ('move', 'resize', 'delete', 'insert')
+
+@app.route('/api/plan/<int:plan_id>/items', methods=['PATCH'])
+@login_required
+def api_plan_items_batch(plan_id):
+    """Aplica un lote de operaciones sobre los ejercicios de un plan en una sola transacción.
+
+    Body: {version?: int, ops: [
+        {op: 'move', item_id, block_name?, position},
+        {op: 'resize', item_id, duration},
+        {op: 'delete', item_id},
+        {op: 'insert', drill_id, block_name, position?, duration?, temp_id?}
+    ]}
+    Si se envía version y no coincide con la del plan, responde 409 sin aplicar nada.
+    El orden resultante se escribe con un único UPDATE ... CASE.
+    """
+    plan = TrainingPlan.query.get_or_404(plan_id)
+    if plan.user_id != current_user.id:
+        return jsonify({'status': 'error', 'message': 'No autorizado'}), 403
+    data = request.get_json() or {}
+    ops = data.get('ops')
+    if not isinstance(ops, list) or not ops:
+        return jsonify({'status': 'error', 'message': 'ops debe ser una lista no vacía'}), 400
+    expected_version = data.get('version')
+    if expected_version is not None and (not isinstance(expected_version, int) or isinstance(expected_version, bool)):
+        return jsonify({'status': 'error', 'message': 'version debe ser un entero'}), 400
+    if expected_version is not None and expected_version != plan.version:
+        return jsonify({'status': 'conflict', 'version': plan.version}), 409
+
+    items = TrainingItem.query.filter_by(training_plan_id=plan.id).order_by(TrainingItem.order, TrainingItem.id).all()
+    by_id = {it.id: it for it in items}
+    # Estado en memoria: bloque -> lista ordenada de entradas; cada entrada es un item existente o un dict nuevo
+    blocks = {}
+    for it in items:
+        blocks.setdefault(it.block_name, []).append(it)
+    durations = {it.id: it.duration for it in items}
+    deleted = set()
+    new_entries = []
+
+    def _locate(entry):
+        for bname, lst in blocks.items():
+            for idx, e in enumerate(lst):
+                if e is entry:
+                    return bname, idx
+        return None, None
+
+    def _place(entry, block_name, position):
+        lst = blocks.setdefault(block_name, [])
+        pos = len(lst) if position is None else max(0, min(int(position), len(lst)))
+        lst.insert(pos, entry)
+
+    for n, op in enumerate(ops):
+        kind = op.get('op') if isinstance(op, dict) else None
+        if kind not in PLAN_ITEM_OPS:
+            return jsonify({'status': 'error', 'message': f'Operación {n}: tipo inválido'}), 400
+        try:
+            if kind == 'insert':
+                block_name = (op.get('block_name') or '').strip()[:50]
+                if not block_name:
+                    return jsonify({'status': 'error', 'message': f'Operación {n}: block_name requerido'}), 400
+                entry = {'drill_id': int(op['drill_id']), 'duration': int(op.get('duration', 10)),
+                         'temp_id': op.get('temp_id')}
+                new_entries.append(entry)
+                _place(entry, block_name, op.get('position'))
+                continue
+            item = by_id.get(int(op.get('item_id')))
+            if item is None or item.id in deleted:
+                return jsonify({'status': 'error', 'message': f'Operación {n}: ejercicio no encontrado'}), 404
+            if kind == 'resize':
+                durations[item.id] = max(0, int(op['duration']))
+            elif kind == 'delete':
+                bname, idx = _locate(item)
+                blocks[bname].pop(idx)
+                deleted.add(item.id)
+            elif kind == 'move':
+                bname, idx = _locate(item)
+                blocks[bname].pop(idx)
+                target = (op.get('block_name') or bname).strip()[:50]
+                _place(item, target, op.get('position'))
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return jsonify({'status': 'error', 'message': f'Operación {n}: datos inválidos'}), 400
+
+    if new_entries:
+        drill_ids = {e['drill_id'] for e in new_entries}
+        visible = {d for (d,) in db.session.query(Drill.id).filter(
+            Drill.id.in_(drill_ids), or_(Drill.is_public == True, Drill.user_id == current_user.id)).all()}
+        if drill_ids - visible:
+            return jsonify({'status': 'error', 'message': f'Ejercicios no disponibles: {sorted(drill_ids - visible)}'}), 400
+
+    # Optimistic lock: el UPDATE solo afecta si nadie ha cambiado la versión mientras tanto
+    bumped = db.session.execute(
+        TrainingPlan.__table__.update()
+        .where(TrainingPlan.id == plan.id, TrainingPlan.version == plan.version)
+        .values(version=TrainingPlan.version + 1)
+    ).rowcount
+    if not bumped:
+        db.session.rollback()
+        return jsonify({'status': 'conflict', 'version': TrainingPlan.query.get(plan_id).version}), 409
+
+    if deleted:
+        TrainingItem.query.filter(TrainingItem.id.in_(deleted)).delete(synchronize_session=False)
+
+    new_order, new_block, new_duration = {}, {}, {}
+    pending_inserts = []
+    for bname, lst in blocks.items():
+        for idx, e in enumerate(lst):
+            if isinstance(e, dict):
+                pending_inserts.append(dict(training_plan_id=plan.id, drill_id=e['drill_id'], block_name=bname,
+                                            order=idx, duration=e['duration'], temp_id=e['temp_id']))
+                continue
+            if e.order != idx: new_order[e.id] = idx
+            if e.block_name != bname: new_block[e.id] = bname
+            if e.duration != durations[e.id]: new_duration[e.id] = durations[e.id]
+
+    changed_ids = set(new_order) | set(new_block) | set(new_duration)
+    if changed_ids:
+        t = TrainingItem.__table__
+        values = {}
+        if new_order: values['order'] = case(new_order, value=t.c.id, else_=t.c.order)
+        if new_block: values['block_name'] = case(new_block, value=t.c.id, else_=t.c.block_name)
+        if new_duration: values['duration'] = case(new_duration, value=t.c.id, else_=t.c.duration)
+        db.session.execute(t.update().where(t.c.id.in_(changed_ids)).values(**values))
+
+    inserted = {}
+    if pending_inserts:
+        # add_all + flush: SQLAlchemy agrupa las filas en un INSERT multi-fila donde el dialecto lo permite
+        temp_ids = [row.pop('temp_id') for row in pending_inserts]
+        new_items = [TrainingItem(**row) for row in pending_inserts]
+        db.session.add_all(new_items)
+        db.session.flush()
+        inserted = {str(tid): it.id for tid, it in zip(temp_ids, new_items) if tid is not None}
+
+    db.session.commit()
+    rows = db.session.query(TrainingItem.id, TrainingItem.drill_id, TrainingItem.block_name,
+                            TrainingItem.order, TrainingItem.duration) \
+        .filter_by(training_plan_id=plan.id).order_by(TrainingItem.block_name, TrainingItem.order).all()
+    return jsonify({
+        'status': 'ok',
+        'version': plan.version,
+        'inserted': inserted,
+        'items': [{'id': r.id, 'drill_id': r.drill_id, 'block_name': r.block_name, 'order': r.order, 'duration': r.duration} for r in rows]
+    })
+
+# --- CLONADO DE PLANES Y EJERCICIOS (INSERT ... SELECT) ---
+def _insert_from_select(table, columns, select_stmt):
+    """Ejecuta INSERT ... SELECT de una sola fila y devuelve el id generado."""
+    stmt = table.insert().from_select(columns, select_stmt)
+    if db.engine.dialect.insert_returning:
+        return db.session.execute(stmt.returning(table.c.id)).scalar_one()
+    return db.session.execute(stmt).lastrowid
+
+def clone_drill(drill_id, user_id):
+    """Copia un ejercicio y sus etiquetas secundarias en el servidor, sin cargar objetos ORM."""
+    d = Drill.__table__
+    new_id = _insert_from_select(
+        d,
+        ['title', 'description', 'date_posted', 'media_type', 'media_file', 'external_link',
+         'cover_image', 'is_public', 'views', 'user_id', 'primary_tag_id'],
+        select(
+            d.c.title + ' (Copia)', d.c.description, literal(datetime.utcnow()), d.c.media_type,
+            d.c.media_file, d.c.external_link, d.c.cover_image, false(), literal(0),
+            literal(user_id), d.c.primary_tag_id
+        ).where(d.c.id == drill_id)
+    )
+    st = drill_secondary_tags
+    db.session.execute(st.insert().from_select(
+        ['drill_id', 'tag_id'],
+        select(literal(new_id), st.c.tag_id).where(st.c.drill_id == drill_id)
+    ))
+    return new_id
+
+def clone_plans(plan_ids, user_id, team_name=None, start_date=None, shift_days=None, name_suffix=' (Copia)'):
+    """Clona varios planes con sus TrainingItem mediante INSERT ... SELECT.
+
+    No hace commit: el llamador decide la transacción, de modo que un lote entero
+    (p. ej. un microciclo) se copia o no se copia. Fechas:
+      - start_date: el plan más antiguo cae en esa fecha y el resto conserva su separación.
+      - shift_days: desplaza todas las fechas ese número de días.
+      - ninguno: fecha actual (comportamiento de /duplicate_plan).
+    Devuelve los ids nuevos en el mismo orden que plan_ids.
+    """
+    from datetime import timedelta
+    plan_ids = list(dict.fromkeys(plan_ids))
+    sources = {
+        pid: pdate for pid, pdate in db.session.query(TrainingPlan.id, TrainingPlan.date)
+        .filter(TrainingPlan.id.in_(plan_ids), TrainingPlan.user_id == user_id).all()
+    }
+    missing = [pid for pid in plan_ids if pid not in sources]
+    if missing:
+        raise ValueError(f'Planes no encontrados: {missing}')
+    now = datetime.utcnow()
+    if start_date is not None:
+        base = min(d or now for d in sources.values())
+        offset = start_date - base.replace(hour=0, minute=0, second=0, microsecond=0)
+    elif shift_days is not None:
+        offset = timedelta(days=shift_days)
+    else:
+        offset = None
+
+    p = TrainingPlan.__table__
+    i = TrainingItem.__table__
+    new_ids = []
+    for pid in plan_ids:
+        new_date = (sources[pid] or now) + offset if offset is not None else now
+        new_pid = _insert_from_select(
+            p,
+            ['name', 'date', 'team_name', 'notes', 'user_id', 'structure', 'is_public'],
+            select(
+                p.c.name + name_suffix if name_suffix else p.c.name,
+                literal(new_date),
+                literal(team_name) if team_name is not None else p.c.team_name,
+                p.c.notes, literal(user_id), p.c.structure, false()
+            ).where(p.c.id == pid)
+        )
+        db.session.execute(i.insert().from_select(
+            ['training_plan_id', 'drill_id', 'block_name', 'order', 'duration'],
+            select(literal(new_pid), i.c.drill_id, i.c.block_name, i.c.order, i.c.duration)
+            .where(i.c.training_plan_id == pid)
+        ))
+        new_ids.append(new_pid)
+    return new_ids
+
 @app.route('/duplicate_drill/<int:id>')
 @login_required
 def duplicate_drill(id):
     original = Drill.query.get_or_404(id)
     if original.user_id != current_user.id and not current_user.is_admin: return redirect('/')
-    clon = Drill(title=f"{original.title} (Copia)", description=original.description, media_type=original.media_type, media_file=original.media_file, external_link=original.external_link, cover_image=original.cover_image, user_id=current_user.id, is_public=False)
-    clon.primary_tag_id = original.primary_tag_id
-    clon.secondary_tags = list(original.secondary_tags)
-    db.session.add(clon)
+    clone_drill(original.id, current_user.id)
     db.session.commit()
     flash('Ejercicio duplicado')
     return redirect('/')
@@ -1078,16 +1743,44 @@ def duplicate_drill(id):
 def duplicate_plan(id):
     original = TrainingPlan.query.get_or_404(id)
     if original.user_id != current_user.id: return redirect('/')
-    clon = TrainingPlan(name=f"{original.name} (Copia)", team_name=original.team_name, notes=original.notes, structure=original.structure, user_id=current_user.id, date=datetime.utcnow())
-    db.session.add(clon)
-    for item in original.items:
-        new_item = TrainingItem(drill_id=item.drill_id, block_name=item.block_name, order=item.order, duration=item.duration)
-        clon.items.append(new_item)
-    db.session.add(clon)
+    clone_plans([original.id], current_user.id)
     db.session.commit()
     flash('Plan duplicado')
     return redirect('/my_plans')
 
+@app.route('/api/plans/clone', methods=['POST'])
+@login_required
+def api_clone_plans():
+    """Clona un lote de planes (p. ej. un microciclo) en una sola transacción.
+
+    Body: {plan_ids: [...], team_id?: int, start_date?: 'YYYY-MM-DD', shift_days?: int, keep_name?: bool}
+    """
+    data = request.get_json() or {}
+    raw_ids = data.get('plan_ids') or []
+    if not isinstance(raw_ids, list) or not raw_ids:
+        return jsonify({'status': 'error', 'message': 'plan_ids debe ser una lista no vacía'}), 400
+    try:
+        plan_ids = list(dict.fromkeys(int(x) for x in raw_ids))
+        shift_days = int(data['shift_days']) if data.get('shift_days') is not None else None
+        start_date = datetime.strptime(data['start_date'], '%Y-%m-%d') if data.get('start_date') else None
+    except (TypeError, ValueError):
+        return jsonify({'status': 'error', 'message': 'Datos inválidos'}), 400
+    team_name = None
+    if data.get('team_id'):
+        team = Team.query.get_or_404(data.get('team_id'))
+        if not _can_edit_team(team):
+            return jsonify({'status': 'error', 'message': 'No autorizado'}), 403
+        team_name = team.name
+    suffix = '' if data.get('keep_name') else ' (Copia)'
+    try:
+        new_ids = clone_plans(plan_ids, current_user.id, team_name=team_name,
+                              start_date=start_date, shift_days=shift_days, name_suffix=suffix)
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'status': 'error', 'message': str(e)}), 404
+    db.session.commit()
+    return jsonify({'status': 'ok', 'plan_ids': new_ids, 'mapping': dict(zip(plan_ids, new_ids))})
+
 @app.route('/delete_plan/<int:id>')
 @login_required
 def delete_plan(id):
@@ -1112,28 +1805,23 @@ def edit_plan(id):
         if date_str: plan.date = datetime.strptime(date_str, '%Y-%m-%d')
         plan.notes = request.form.get('notes')
         blocks_csv = request.form.get('blocks_csv')
+        items_rows, errors = parse_plan_payload(request.form.get('exercises_json', '{}'), blocks_csv, current_user.id)
+        if errors:
+            db.session.rollback()
+            for err in errors[:5]:
+                flash(err)
+            # Igual que create_plan: se vuelve a pintar el formulario con lo enviado, no con lo guardado
+            tags = Tag.query.order_by(Tag.display_order.asc(), Tag.name.asc()).all()
+            draft = plan_form_draft(request.form)
+            return render_template('create_plan.html', plan=plan, blocks=draft['blocks'], standard_blocks=STANDARD_BLOCKS,
+                                   tags=tags, now=datetime.utcnow().strftime('%Y-%m-%d'), draft=draft)
         plan.structure = blocks_csv
         current_user.last_blocks_config = blocks_csv
         
-        # Eliminar ejercicios existentes
+        # Sustituir ejercicios existentes por los del formulario
         TrainingItem.query.filter_by(training_plan_id=plan.id).delete()
-        
-        # Añadir nuevos ejercicios si hay
-        exercises_json = request.form.get('exercises_json', '{}')
-        try:
-            exercises_data = json.loads(exercises_json)
-            for block_name, exercises in exercises_data.items():
-                for idx, ex in enumerate(exercises):
-                    item = TrainingItem(
-                        training_plan_id=plan.id,
-                        drill_id=ex['drill_id'],
-                        block_name=block_name,
-                        order=idx,
-                        duration=ex.get('duration', 10)
-                    )
-                    db.session.add(item)
-        except (json.JSONDecodeError, KeyError, TypeError):
-            pass
+        bulk_insert_plan_items(plan.id, items_rows)
+        _bump_plan_version(plan)
         
         db.session.commit()
         flash('Plan actualizado correctamente')
@@ -1885,36 +2573,202 @@ def view_team(id):
         db.session.commit()
         return redirect(url_for('view_team', id=team.id))
     
-    sessions = TrainingSession.query.filter_by(team_id=team.id, status='finished').order_by(TrainingSession.date.desc()).all()
+    # La ficha es solo el esqueleto con la plantilla: historial, galería, configuración y estadísticas
+    # se piden a /api/team/<id>/sections/... cuando cada bloque entra en pantalla
+    return render_template('view_team.html', team=team, is_owner=is_owner,
+                           gallery_page_size=TEAM_GALLERY_PAGE_SIZE, sessions_page_size=TEAM_SESSIONS_PAGE_SIZE)
+
+# --- SECCIONES DE LA FICHA DE EQUIPO (CARGA DIFERIDA) ---
+
+TEAM_GALLERY_PAGE_SIZE = 12
+TEAM_SESSIONS_PAGE_SIZE = 10
+
+def _cacheable_json(payload):
+    """JSON con ETag del contenido: el navegador revalida siempre (no-cache) y recibe 304 si no cambió."""
+    response = jsonify(payload)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.add_etag(weak=True)
+    return response.make_conditional(request)
+
+def _gallery_covers(drills):
+    """{drill_id: portada de respaldo} para los ejercicios sin portada propia, con una consulta de
+    imágenes de etiqueta y otra de imágenes de grupo para toda la página. La elección es estable
+    por ejercicio para que el ETag de la página no cambie entre peticiones."""
+    pending = [d for d in drills if not d.cover_image and d.primary_tag_id]
+    if not pending:
+        return {}
+    tag_ids = {d.primary_tag_id for d in pending}
+    tag_images, group_images, tag_group = {}, {}, {}
+    for tag_id, filename in db.session.query(TagImage.tag_id, TagImage.filename) \
+            .filter(TagImage.tag_id.in_(tag_ids)).order_by(TagImage.id).all():
+        tag_images.setdefault(tag_id, []).append(filename)
+    tag_group = dict(db.session.query(Tag.id, Tag.group_id).filter(Tag.id.in_(tag_ids), Tag.group_id.isnot(None)).all())
+    if tag_group:
+        for group_id, filename in db.session.query(TagGroupImage.group_id, TagGroupImage.filename) \
+                .filter(TagGroupImage.group_id.in_(set(tag_group.values()))).order_by(TagGroupImage.id).all():
+            group_images.setdefault(group_id, []).append(filename)
+    covers = {}
+    for d in pending:
+        images = tag_images.get(d.primary_tag_id) or group_images.get(tag_group.get(d.primary_tag_id), [])
+        if images:
+            covers[d.id] = images[d.id % len(images)]
+    return covers
+
+def team_gallery_page(team_id, offset=0, limit=TEAM_GALLERY_PAGE_SIZE):
+    """Página de la galería en el orden de TeamGalleryItem (los ejercicios sin orden guardado van al final).
+    Devuelve (items, next_offset) con next_offset=None en la última página."""
+    order_col = func.coalesce(TeamGalleryItem.display_order, 999)
+    rows = db.session.query(Drill, TeamGalleryItem.note) \
+        .join(team_gallery_drills, team_gallery_drills.c.drill_id == Drill.id) \
+        .outerjoin(TeamGalleryItem, and_(TeamGalleryItem.team_id == team_id, TeamGalleryItem.drill_id == Drill.id)) \
+        .filter(team_gallery_drills.c.team_id == team_id) \
+        .order_by(order_col, Drill.id).offset(offset).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    covers = _gallery_covers([d for d, _ in rows])
+    items = [{
+        'id': d.id,
+        'title': d.title,
+        'media_type': d.media_type,
+        'external_link': d.external_link or '',
+        'media_file': d.media_file or '',
+        'cover': d.cover_image or covers.get(d.id) or (d.media_file if d.media_type == 'image' else None),
+        'origin': get_drill_origin(d),
+        'note': note or '',
+    } for d, note in rows]
+    return items, (offset + limit if has_more else None)
+
+@app.route('/api/team/<int:id>/sections/gallery')
+@login_required
+def api_team_section_gallery(id):
+    """Galería paginada: ?offset=0&limit=12 (máx. 50)."""
+    team = Team.query.get_or_404(id)
+    if not _can_edit_team(team): return jsonify({'error': 'No autorizado'}), 403
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = max(1, min(50, request.args.get('limit', TEAM_GALLERY_PAGE_SIZE, type=int)))
+    items, next_offset = team_gallery_page(team.id, offset, limit)
+    return _cacheable_json({'items': items, 'next_offset': next_offset})
+
+def team_config_section(team):
+    """Acciones, rankings y categorías del equipo (o los globales del propietario si no tiene propios)."""
     team_actions = ActionDefinition.query.filter_by(team_id=team.id).order_by(ActionDefinition.display_section, ActionDefinition.display_order).all()
     if not team_actions:
         team_actions = get_actions_for_user(team.user_id, include_hidden=True)
     team_rankings = RankingDefinition.query.filter_by(team_id=team.id).all()
     if not team_rankings:
         team_rankings = RankingDefinition.query.filter_by(user_id=team.user_id, team_id=None).all()
-    categories = ActionCategory.query.filter_by(team_id=team.id).all()
-    
-    # Obtener ejercicios de la galería ordenados con sus notas
-    gallery_items = TeamGalleryItem.query.filter_by(team_id=team.id).order_by(TeamGalleryItem.display_order).all()
-    drill_notes = {item.drill_id: item.note for item in gallery_items}
-    drill_order = {item.drill_id: item.display_order for item in gallery_items}
-    
-    # Ordenar gallery_drills según TeamGalleryItem.display_order
-    gallery_items_ordered = []
-    for d in team.gallery_drills:
-        if not d.cover_image and d.primary_tag:
-            d.cover_fallback = pick_cover_from_tag(d.primary_tag)
-        else:
-            d.cover_fallback = None
-        d.origin = get_drill_origin(d)
-        d.gallery_note = drill_notes.get(d.id, '')
-        d.gallery_order = drill_order.get(d.id, 999)
-        gallery_items_ordered.append(d)
-    
-    # Ordenar por display_order
-    gallery_items_ordered.sort(key=lambda x: x.gallery_order)
-    
-    return render_template('view_team.html', team=team, is_owner=is_owner, sessions=sessions, actions=team_actions, rankings=team_rankings, categories=categories, gallery_items_ordered=gallery_items_ordered)
+    categories = ActionCategory.query.filter_by(team_id=team.id).order_by(ActionCategory.name).all()
+    return {
+        'actions': [{'id': a.id, 'name': a.name, 'value': a.value, 'is_positive': a.is_positive,
+                     'section': a.display_section, 'visible': a.visible} for a in team_actions],
+        'rankings': [{'id': r.id, 'name': r.name, 'icon': r.icon} for r in team_rankings],
+        'categories': [{'id': c.id, 'name': c.name} for c in categories],
+    }
+
+def team_stats_section(team):
+    """Resumen de la temporada: asistencia a entrenamientos y ranking de puntos (ambos O(jugadores))."""
+    return {
+        'attendance': team_attendance_ranking(team.id, season_start()),
+        'training': training_leaderboard(team.id, 'season', limit=10),
+    }
+
+@app.route('/api/team/<int:id>/sections/config')
+@login_required
+def api_team_section_config(id):
+    team = Team.query.get_or_404(id)
+    if not _can_edit_team(team): return jsonify({'error': 'No autorizado'}), 403
+    return _cacheable_json(team_config_section(team))
+
+@app.route('/api/team/<int:id>/sections/stats')
+@login_required
+def api_team_section_stats(id):
+    team = Team.query.get_or_404(id)
+    if not _can_edit_team(team): return jsonify({'error': 'No autorizado'}), 403
+    return _cacheable_json(team_stats_section(team))
+
+# --- PANEL DEL EQUIPO (UNA PETICIÓN, SECCIONES CON ETAG PROPIO) ---
+
+DASHBOARD_DEFAULT_FIELDS = ('players', 'attendance', 'sessions', 'teams')
+
+def team_players_section(team, roster=None):
+    """Plantilla ordenada por dorsal. Si ya se cargó el ranking de asistencia (que incluye a toda la
+    plantilla) se reutilizan sus filas en lugar de consultar de nuevo."""
+    if roster is None:
+        roster = [{'player_id': pid, 'name': name, 'dorsal': dorsal, 'photo': photo}
+                  for pid, name, dorsal, photo in db.session.query(
+                      Player.id, Player.name, Player.dorsal, Player.photo_file).filter_by(team_id=team.id).all()]
+    players = [{'id': r['player_id'], 'name': r['name'], 'dorsal': r['dorsal'], 'photo': r['photo']} for r in roster]
+    players.sort(key=lambda p: (p['dorsal'] is None, p['dorsal'] or 0, p['name']))
+    return players
+
+def _dashboard_attendance(team, ctx):
+    ranking = team_attendance_ranking(team.id, ctx['start_dt'], ctx['end_dt'])
+    ctx['roster'] = ranking
+    total = db.session.query(func.count(TrainingSession.id)).filter(
+        TrainingSession.team_id == team.id, TrainingSession.status == 'finished',
+        *([TrainingSession.date >= ctx['start_dt']] if ctx['start_dt'] else []),
+        *([TrainingSession.date < ctx['end_dt']] if ctx['end_dt'] else [])).scalar()
+    return {'ranking': ranking, 'total_sessions': int(total or 0)}
+
+def _dashboard_sessions(team, ctx):
+    sessions, next_cursor = load_finished_sessions_page(
+        team.id, limit=ctx['limit'], cursor=ctx['cursor'], start_dt=ctx['start_dt'], end_dt=ctx['end_dt'])
+    return {'sessions': sessions, 'next_cursor': next_cursor, 'has_more': next_cursor is not None}
+
+def _dashboard_gallery(team, ctx):
+    items, next_offset = team_gallery_page(team.id)
+    return {'items': items, 'next_offset': next_offset}
+
+# Se resuelven en este orden (attendance antes que players para compartir la plantilla)
+DASHBOARD_SECTIONS = {
+    'attendance': _dashboard_attendance,
+    'players': lambda team, ctx: team_players_section(team, ctx.get('roster')),
+    'sessions': _dashboard_sessions,
+    'teams': lambda team, ctx: [{'id': t.id, 'name': t.name, 'logo_file': t.logo_file}
+                                for t in sorted(_user_teams(), key=lambda t: t.name)],
+    'gallery': _dashboard_gallery,
+    'config': lambda team, ctx: team_config_section(team),
+    'stats': lambda team, ctx: team_stats_section(team),
+}
+
+def _section_etag(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()[:20]
+
+@app.route('/api/team/<int:id>/dashboard')
+@login_required
+def api_team_dashboard(id):
+    """Panel del equipo en una sola petición.
+
+    ?fields=players,attendance,sessions,teams (también gallery, config, stats); por defecto los cuatro primeros.
+    ?etags=players:<etag>,sessions:<etag> con los ETag de secciones que el cliente ya tiene: esas secciones
+    vuelven como {'etag', 'not_modified': true} sin datos. sessions admite limit/cursor y attendance y sessions
+    start_date/end_date, como sus endpoints individuales.
+    """
+    team = Team.query.get_or_404(id)
+    if not _can_edit_team(team): return jsonify({'error': 'No autorizado'}), 403
+    fields = [f.strip() for f in request.args.get('fields', ','.join(DASHBOARD_DEFAULT_FIELDS)).split(',') if f.strip()]
+    unknown = [f for f in fields if f not in DASHBOARD_SECTIONS]
+    if unknown:
+        return jsonify({'error': f'Secciones desconocidas: {", ".join(unknown)}'}), 400
+    known = dict(pair.split(':', 1) for pair in request.args.get('etags', '').split(',') if ':' in pair)
+    try:
+        start_dt, end_dt = _parse_date_range(request.args)
+    except ValueError:
+        return jsonify({'error': 'Fechas inválidas'}), 400
+    ctx = {'start_dt': start_dt, 'end_dt': end_dt, 'cursor': request.args.get('cursor'),
+           'limit': max(1, min(100, request.args.get('limit', 20, type=int)))}
+    sections = {}
+    for name, build in DASHBOARD_SECTIONS.items():
+        if name not in fields:
+            continue
+        try:
+            data = build(team, ctx)
+        except ValueError:
+            return jsonify({'error': f'Parámetros inválidos para {name}'}), 400
+        etag = _section_etag(data)
+        sections[name] = {'etag': etag, 'not_modified': True} if known.get(name) == etag else {'etag': etag, 'data': data}
+    return _cacheable_json({'team_id': team.id, 'sections': sections})
 
 def _user_teams():
     owned = Team.query.filter_by(user_id=current_user.id).all()
@@ -1984,6 +2838,7 @@ def api_team_action_add(team_id):
     for tid in team_ids:
         a = ActionDefinition(name=name, value=val, is_positive=is_pos, icon=icon, user_id=team.user_id, team_id=tid)
         db.session.add(a)
+    bump_action_config(team.user_id, live=False)
     db.session.commit()
     return jsonify({'status': 'ok'})
 
@@ -2003,6 +2858,7 @@ def api_team_action_update(team_id):
         for o in others:
             if 'value' in d: o.value = max(-10, min(10, float(d.get('value', o.value))))
             if 'name' in d: o.name = (d.get('name') or '')[:8]
+    bump_action_config(team.user_id)
     db.session.commit()
     return jsonify({'status': 'ok'})
 
@@ -2019,6 +2875,7 @@ def api_team_action_delete(team_id, aid):
     for tid in teams:
         for a in ActionDefinition.query.filter_by(team_id=tid, name=name).all():
             db.session.delete(a)
+    bump_action_config(team.user_id)
     db.session.commit()
     return jsonify({'status': 'ok'})
 
@@ -2066,6 +2923,38 @@ def api_team_ranking_delete(team_id, rid):
     db.session.commit()
     return jsonify({'status': 'ok'})
 
+def team_attendance_ranking(team_id, start_dt=None, end_dt=None):
+    """Asistencia por jugador en sesiones finalizadas: un único GROUP BY sobre
+    session_attendance ⨝ training_session, unido por LEFT JOIN a la plantilla para
+    incluir también a quien no ha venido nunca. 'total_sessions' cuenta las sesiones
+    en las que el jugador estaba convocado (tenía fila de asistencia)."""
+    conds = [TrainingSession.team_id == team_id, TrainingSession.status == 'finished']
+    if start_dt: conds.append(TrainingSession.date >= start_dt)
+    if end_dt: conds.append(TrainingSession.date < end_dt)
+    agg = select(
+        SessionAttendance.player_id.label('player_id'),
+        func.count().label('total'),
+        func.sum(case((SessionAttendance.is_present == True, 1), else_=0)).label('attended')
+    ).join(TrainingSession, TrainingSession.id == SessionAttendance.session_id) \
+        .where(*conds).group_by(SessionAttendance.player_id).subquery()
+    rows = db.session.query(
+        Player.id, Player.name, Player.dorsal, Player.photo_file,
+        func.coalesce(agg.c.total, 0), func.coalesce(agg.c.attended, 0)
+    ).outerjoin(agg, agg.c.player_id == Player.id).filter(Player.team_id == team_id).all()
+    ranking = []
+    for pid, name, dorsal, photo, total, attended in rows:
+        ranking.append({
+            'player_id': pid,
+            'name': name,
+            'dorsal': dorsal,
+            'photo': photo,
+            'total_sessions': int(total),
+            'attended': int(attended),
+            'percentage': round(attended / total * 100, 1) if total else 0
+        })
+    ranking.sort(key=lambda x: (x['attended'], x['percentage']), reverse=True)
+    return ranking
+
 @app.route('/api/team_attendance_stats/<int:team_id>', methods=['GET'])
 @login_required
 def api_team_attendance_stats(team_id):
@@ -2074,65 +2963,32 @@ def api_team_attendance_stats(team_id):
     is_staff = TeamStaff.query.filter_by(team_id=team.id, email=current_user.email, status='accepted').first()
     if not is_owner and not is_staff: return jsonify({'error': 'No autorizado'}), 403
     
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
+    try:
+        start_dt, end_dt = _parse_date_range(request.args)
+    except ValueError:
+        return jsonify({'error': 'Fechas inválidas'}), 400
     
-    query = TrainingSession.query.filter_by(team_id=team_id, status='finished')
-    if start_date:
-        query = query.filter(TrainingSession.date >= datetime.strptime(start_date, '%Y-%m-%d'))
-    if end_date:
-        query = query.filter(TrainingSession.date <= datetime.strptime(end_date, '%Y-%m-%d'))
+    attendance_ranking = team_attendance_ranking(team.id, start_dt, end_dt)
     
+    # Lista de sesiones con los presentes: 2 consultas (sesiones + presentes con IN)
+    query = db.session.query(TrainingSession.id, TrainingSession.date, TrainingPlan.name) \
+        .outerjoin(TrainingPlan, TrainingPlan.id == TrainingSession.plan_id) \
+        .filter(TrainingSession.team_id == team.id, TrainingSession.status == 'finished')
+    if start_dt: query = query.filter(TrainingSession.date >= start_dt)
+    if end_dt: query = query.filter(TrainingSession.date < end_dt)
     sessions = query.order_by(TrainingSession.date.desc()).all()
-    
-    # Calcular estadísticas
-    player_stats = {}
-    sessions_list = []
-    
-    for session in sessions:
-        plan = TrainingPlan.query.get(session.plan_id) if session.plan_id else None
-        session_data = {
-            'id': session.id,
-            'date': session.date.strftime('%d/%m/%Y'),
-            'plan_name': plan.name if plan else 'Sin plan',
-            'players_present': []
-        }
-        
-        for att in session.attendance:
-            if att.is_present:
-                player = Player.query.get(att.player_id)
-                if player:
-                    session_data['players_present'].append({
-                        'id': player.id,
-                        'name': player.name,
-                        'dorsal': player.dorsal
-                    })
-                    
-                    # Actualizar estadísticas del jugador
-                    if player.id not in player_stats:
-                        player_stats[player.id] = {
-                            'name': player.name,
-                            'dorsal': player.dorsal,
-                            'photo': player.photo_file,
-                            'total_sessions': 0,
-                            'attended': 0
-                        }
-                    player_stats[player.id]['total_sessions'] += 1
-                    player_stats[player.id]['attended'] += 1
-        
-        sessions_list.append(session_data)
-    
-    # Calcular porcentajes y ordenar por asistencia
-    attendance_ranking = []
-    for pid, stats in player_stats.items():
-        percentage = (stats['attended'] / stats['total_sessions'] * 100) if stats['total_sessions'] > 0 else 0
-        attendance_ranking.append({
-            **stats,
-            'percentage': round(percentage, 1),
-            'player_id': pid
-        })
-    
-    attendance_ranking.sort(key=lambda x: x['attended'], reverse=True)
+    present = {}
+    if sessions:
+        for sid, pid, pname, pdorsal in db.session.query(SessionAttendance.session_id, Player.id, Player.name, Player.dorsal) \
+                .join(Player, Player.id == SessionAttendance.player_id) \
+                .filter(SessionAttendance.session_id.in_([s.id for s in sessions]), SessionAttendance.is_present == True).all():
+            present.setdefault(sid, []).append({'id': pid, 'name': pname, 'dorsal': pdorsal})
+    sessions_list = [{
+        'id': sid,
+        'date': sdate.strftime('%d/%m/%Y'),
+        'plan_name': plan_name or 'Sin plan',
+        'players_present': present.get(sid, [])
+    } for sid, sdate, plan_name in sessions]
     
     return jsonify({
         'sessions': sessions_list,
@@ -2297,16 +3153,7 @@ def api_get_team_players():
     is_staff = TeamStaff.query.filter_by(team_id=team.id, email=current_user.email, status='accepted').first()
     if not is_owner and not is_staff: return jsonify({'error': 'Unauthorized'}), 403
     
-    players = []
-    for player in team.players:
-        players.append({
-            'id': player.id,
-            'name': player.name,
-            'dorsal': player.dorsal,
-            'photo': player.photo_file
-        })
-    
-    return jsonify({'players': players})
+    return jsonify({'players': team_players_section(team)})
 
 @app.route('/api/start_session_from_court', methods=['POST'])
 @login_required
@@ -2321,20 +3168,33 @@ def api_start_session_from_court():
     is_staff = TeamStaff.query.filter_by(team_id=team.id, email=current_user.email, status='accepted').first()
     if not is_owner and not is_staff: return jsonify({'error': 'Unauthorized'}), 403
     
-    # Crear nueva sesión
-    new_session = TrainingSession(team_id=team_id, plan_id=plan_id, status='active')
-    db.session.add(new_session)
-    db.session.flush()
-    
-    # Añadir asistencia para TODOS los jugadores del equipo (presentes y ausentes)
-    for player in team.players:
-        is_present = player.id in player_ids
-        att = SessionAttendance(session_id=new_session.id, player_id=player.id, is_present=is_present)
-        db.session.add(att)
-    
+    # Crear nueva sesión con asistencia para TODOS los jugadores del equipo (presentes y ausentes)
+    try:
+        present_ids = [int(pid) for pid in player_ids]
+    except (TypeError, ValueError):
+        return jsonify({'error': 'player_ids inválidos'}), 400
+    new_session = open_training_session(team, plan_id, present_ids)
     db.session.commit()
     return jsonify({'status': 'ok', 'session_id': new_session.id})
 
+def open_training_session(team, plan_id, present_ids=None):
+    """Crea una sesión activa y su asistencia con un único INSERT ... SELECT sobre la plantilla
+    (present_ids=None marca a todos presentes). No hace commit."""
+    new_session = TrainingSession(team_id=team.id, plan_id=plan_id or None, status='active')
+    db.session.add(new_session)
+    db.session.flush()
+    is_present = literal(True) if present_ids is None else \
+        (Player.id.in_(present_ids) if present_ids else false())
+    roster = select(literal(new_session.id), Player.id, is_present).where(Player.team_id == team.id)
+    db.session.execute(insert(SessionAttendance).from_select(['session_id', 'player_id', 'is_present'], roster))
+    if new_session.plan_id:
+        planned = select(literal(new_session.id), TrainingItem.drill_id, func.count(TrainingItem.id)) \
+            .where(TrainingItem.training_plan_id == new_session.plan_id).group_by(TrainingItem.drill_id)
+        db.session.execute(insert(SessionPlannedDrill).from_select(['session_id', 'drill_id', 'n'], planned))
+        apply_drill_usage_delta(team.id, {drill_id: (n, 0, 0, 0, 0) for drill_id, n in db.session.query(
+            SessionPlannedDrill.drill_id, SessionPlannedDrill.n).filter_by(session_id=new_session.id).all()})
+    return new_session
+
 @app.route('/api/get_absent_players')
 @login_required
 def api_get_absent_players():
@@ -2375,13 +3235,43 @@ def api_save_exercise_execution():
     is_staff = TeamStaff.query.filter_by(team_id=team.id, email=current_user.email, status='accepted').first()
     if not is_owner and not is_staff: return jsonify({'error': 'Unauthorized'}), 403
     
+    try:
+        save_exercise_execution(session, training_item_id, was_completed, actual_duration)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e) or 'Datos inválidos'}), 400
+    refresh_session_load(session)
+    db.session.commit()
+    return jsonify({'status': 'ok'})
+
+def save_exercise_execution(session, training_item_id, was_completed=True, actual_duration=None):
+    """Crea o actualiza la ejecución de un ejercicio del plan de la sesión. No hace commit.
+    Lanza ValueError (antes de escribir nada) si el ejercicio no pertenece al plan."""
+    training_item_id = int(training_item_id)
+    if actual_duration is not None:
+        actual_duration = int(actual_duration)
+    was_completed = bool(was_completed)
+    in_plan = db.session.query(TrainingItem.drill_id, TrainingItem.duration).filter_by(
+        id=training_item_id, training_plan_id=session.plan_id).first()
+    if not in_plan:
+        raise ValueError(f'El ejercicio {training_item_id} no pertenece al plan de la sesión')
+    drill_id, planned_duration = in_plan
+
     # Buscar ejecución existente o crear nueva
     execution = SessionItemExecution.query.filter_by(
-        session_id=session_id,
+        session_id=session.id,
         training_item_id=training_item_id
     ).first()
-    
+
+    # Se descuenta lo que sumó la ejecución con la duración planificada que tenía entonces
+    before = _execution_usage(execution.was_completed, execution.actual_duration,
+                              execution.planned_duration if execution.planned_duration is not None else planned_duration) \
+        if execution else (0, 0, 0, 0, 0)
+    after = _execution_usage(was_completed, actual_duration, planned_duration)
+    apply_drill_usage_delta(session.team_id, {drill_id: tuple(a - b for a, b in zip(after, before))})
+
     if execution:
+        execution.drill_id = drill_id
+        execution.planned_duration = planned_duration
         execution.was_completed = was_completed
         execution.actual_duration = actual_duration
         if was_completed:
@@ -2390,16 +3280,16 @@ def api_save_exercise_execution():
             execution.completed_at = None
     else:
         execution = SessionItemExecution(
-            session_id=session_id,
+            session_id=session.id,
             training_item_id=training_item_id,
+            drill_id=drill_id,
+            planned_duration=planned_duration,
             was_completed=was_completed,
             actual_duration=actual_duration,
             completed_at=datetime.utcnow() if was_completed else None
         )
         db.session.add(execution)
-    
-    db.session.commit()
-    return jsonify({'status': 'ok'})
+    return execution
 
 @app.route('/api/finish_session/<int:session_id>', methods=['POST'])
 @login_required
@@ -2411,70 +3301,133 @@ def api_finish_session(session_id):
     if not is_owner and not is_staff: return jsonify({'error': 'Unauthorized'}), 403
     
     session.status = 'finished'
+    refresh_session_load(session)
     db.session.commit()
     return jsonify({'status': 'ok'})
 
+def _parse_date_range(args):
+    """Lee start_date/end_date (YYYY-MM-DD) de la query. end_date es inclusivo.
+    Devuelve (desde, hasta_exclusivo); lanza ValueError si el formato es incorrecto."""
+    from datetime import timedelta
+    start = args.get('start_date')
+    end = args.get('end_date')
+    start_dt = datetime.strptime(start, '%Y-%m-%d') if start else None
+    end_dt = datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1) if end else None
+    return start_dt, end_dt
+
+def _encode_cursor(date, row_id):
+    """Cursor opaco para paginación por clave (fecha desc, id desc)."""
+    import base64
+    raw = f"{date.isoformat() if date else ''}|{row_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def _decode_cursor(cursor):
+    import base64
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+    date_str, row_id = raw.rsplit('|', 1)
+    return (datetime.fromisoformat(date_str) if date_str else None), int(row_id)
+
+def load_finished_sessions_page(team_id, limit=20, cursor=None, start_dt=None, end_dt=None):
+    """Historial de sesiones finalizadas con consultas por conjuntos.
+
+    1 consulta para la página de sesiones y 1 por cada tipo de dato relacionado
+    (asistencia, ejercicios del plan, ejecuciones, gamificación), todas con IN.
+    Devuelve (sesiones, next_cursor).
+    """
+    q = db.session.query(TrainingSession.id, TrainingSession.date, TrainingSession.plan_id, TrainingPlan.name) \
+        .outerjoin(TrainingPlan, TrainingPlan.id == TrainingSession.plan_id) \
+        .filter(TrainingSession.team_id == team_id, TrainingSession.status == 'finished')
+    if start_dt: q = q.filter(TrainingSession.date >= start_dt)
+    if end_dt: q = q.filter(TrainingSession.date < end_dt)
+    if cursor:
+        c_date, c_id = _decode_cursor(cursor)
+        q = q.filter(or_(TrainingSession.date < c_date, and_(TrainingSession.date == c_date, TrainingSession.id < c_id)))
+    rows = q.order_by(TrainingSession.date.desc(), TrainingSession.id.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not rows:
+        return [], None
+
+    session_ids = [r.id for r in rows]
+    plan_ids = {r.plan_id for r in rows if r.plan_id}
+
+    present = {}
+    for sid, pid, pname, pdorsal in db.session.query(SessionAttendance.session_id, Player.id, Player.name, Player.dorsal) \
+            .join(Player, Player.id == SessionAttendance.player_id) \
+            .filter(SessionAttendance.session_id.in_(session_ids), SessionAttendance.is_present == True).all():
+        present.setdefault(sid, []).append({'id': pid, 'name': pname, 'dorsal': pdorsal})
+
+    plan_items = {}
+    if plan_ids:
+        for it in db.session.query(TrainingItem.id, TrainingItem.training_plan_id, TrainingItem.drill_id,
+                                   TrainingItem.duration, Drill.title) \
+                .join(Drill, Drill.id == TrainingItem.drill_id) \
+                .filter(TrainingItem.training_plan_id.in_(plan_ids)) \
+                .order_by(TrainingItem.order, TrainingItem.id).all():
+            plan_items.setdefault(it.training_plan_id, []).append(it)
+
+    executions = {
+        (e.session_id, e.training_item_id): e for e in db.session.query(
+            SessionItemExecution.session_id, SessionItemExecution.training_item_id,
+            SessionItemExecution.was_completed, SessionItemExecution.actual_duration
+        ).filter(SessionItemExecution.session_id.in_(session_ids)).all()
+    }
+
+    gamification = {}
+    for sc in db.session.query(SessionScore.session_id, SessionScore.drill_id, SessionScore.raw_score,
+                               SessionScore.points, Player.name, Player.dorsal) \
+            .join(Player, Player.id == SessionScore.player_id) \
+            .filter(SessionScore.session_id.in_(session_ids)) \
+            .order_by(SessionScore.points.desc()).all():
+        gamification.setdefault((sc.session_id, sc.drill_id), []).append({
+            'player_name': sc.name,
+            'player_dorsal': sc.dorsal,
+            'raw_score': sc.raw_score,
+            'points': sc.points
+        })
+
+    result = []
+    for r in rows:
+        exercises = []
+        for item in plan_items.get(r.plan_id, []):
+            execution = executions.get((r.id, item.id))
+            exercises.append({
+                'id': item.id,
+                'title': item.title,
+                'planned_duration': item.duration,
+                'was_completed': execution.was_completed if execution else True,
+                'actual_duration': execution.actual_duration if execution else item.duration,
+                'gamification': gamification.get((r.id, item.drill_id), [])
+            })
+        result.append({
+            'id': r.id,
+            'date': r.date.isoformat() if r.date else None,
+            'plan_name': r.name,
+            'players_present': present.get(r.id, []),
+            'exercises': exercises
+        })
+    next_cursor = _encode_cursor(rows[-1].date, rows[-1].id) if has_more else None
+    return result, next_cursor
+
 @app.route('/api/get_finished_sessions')
 @login_required
 def api_get_finished_sessions():
+    """Historial paginado. Parámetros: team_id, limit (máx. 100), cursor, start_date, end_date."""
     team_id = request.args.get('team_id')
     team = Team.query.get_or_404(team_id)
     is_owner = (team.user_id == current_user.id)
     is_staff = TeamStaff.query.filter_by(team_id=team.id, email=current_user.email, status='accepted').first()
     if not is_owner and not is_staff: return jsonify({'error': 'Unauthorized'}), 403
     
-    sessions = TrainingSession.query.filter_by(team_id=team_id, status='finished').order_by(TrainingSession.date.desc()).all()
-    
-    result = []
-    for session in sessions:
-        # Jugadores presentes
-        players_present = [{'id': att.player.id, 'name': att.player.name, 'dorsal': att.player.dorsal} 
-                          for att in session.attendance if att.is_present]
-        
-        # Ejercicios del plan
-        exercises = []
-        if session.plan:
-            for item in session.plan.items:
-                # Buscar ejecución
-                execution = SessionItemExecution.query.filter_by(
-                    session_id=session.id,
-                    training_item_id=item.id
-                ).first()
-                
-                # Buscar gamificación
-                gamification = []
-                scores = SessionScore.query.filter_by(session_id=session.id, drill_id=item.drill_id).all()
-                if scores:
-                    # Ordenar por puntos (mejor a peor)
-                    sorted_scores = sorted(scores, key=lambda x: x.points, reverse=True)
-                    for score in sorted_scores:
-                        player = Player.query.get(score.player_id)
-                        if player:
-                            gamification.append({
-                                'player_name': player.name,
-                                'player_dorsal': player.dorsal,
-                                'raw_score': score.raw_score,
-                                'points': score.points
-                            })
-                
-                exercises.append({
-                    'id': item.id,
-                    'title': item.drill.title,
-                    'planned_duration': item.duration,
-                    'was_completed': execution.was_completed if execution else True,
-                    'actual_duration': execution.actual_duration if execution else item.duration,
-                    'gamification': gamification
-                })
-        
-        result.append({
-            'id': session.id,
-            'date': session.date.isoformat() if session.date else None,
-            'plan_name': session.plan.name if session.plan else None,
-            'players_present': players_present,
-            'exercises': exercises
-        })
+    limit = max(1, min(100, request.args.get('limit', 20, type=int)))
+    try:
+        start_dt, end_dt = _parse_date_range(request.args)
+        sessions, next_cursor = load_finished_sessions_page(
+            team.id, limit=limit, cursor=request.args.get('cursor'), start_dt=start_dt, end_dt=end_dt)
+    except ValueError:
+        return jsonify({'error': 'Parámetros inválidos'}), 400
     
-    return jsonify({'sessions': result})
+    return _cacheable_json({'sessions': sessions, 'next_cursor': next_cursor, 'has_more': next_cursor is not None})
 
 @app.route('/edit_session/<int:session_id>')
 @login_required
@@ -2498,10 +3451,17 @@ def edit_session(session_id):
             scores = SessionScore.query.filter_by(session_id=session.id, drill_id=item.drill_id).all()
             if scores:
                 gamifications[item.id] = sorted(scores, key=lambda x: x.points, reverse=True)
+    scorings = {conf.drill_id: {'strategy': conf.strategy, 'criteria': conf.criteria} for conf in session.drill_scorings}
+    for item_id, scores in gamifications.items():
+        drill_id = scores[0].drill_id
+        if drill_id not in scorings:
+            scorings[drill_id] = {'strategy': DEFAULT_SCORING_STRATEGY,
+                                  'criteria': _infer_scoring_criteria([(sc.raw_score, sc.points) for sc in scores])}
     
     return render_template('edit_session.html', session=session, plan=plan, 
                          attendance_map=attendance_map, executions=executions, 
-                         gamifications=gamifications)
+                         gamifications=gamifications, scorings=scorings,
+                         scoring_strategies=SCORING_STRATEGY_LABELS)
 
 @app.route('/api/recalculate_gamification', methods=['POST'])
 @login_required
@@ -2517,46 +3477,15 @@ def api_recalculate_gamification():
     is_staff = TeamStaff.query.filter_by(team_id=team.id, email=current_user.email, status='accepted').first()
     if not is_owner and not is_staff: return jsonify({'error': 'Unauthorized'}), 403
     
-    # Actualizar raw_scores
-    for score_data in scores_data:
-        score = SessionScore.query.get(score_data['score_id'])
-        if score and score.session_id == session_id and score.drill_id == drill_id:
-            score.raw_score = score_data['raw_score']
-    
-    db.session.flush()
-    
-    # Obtener criterio del ejercicio (por defecto "higher")
-    # Buscar en la primera gamificación guardada para este drill
-    first_score = SessionScore.query.filter_by(session_id=session_id, drill_id=drill_id).first()
-    criteria = 'higher'  # Por defecto, asumimos "mayor es mejor"
-    
-    # Recalcular puntos basándose en raw_scores
-    all_scores = SessionScore.query.filter_by(session_id=session_id, drill_id=drill_id).all()
-    raw_scores = [(s.player_id, s.raw_score) for s in all_scores if s.raw_score > 0]
-    
-    if criteria == 'higher':
-        raw_scores.sort(key=lambda x: x[1], reverse=True)
-    else:
-        raw_scores.sort(key=lambda x: x[1])
-    
-    # Asignar puntos
-    points_map = {}
-    for rank, (player_id, raw_score) in enumerate(raw_scores, 1):
-        if len(raw_scores) == 1:
-            points = 15
-        elif len(raw_scores) == 2:
-            points = 15 if rank == 1 else 14
-        else:
-            points = max(15 - (rank - 1), 1)
-        points_map[player_id] = points
-    
-    # Actualizar puntos
-    for score in all_scores:
-        if score.player_id in points_map:
-            score.points = points_map[score.player_id]
-    
+    try:
+        raw_updates = {int(sd['score_id']): float(sd['raw_score']) for sd in scores_data}
+        changed = recalculate_session_scores(session, drill_id, raw_updates,
+                                             data.get('strategy'), data.get('criteria'))
+    except (TypeError, ValueError, KeyError) as e:
+        db.session.rollback()
+        return jsonify({'error': str(e) or 'Datos inválidos'}), 400
     db.session.commit()
-    return jsonify({'status': 'ok'})
+    return jsonify({'status': 'ok', 'changed': changed})
 
 @app.route('/import_players/<int:id>', methods=['POST'])
 @login_required
@@ -2644,12 +3573,7 @@ def start_session():
     is_owner = (team.user_id == current_user.id)
     is_staff = TeamStaff.query.filter_by(team_id=team.id, email=current_user.email, status='accepted').first()
     if not is_owner and not is_staff: return "No autorizado", 403
-    new_session = TrainingSession(team_id=team_id, plan_id=plan_id, status='active')
-    db.session.add(new_session)
-    db.session.commit()
-    for p in team.players:
-        att = SessionAttendance(session_id=new_session.id, player_id=p.id, is_present=True)
-        db.session.add(att)
+    new_session = open_training_session(team, plan_id)
     db.session.commit()
     return redirect(url_for('session_tracker', id=new_session.id))
 
@@ -2663,7 +3587,8 @@ def session_tracker(id):
     if not is_owner and not is_staff: return redirect('/')
     plan = TrainingPlan.query.get(session.plan_id) if session.plan_id else None
     attendance_map = {att.player_id: att.is_present for att in session.attendance}
-    return render_template('session_tracker.html', session=session, plan=plan, attendance_map=attendance_map)
+    return render_template('session_tracker.html', session=session, plan=plan, attendance_map=attendance_map,
+                           scoring_strategies=SCORING_STRATEGY_LABELS)
 
 @app.route('/api/save_attendance', methods=['POST'])
 @login_required
@@ -2672,9 +3597,12 @@ def api_save_attendance():
     session_id = data.get('session_id')
     player_id = data.get('player_id')
     is_present = data.get('is_present')
+    session = TrainingSession.query.get_or_404(session_id)
+    if not _can_edit_team(session.team): return jsonify({'error': 'Unauthorized'}), 403
     att = SessionAttendance.query.filter_by(session_id=session_id, player_id=player_id).first()
     if att:
         att.is_present = is_present
+        refresh_session_load(session)
         db.session.commit()
         return jsonify({'status': 'ok'})
     return jsonify({'error': 'Not found'}), 404
@@ -2684,26 +3612,222 @@ def api_save_attendance():
 def api_save_gamification():
     data = request.json
     session_id = data.get('session_id')
-    drill_id = data.get('drill_id')
-    results = data.get('results')
-    criteria = data.get('criteria')
-    reverse_sort = (criteria == 'high')
-    sorted_results = sorted(results, key=lambda x: float(x['raw_score']), reverse=reverse_sort)
-    points_map = {}
-    current_points = 15
-    for res in sorted_results:
-        points_map[res['player_id']] = max(1, current_points)
-        current_points -= 1
-    SessionScore.query.filter_by(session_id=session_id, drill_id=drill_id).delete()
-    for res in results:
-        pid = res['player_id']
-        raw = res['raw_score']
-        pts = points_map.get(pid, 0)
-        new_score = SessionScore(session_id=session_id, drill_id=drill_id, player_id=pid, raw_score=raw, points=pts)
-        db.session.add(new_score)
+    session = TrainingSession.query.get_or_404(session_id)
+    if not _can_edit_team(session.team): return jsonify({'error': 'Unauthorized'}), 403
+    try:
+        save_session_scores(session, data.get('drill_id'), data.get('results'), data.get('criteria'), data.get('strategy'))
+    except (TypeError, ValueError, KeyError) as e:
+        db.session.rollback()
+        return jsonify({'error': str(e) or 'Datos inválidos'}), 400
     db.session.commit()
     return jsonify({'status': 'ok'})
 
+def _week_start(dt):
+    """Lunes (date) de la semana ISO de una fecha."""
+    d = dt.date() if isinstance(dt, datetime) else dt
+    return d - timedelta(days=d.weekday())
+
+def _rebuild_session_rows(session_ids):
+    SessionPlayerPoints.query.filter(SessionPlayerPoints.session_id.in_(session_ids)).delete(synchronize_session=False)
+    totals = select(
+        SessionScore.session_id, SessionScore.player_id,
+        func.coalesce(func.sum(SessionScore.points), 0), func.count(SessionScore.id)
+    ).where(SessionScore.session_id.in_(session_ids)).group_by(SessionScore.session_id, SessionScore.player_id)
+    db.session.execute(insert(SessionPlayerPoints).from_select(
+        ['session_id', 'player_id', 'total_points', 'drills_scored'], totals))
+    _bump_scores_version(session_ids)
+
+def rebuild_session_points(session_ids):
+    """Recalcula desde SessionScore el marcador materializado de las sesiones indicadas
+    (un DELETE y un INSERT ... SELECT con GROUP BY), sube su versión y rehace sus semanas. No hace commit."""
+    session_ids = list(session_ids)
+    if not session_ids:
+        return
+    _rebuild_session_rows(session_ids)
+    weeks = {(team_id, _week_start(date)) for team_id, date in db.session.query(
+        TrainingSession.team_id, TrainingSession.date).filter(TrainingSession.id.in_(session_ids)).all() if date}
+    rebuild_weekly_points(weeks)
+
+def rebuild_weekly_points(weeks):
+    """Rehace el acumulado semanal de cada (team_id, lunes) a partir del marcador de sus sesiones,
+    materializando antes las sesiones de esa semana que aún no lo estén. No hace commit."""
+    bump_team_data({team_id for team_id, _ in weeks})
+    for team_id, week_start in weeks:
+        begin = datetime.combine(week_start, datetime.min.time())
+        in_week = db.session.query(TrainingSession.id, TrainingSession.scores_version).filter(
+            TrainingSession.team_id == team_id, TrainingSession.date >= begin,
+            TrainingSession.date < begin + timedelta(days=7)).all()
+        legacy = [sid for sid, version in in_week if not version]
+        if legacy:
+            _rebuild_session_rows(legacy)
+        TeamWeeklyPoints.query.filter_by(team_id=team_id, week_start=week_start).delete(synchronize_session=False)
+        if not in_week:
+            continue
+        rows = db.session.query(SessionPlayerPoints.player_id, func.sum(SessionPlayerPoints.total_points),
+                                func.count(SessionPlayerPoints.id)) \
+            .filter(SessionPlayerPoints.session_id.in_([sid for sid, _ in in_week]), SessionPlayerPoints.drills_scored > 0) \
+            .group_by(SessionPlayerPoints.player_id).all()
+        if rows:
+            db.session.execute(insert(TeamWeeklyPoints), [
+                {'team_id': team_id, 'player_id': pid, 'week_start': week_start,
+                 'total_points': int(total or 0), 'sessions': n} for pid, total, n in rows])
+
+def _bump_scores_version(session_ids):
+    t = TrainingSession.__table__
+    db.session.execute(t.update().where(t.c.id.in_(session_ids)).values(scores_version=t.c.scores_version + 1))
+    for obj in list(db.session.identity_map.values()):
+        if isinstance(obj, TrainingSession) and obj.id in session_ids:
+            db.session.expire(obj, ['scores_version'])
+
+def apply_session_points_delta(session, deltas):
+    """Aplica al marcador de la sesión y a su semana los cambios {player_id: (delta_puntos, delta_ejercicios)}:
+    un UPDATE ... CASE para los jugadores que ya tienen fila y un INSERT para el resto.
+    Las sesiones aún sin materializar se reconstruyen enteras. No hace commit."""
+    if not session.scores_version:
+        db.session.flush()
+        rebuild_session_points([session.id])
+        return
+    t = SessionPlayerPoints.__table__
+    have = dict(db.session.query(SessionPlayerPoints.player_id, SessionPlayerPoints.drills_scored)
+                .filter(SessionPlayerPoints.session_id == session.id,
+                        SessionPlayerPoints.player_id.in_(list(deltas))).all())
+    known = {pid: d for pid, d in deltas.items() if pid in have}
+    if known:
+        db.session.execute(
+            t.update()
+            .where(t.c.session_id == session.id, t.c.player_id.in_(list(known)))
+            .values(total_points=t.c.total_points + case({pid: d[0] for pid, d in known.items()}, value=t.c.player_id),
+                    drills_scored=t.c.drills_scored + case({pid: d[1] for pid, d in known.items()}, value=t.c.player_id))
+        )
+    rows = [{'session_id': session.id, 'player_id': pid, 'total_points': d[0], 'drills_scored': d[1]}
+            for pid, d in deltas.items() if pid not in have]
+    if rows:
+        db.session.execute(insert(SessionPlayerPoints), rows)
+    _bump_scores_version([session.id])
+
+    # Semana de la sesión: los puntos suman igual; la sesión cuenta cuando el jugador pasa de 0 a >0 ejercicios
+    weekly = {}
+    for pid, (dpoints, ddrills) in deltas.items():
+        before = have.get(pid, 0) or 0
+        after = before + ddrills
+        dsessions = (1 if after > 0 else 0) - (1 if before > 0 else 0)
+        if dpoints or dsessions:
+            weekly[pid] = (dpoints, dsessions)
+    if weekly and session.date:
+        _apply_weekly_points_delta(session.team_id, _week_start(session.date), weekly)
+
+def _apply_weekly_points_delta(team_id, week_start, deltas):
+    bump_team_data([team_id])
+    t = TeamWeeklyPoints.__table__
+    have = {pid for (pid,) in db.session.query(TeamWeeklyPoints.player_id).filter(
+        TeamWeeklyPoints.team_id == team_id, TeamWeeklyPoints.week_start == week_start,
+        TeamWeeklyPoints.player_id.in_(list(deltas))).all()}
+    known = {pid: d for pid, d in deltas.items() if pid in have}
+    if known:
+        db.session.execute(
+            t.update()
+            .where(t.c.team_id == team_id, t.c.week_start == week_start, t.c.player_id.in_(list(known)))
+            .values(total_points=t.c.total_points + case({pid: d[0] for pid, d in known.items()}, value=t.c.player_id),
+                    sessions=t.c.sessions + case({pid: d[1] for pid, d in known.items()}, value=t.c.player_id))
+        )
+    rows = [{'team_id': team_id, 'player_id': pid, 'week_start': week_start, 'total_points': d[0], 'sessions': d[1]}
+            for pid, d in deltas.items() if pid not in have]
+    if rows:
+        db.session.execute(insert(TeamWeeklyPoints), rows)
+
+def _drill_scoring(session_id, drill_id, strategy=None, criteria=None, default_criteria='high'):
+    """Devuelve (y crea o actualiza si se indican) la estrategia y el criterio guardados del ejercicio."""
+    conf = SessionDrillScoring.query.filter_by(session_id=session_id, drill_id=drill_id).first()
+    if strategy is not None and strategy not in SCORING_STRATEGIES:
+        raise ValueError(f'Estrategia de puntuación desconocida: {strategy}')
+    if not conf:
+        conf = SessionDrillScoring(session_id=session_id, drill_id=drill_id,
+                                   strategy=strategy or DEFAULT_SCORING_STRATEGY,
+                                   criteria=normalize_criteria(criteria or default_criteria))
+        db.session.add(conf)
+    else:
+        if strategy is not None:
+            conf.strategy = strategy
+        if criteria is not None:
+            conf.criteria = normalize_criteria(criteria)
+    return conf
+
+def _infer_scoring_criteria(raw_points):
+    """Ejercicios puntuados antes de guardar el criterio: si el mejor resultado bruto tiene
+    menos puntos que el peor, se puntuó con 'low'. raw_points = [(raw, points), ...]."""
+    if not raw_points:
+        return 'high'
+    best, worst = max(raw_points), min(raw_points)
+    return 'low' if best[0] != worst[0] and best[1] < worst[1] else 'high'
+
+def _write_drill_scores(session, drill_id, existing, raw_map, conf):
+    """Puntúa raw_map {player_id: raw} en una pasada y escribe solo las diferencias con existing
+    ({player_id: (score_id, raw, points)}): UPDATE por lotes de filas cambiadas, INSERT de nuevas
+    y DELETE de las que ya no tienen resultado. Propaga los cambios al marcador de la sesión."""
+    points = compute_points(raw_map, conf.strategy, conf.criteria)
+    updates, inserts = [], []
+    deltas = {}  # player_id -> (delta de puntos, delta de ejercicios puntuados)
+    for pid, raw in raw_map.items():
+        pts = points.get(pid, 0)
+        if pid in existing:
+            score_id, old_raw, old_pts = existing[pid]
+            if old_raw != raw or old_pts != pts:
+                updates.append({'id': score_id, 'raw_score': raw, 'points': pts})
+                if old_pts != pts:
+                    deltas[pid] = (pts - (old_pts or 0), 0)
+        else:
+            inserts.append({'session_id': session.id, 'drill_id': drill_id, 'player_id': pid,
+                            'raw_score': raw, 'points': pts})
+            deltas[pid] = (pts, 1)
+    gone = []
+    for pid, (score_id, _, old_pts) in existing.items():
+        if pid not in raw_map:
+            gone.append(score_id)
+            deltas[pid] = (-(old_pts or 0), -1)
+    if updates:
+        db.session.execute(update(SessionScore), updates)
+    if inserts:
+        db.session.execute(insert(SessionScore), inserts)
+    if gone:
+        SessionScore.query.filter(SessionScore.id.in_(gone)).delete(synchronize_session=False)
+    if deltas:
+        apply_session_points_delta(session, deltas)
+    return len(updates) + len(inserts) + len(gone)
+
+def _existing_drill_scores(session_id, drill_id):
+    return {pid: (sid, raw, pts) for sid, pid, raw, pts in db.session.query(
+        SessionScore.id, SessionScore.player_id, SessionScore.raw_score, SessionScore.points
+    ).filter_by(session_id=session_id, drill_id=drill_id).all()}
+
+def save_session_scores(session, drill_id, results, criteria, strategy=None):
+    """Guarda los resultados de un ejercicio en la sesión y los puntúa con el motor de scoring.py.
+    No hace commit. Valida resultados y jugadores antes de escribir; lanza ValueError si algo no cuadra."""
+    drill_id = int(drill_id)
+    if not isinstance(results, list):
+        raise ValueError('results debe ser una lista')
+    raw_map = {int(res['player_id']): float(res['raw_score']) for res in results}
+    roster = {pid for (pid,) in db.session.query(Player.id).filter_by(team_id=session.team_id).all()}
+    unknown = [pid for pid in raw_map if pid not in roster]
+    if unknown:
+        raise ValueError(f'El jugador {unknown[0]} no pertenece al equipo')
+    conf = _drill_scoring(session.id, drill_id, strategy, criteria)
+    return _write_drill_scores(session, drill_id, _existing_drill_scores(session.id, drill_id), raw_map, conf)
+
+def recalculate_session_scores(session, drill_id, raw_updates=None, strategy=None, criteria=None):
+    """Recalcula los puntos de un ejercicio con la estrategia guardada (o la indicada), aplicando antes
+    los cambios de resultado {score_id: raw}. Solo actualiza las filas cuyo valor cambia. No hace commit."""
+    drill_id = int(drill_id)
+    existing = _existing_drill_scores(session.id, drill_id)
+    by_id = {sid: pid for pid, (sid, _, _) in existing.items()}
+    raw_map = {pid: raw for pid, (_, raw, _) in existing.items()}
+    for score_id, raw in (raw_updates or {}).items():
+        pid = by_id.get(int(score_id))
+        if pid is not None:
+            raw_map[pid] = float(raw)
+    inferred = _infer_scoring_criteria([(raw, pts) for _, raw, pts in existing.values()])
+    conf = _drill_scoring(session.id, drill_id, strategy, criteria, default_criteria=inferred)
+    return _write_drill_scores(session, drill_id, existing, raw_map, conf)
+
 @app.route('/api/add_late_player', methods=['POST'])
 @login_required
 def api_add_late_player():
@@ -2713,14 +3837,200 @@ def api_add_late_player():
     dorsal = data.get('dorsal')
     session = TrainingSession.query.get(session_id)
     if not session: return jsonify({'error': 'No session'}), 404
+    if not _can_edit_team(session.team): return jsonify({'error': 'Unauthorized'}), 403
     new_player = Player(name=name, dorsal=int(dorsal), team_id=session.team_id)
     db.session.add(new_player)
-    db.session.commit()
+    db.session.flush()
     att = SessionAttendance(session_id=session.id, player_id=new_player.id, is_present=True)
     db.session.add(att)
+    refresh_session_load(session)
     db.session.commit()
     return jsonify({'status': 'ok'})
 
+def apply_session_attendance(session, attendance, new_players=()):
+    """Aplica un mapa completo {player_id: is_present} y altas de jugadores en la sesión.
+
+    No hace commit. Usa una consulta para la plantilla y otra para la asistencia actual,
+    un único UPDATE ... CASE para los cambios y un INSERT multi-fila para las filas nuevas.
+    Lanza ValueError, antes de escribir nada, si algún jugador no pertenece al equipo de la sesión.
+    """
+    roster = {pid for (pid,) in db.session.query(Player.id).filter_by(team_id=session.team_id).all()}
+    wanted = {}
+    for pid, present in attendance.items():
+        pid = int(pid)
+        if pid not in roster:
+            raise ValueError(f'El jugador {pid} no pertenece al equipo')
+        wanted[pid] = bool(present)
+    created = []
+    for np in new_players:
+        name = (np.get('name') or '').strip()[:100]
+        if not name:
+            raise ValueError('Nombre de jugador vacío')
+        created.append((Player(name=name, dorsal=int(np.get('dorsal')), team_id=session.team_id),
+                        np.get('is_present', True)))
+    current = dict(db.session.query(SessionAttendance.player_id, SessionAttendance.is_present)
+                   .filter_by(session_id=session.id).all())
+    changed = {pid: present for pid, present in wanted.items() if pid in current and bool(current[pid]) != present}
+    if changed:
+        t = SessionAttendance.__table__
+        db.session.execute(
+            t.update()
+            .where(t.c.session_id == session.id, t.c.player_id.in_(changed))
+            .values(is_present=case(changed, value=t.c.player_id))
+        )
+    rows = [{'session_id': session.id, 'player_id': pid, 'is_present': present}
+            for pid, present in wanted.items() if pid not in current]
+    if created:
+        db.session.add_all([p for p, _ in created])
+        db.session.flush()
+        rows.extend({'session_id': session.id, 'player_id': p.id, 'is_present': bool(present)} for p, present in created)
+    if rows:
+        db.session.execute(insert(SessionAttendance), rows)
+    return [p.id for p, _ in created]
+
+@app.route('/api/session/<int:session_id>/attendance', methods=['POST'])
+@login_required
+def api_session_attendance_bulk(session_id):
+    """Guarda la asistencia completa de una sesión en una sola transacción.
+
+    Body: {attendance: {player_id: bool, ...}, new_players: [{name, dorsal, is_present?}, ...]}
+    """
+    session = TrainingSession.query.get_or_404(session_id)
+    if not _can_edit_team(session.team): return jsonify({'error': 'Unauthorized'}), 403
+    data = request.get_json() or {}
+    attendance = data.get('attendance') or {}
+    new_players = data.get('new_players') or []
+    if not isinstance(attendance, dict) or not isinstance(new_players, list):
+        return jsonify({'error': 'Formato inválido'}), 400
+    try:
+        new_ids = apply_session_attendance(session, attendance, new_players)
+    except (TypeError, ValueError) as e:
+        db.session.rollback()
+        return jsonify({'error': str(e) or 'Datos inválidos'}), 400
+    refresh_session_load(session)
+    db.session.commit()
+    present = dict(db.session.query(SessionAttendance.player_id, SessionAttendance.is_present)
+                   .filter_by(session_id=session.id).all())
+    return jsonify({'status': 'ok', 'new_player_ids': new_ids,
+                    'attendance': {str(pid): bool(v) for pid, v in present.items()}})
+
+# --- DIARIO OFFLINE DE SESIÓN (SINCRONIZACIÓN IDEMPOTENTE) ---
+
+SESSION_SYNC_MAX_OPS = 200
+
+def _sync_op_execution(session, data):
+    save_exercise_execution(session, data['training_item_id'], data.get('was_completed', True), data.get('actual_duration'))
+
+def _sync_op_gamification(session, data):
+    save_session_scores(session, data['drill_id'], data['results'], data.get('criteria'), data.get('strategy'))
+
+def _sync_op_attendance(session, data):
+    attendance = data.get('attendance') or {}
+    new_players = data.get('new_players') or []
+    if not isinstance(attendance, dict) or not isinstance(new_players, list):
+        raise ValueError('Formato de asistencia inválido')
+    apply_session_attendance(session, attendance, new_players)
+
+def _sync_op_finish(session, data):
+    session.status = 'finished'
+
+def _sync_op_rpe(session, data):
+    apply_session_rpe(session, data.get('rpe') or {})
+
+# Tipo de operación -> función que la aplica (valida antes de escribir y no hace commit)
+SESSION_SYNC_OPS = {
+    'execution': _sync_op_execution,
+    'gamification': _sync_op_gamification,
+    'attendance': _sync_op_attendance,
+    'finish': _sync_op_finish,
+    'rpe': _sync_op_rpe,
+}
+
+def session_sync_state(session):
+    """Estado autoritativo de la sesión para el cliente: plantilla con asistencia, ejecuciones y puntuaciones."""
+    attendance = dict(db.session.query(SessionAttendance.player_id, SessionAttendance.is_present)
+                      .filter_by(session_id=session.id).all())
+    players = [{'id': p.id, 'name': p.name, 'dorsal': p.dorsal, 'photo': p.photo_file,
+                'is_present': bool(attendance.get(p.id, False))}
+               for p in Player.query.filter_by(team_id=session.team_id).order_by(Player.dorsal).all()]
+    executions = {str(item_id): {'was_completed': bool(done), 'actual_duration': dur}
+                  for item_id, done, dur in db.session.query(
+                      SessionItemExecution.training_item_id, SessionItemExecution.was_completed,
+                      SessionItemExecution.actual_duration).filter_by(session_id=session.id).all()}
+    scores = {}
+    for drill_id, pid, raw, pts in db.session.query(
+            SessionScore.drill_id, SessionScore.player_id, SessionScore.raw_score, SessionScore.points
+    ).filter_by(session_id=session.id).all():
+        scores.setdefault(str(drill_id), {})[str(pid)] = {'raw_score': raw, 'points': pts}
+    return {'session_id': session.id, 'status': session.status, 'players': players,
+            'executions': executions, 'scores': scores}
+
+@app.route('/api/session/<int:session_id>/sync', methods=['POST'])
+@login_required
+def api_session_sync(session_id):
+    """Aplica, exactamente una vez y en orden, un lote de operaciones del diario offline.
+
+    Body: {ops: [{key, type, data}, ...]} con type en SESSION_SYNC_OPS y key única generada por el cliente.
+    Las claves ya procesadas se confirman sin volver a aplicarse; las operaciones inválidas se
+    rechazan (y se registran) para que el cliente las descarte. Todo en una sola transacción.
+    """
+    session = TrainingSession.query.get_or_404(session_id)
+    if not _can_edit_team(session.team): return jsonify({'error': 'Unauthorized'}), 403
+    ops = (request.get_json(silent=True) or {}).get('ops') or []
+    if not isinstance(ops, list):
+        return jsonify({'error': 'ops debe ser una lista'}), 400
+    if len(ops) > SESSION_SYNC_MAX_OPS:
+        return jsonify({'error': f'Máximo {SESSION_SYNC_MAX_OPS} operaciones por lote'}), 400
+    keys = []
+    for op in ops:
+        key = op.get('key') if isinstance(op, dict) else None
+        if not isinstance(key, str) or not key or len(key) > 64:
+            return jsonify({'error': 'Cada operación necesita una key (máx. 64 caracteres)'}), 400
+        keys.append(key)
+
+    done = {}
+    if keys:
+        done = {k: (st, err) for k, st, err in db.session.query(
+            SessionSyncOp.op_key, SessionSyncOp.status, SessionSyncOp.error
+        ).filter(SessionSyncOp.session_id == session.id, SessionSyncOp.op_key.in_(set(keys))).all()}
+
+    acked, rejected = [], []
+    for op, key in zip(ops, keys):
+        if key in done:
+            st, err = done[key]
+            if st == 'rejected':
+                rejected.append({'key': key, 'error': err})
+            else:
+                acked.append(key)
+            continue
+        op_type = op.get('type')
+        handler = SESSION_SYNC_OPS.get(op_type)
+        error = None
+        if not handler:
+            error = f'Tipo de operación desconocido: {op_type}'
+        else:
+            try:
+                handler(session, op.get('data') or {})
+            except (TypeError, ValueError, KeyError, AttributeError) as e:
+                error = (str(e) or 'Datos inválidos')[:255]
+        db.session.add(SessionSyncOp(session_id=session.id, op_key=key, op_type=str(op_type)[:20],
+                                     status='rejected' if error else 'applied', error=error))
+        done[key] = ('rejected' if error else 'applied', error)
+        if error:
+            rejected.append({'key': key, 'error': error})
+        else:
+            acked.append(key)
+    # Ejecuciones, asistencia, RPE y cierre cambian la carga del día de la sesión
+    if any(done[k][0] == 'applied' and op.get('type') != 'gamification' for op, k in zip(ops, keys)):
+        refresh_session_load(session)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Otro envío concurrente del mismo diario ganó la carrera: el cliente reintentará
+        db.session.rollback()
+        return jsonify({'error': 'Sincronización concurrente, reintenta'}), 409
+    return jsonify({'status': 'ok', 'acked': acked, 'rejected': rejected, 'state': session_sync_state(session)})
+
 @app.route('/api/get_session_players')
 @login_required
 def api_get_session_players():
@@ -2765,39 +4075,452 @@ def api_get_session_ranking():
     is_staff = TeamStaff.query.filter_by(team_id=team.id, email=current_user.email, status='accepted').first()
     if not is_owner and not is_staff: return jsonify({'error': 'Unauthorized'}), 403
     
-    # Calcular puntos totales por jugador en esta sesión
-    scores = db.session.query(
-        SessionScore.player_id,
-        func.sum(SessionScore.points).label('total_points')
-    ).filter(SessionScore.session_id == session_id).group_by(SessionScore.player_id).all()
-    
-    ranking = []
-    for pid, total in scores:
-        player = Player.query.get(pid)
-        if player:
-            ranking.append({
-                'id': player.id,
-                'name': player.name,
-                'dorsal': player.dorsal,
-                'photo': player.photo_file,
-                'total_points': int(total) if total else 0
-            })
-    
-    ranking.sort(key=lambda x: x['total_points'], reverse=True)
-    
-    # Limitar a top X
-    visible_ranking = ranking[:top_x]
-    
-    return jsonify({'ranking': visible_ranking})
+    # Sesiones anteriores al marcador materializado: se materializan en la primera lectura
+    if not session.scores_version:
+        rebuild_session_points([session.id])
+        db.session.commit()
+    version = session.scores_version
+    etag = f'W/"ranking-{session.id}-{version}-{top_x}"'
+    if request.headers.get('If-None-Match') == etag:
+        return '', 304, {'ETag': etag}
+    
+    # Una sola lectura por rango del marcador materializado, unida con los jugadores
+    rows = db.session.query(Player.id, Player.name, Player.dorsal, Player.photo_file, SessionPlayerPoints.total_points) \
+        .join(SessionPlayerPoints, SessionPlayerPoints.player_id == Player.id) \
+        .filter(SessionPlayerPoints.session_id == session.id, SessionPlayerPoints.drills_scored > 0) \
+        .order_by(SessionPlayerPoints.total_points.desc(), Player.name) \
+        .limit(top_x).all()
+    visible_ranking = [{'id': pid, 'name': name, 'dorsal': dorsal, 'photo': photo, 'total_points': total or 0}
+                       for pid, name, dorsal, photo, total in rows]
+    
+    response = jsonify({'ranking': visible_ranking, 'version': version})
+    response.headers['ETag'] = etag
+    return response
+
+# --- RANKING DE ENTRENAMIENTOS (TEMPORADA, MES, ÚLTIMAS SESIONES) ---
+
+SEASON_START_MONTH = 9  # La temporada empieza en septiembre
+TRAINING_LEADERBOARD_WINDOWS = {
+    'season': 'Temporada',
+    'month': 'Este mes',
+    'last': 'Últimas sesiones',
+}
+
+def season_start(now=None):
+    now = now or datetime.utcnow()
+    year = now.year if now.month >= SEASON_START_MONTH else now.year - 1
+    return datetime(year, SEASON_START_MONTH, 1)
+
+def _materialize_team_points(team_id):
+    """Materializa (una sola vez) las sesiones del equipo anteriores al marcador persistente."""
+    legacy = [sid for (sid,) in db.session.query(TrainingSession.id).filter_by(team_id=team_id, scores_version=0).all()]
+    if legacy:
+        rebuild_session_points(legacy)
+        db.session.commit()
+
+def training_leaderboard(team_id, window='season', last_n=10, limit=None):
+    """Ranking acumulado de puntos de entrenamiento del equipo.
+
+    window='season'/'month': semanas completas desde TeamWeeklyPoints y, para la semana partida del
+    inicio, el marcador de esas sesiones. window='last': marcador de las últimas last_n sesiones.
+    Cada consulta agrega con GROUP BY, así que se devuelven O(jugadores) filas.
+    """
+    totals = {}
+    def add(rows):
+        for pid, pts, n in rows:
+            t = totals.setdefault(pid, [0, 0])
+            t[0] += int(pts or 0)
+            t[1] += int(n or 0)
+
+    def add_sessions(session_ids):
+        if session_ids:
+            add(db.session.query(SessionPlayerPoints.player_id, func.sum(SessionPlayerPoints.total_points),
+                                 func.count(SessionPlayerPoints.id))
+                .filter(SessionPlayerPoints.session_id.in_(session_ids), SessionPlayerPoints.drills_scored > 0)
+                .group_by(SessionPlayerPoints.player_id).all())
+
+    _materialize_team_points(team_id)
+    if window == 'last':
+        add_sessions([sid for (sid,) in db.session.query(TrainingSession.id).filter_by(team_id=team_id)
+                      .order_by(TrainingSession.date.desc(), TrainingSession.id.desc()).limit(last_n).all()])
+    else:
+        now = datetime.utcnow()
+        start = season_start(now) if window == 'season' else datetime(now.year, now.month, 1)
+        first_full = _week_start(start)
+        if first_full < start.date():
+            first_full += timedelta(days=7)
+        add(db.session.query(TeamWeeklyPoints.player_id, func.sum(TeamWeeklyPoints.total_points),
+                             func.sum(TeamWeeklyPoints.sessions))
+            .filter(TeamWeeklyPoints.team_id == team_id, TeamWeeklyPoints.week_start >= first_full)
+            .group_by(TeamWeeklyPoints.player_id).all())
+        add_sessions([sid for (sid,) in db.session.query(TrainingSession.id).filter(
+            TrainingSession.team_id == team_id, TrainingSession.date >= start,
+            TrainingSession.date < datetime.combine(first_full, datetime.min.time())).all()])
+
+    players = {p.id: p for p in Player.query.filter(Player.team_id == team_id, Player.id.in_(list(totals))).all()} if totals else {}
+    ranking = [{'id': pid, 'name': players[pid].name, 'dorsal': players[pid].dorsal, 'photo': players[pid].photo_file,
+                'points': pts, 'sessions': n}
+               for pid, (pts, n) in totals.items() if pid in players and n > 0]
+    ranking.sort(key=lambda r: (-r['points'], r['name']))
+    return ranking[:limit] if limit else ranking
+
+@app.route('/api/team/<int:id>/training_leaderboard')
+def api_training_leaderboard(id):
+    """Ranking de entrenamientos: ?window=season|month|last&n=10&limit=20.
+    Público si el portal del equipo muestra estadísticas; si no, solo para owner/staff."""
+    team = Team.query.get_or_404(id)
+    is_staff = current_user.is_authenticated and _can_edit_team(team)
+    if not team.analytics_visible and not is_staff:
+        return jsonify({'error': 'Unauthorized'}), 403
+    window = request.args.get('window', 'season')
+    if window not in TRAINING_LEADERBOARD_WINDOWS:
+        return jsonify({'error': 'window debe ser season, month o last'}), 400
+    try:
+        last_n = min(max(int(request.args.get('n', 10)), 1), 100)
+        limit = int(request.args['limit']) if request.args.get('limit') else None
+    except ValueError:
+        return jsonify({'error': 'n y limit deben ser enteros'}), 400
+    if not is_staff:
+        # Fuera del staff se ve lo mismo que en el portal: solo los primeros analytics_players_count
+        cap = team.analytics_players_count or 5
+        limit = min(limit, cap) if limit and limit > 0 else cap
+    ranking = training_leaderboard(team.id, window, last_n, limit)
+    return jsonify({'window': window, 'ranking': ranking})
+
+# --- CARGA DE ENTRENAMIENTO (AGUDA:CRÓNICA) ---
+
+ACUTE_LOAD_DAYS = 7
+CHRONIC_LOAD_DAYS = 28
+
+def refresh_training_load(team_id, day):
+    """Recalcula PlayerDailyLoad del equipo para un día a partir de sus sesiones.
+
+    Minutos de la sesión: ejecuciones realizadas (actual_duration o, si falta, la duración planificada).
+    Las sesiones finalizadas sin ninguna ejecución registrada cuentan la duración total del plan.
+    Cada jugador presente suma esos minutos y, como carga, minutos × RPE (o minutos si no hay RPE).
+    Solo toca las filas de ese día. No hace commit.
+    """
+    if day is None:
+        return
+    if isinstance(day, datetime):
+        day = day.date()
+    begin = datetime.combine(day, datetime.min.time())
+    sessions = db.session.query(TrainingSession.id, TrainingSession.status, TrainingSession.plan_id).filter(
+        TrainingSession.team_id == team_id, TrainingSession.date >= begin,
+        TrainingSession.date < begin + timedelta(days=1)).all()
+    ids = [sid for sid, _, _ in sessions]
+    minutes = {}
+    if ids:
+        executed = db.session.query(
+            SessionItemExecution.session_id, func.count(SessionItemExecution.id),
+            func.sum(case((SessionItemExecution.was_completed == True,
+                           func.coalesce(SessionItemExecution.actual_duration, TrainingItem.duration)), else_=0))
+        ).outerjoin(TrainingItem, TrainingItem.id == SessionItemExecution.training_item_id) \
+            .filter(SessionItemExecution.session_id.in_(ids)).group_by(SessionItemExecution.session_id).all()
+        minutes = {sid: int(total or 0) for sid, n, total in executed if n}
+        fallback = {sid: plan_id for sid, status, plan_id in sessions
+                    if sid not in minutes and status == 'finished' and plan_id}
+        if fallback:
+            planned = dict(db.session.query(TrainingItem.training_plan_id, func.sum(TrainingItem.duration))
+                           .filter(TrainingItem.training_plan_id.in_(set(fallback.values())))
+                           .group_by(TrainingItem.training_plan_id).all())
+            minutes.update({sid: int(planned.get(plan_id) or 0) for sid, plan_id in fallback.items()})
+    per_player = {}
+    if minutes:
+        for sid, pid, rpe in db.session.query(SessionAttendance.session_id, SessionAttendance.player_id,
+                                              SessionAttendance.rpe).filter(
+                SessionAttendance.session_id.in_(list(minutes)), SessionAttendance.is_present == True).all():
+            mins = minutes[sid]
+            if mins <= 0:
+                continue
+            acc = per_player.setdefault(pid, [0, 0.0])
+            acc[0] += mins
+            acc[1] += mins * (rpe if rpe is not None else 1)
+    PlayerDailyLoad.query.filter_by(team_id=team_id, day=day).delete(synchronize_session=False)
+    if per_player:
+        db.session.execute(insert(PlayerDailyLoad), [
+            {'team_id': team_id, 'player_id': pid, 'day': day, 'minutes': m, 'load': load}
+            for pid, (m, load) in per_player.items()])
+
+def refresh_session_load(session):
+    refresh_training_load(session.team_id, session.date)
+
+def _ensure_training_load(team):
+    """Acumula una sola vez el histórico del equipo (días con sesiones anteriores a PlayerDailyLoad)."""
+    if team.training_load_ready:
+        return
+    days = {d.date() for (d,) in db.session.query(TrainingSession.date).filter_by(team_id=team.id).all() if d}
+    for day in sorted(days):
+        refresh_training_load(team.id, day)
+    team.training_load_ready = True
+    db.session.commit()
+
+def team_training_load(team, start, end):
+    """Series diarias por jugador entre start y end (date, inclusivos): carga, aguda (suma 7 días),
+    crónica (media semanal de 28 días) y ratio aguda:crónica. Una sola lectura de PlayerDailyLoad
+    desde start - 27 días y ventanas deslizantes en memoria: O(jugadores × días)."""
+    _ensure_training_load(team)
+    read_from = start - timedelta(days=CHRONIC_LOAD_DAYS - 1)
+    daily = {}
+    minutes = {}
+    for pid, day, mins, load in db.session.query(PlayerDailyLoad.player_id, PlayerDailyLoad.day,
+                                                 PlayerDailyLoad.minutes, PlayerDailyLoad.load).filter(
+            PlayerDailyLoad.team_id == team.id, PlayerDailyLoad.day >= read_from, PlayerDailyLoad.day <= end).all():
+        daily.setdefault(pid, {})[day] = load
+        minutes.setdefault(pid, {})[day] = mins
+    n_days = (end - start).days + 1
+    dates = [start + timedelta(days=i) for i in range(n_days)]
+    players = []
+    for p in Player.query.filter_by(team_id=team.id).order_by(Player.dorsal).all():
+        loads = daily.get(p.id, {})
+        series = {'load': [], 'minutes': [], 'acute': [], 'chronic': [], 'acwr': []}
+        # Ventanas deslizantes: se suma el día que entra y se resta el que sale
+        acute = sum(loads.get(read_from + timedelta(days=i), 0) for i in range(CHRONIC_LOAD_DAYS - ACUTE_LOAD_DAYS, CHRONIC_LOAD_DAYS - 1))
+        chronic = sum(loads.get(read_from + timedelta(days=i), 0) for i in range(CHRONIC_LOAD_DAYS - 1))
+        for day in dates:
+            today = loads.get(day, 0)
+            acute += today
+            chronic += today
+            chronic_weekly = chronic / (CHRONIC_LOAD_DAYS / 7)
+            series['load'].append(round(today, 1))
+            series['minutes'].append(minutes.get(p.id, {}).get(day, 0))
+            series['acute'].append(round(acute, 1))
+            series['chronic'].append(round(chronic_weekly, 1))
+            series['acwr'].append(round(acute / chronic_weekly, 2) if chronic_weekly else None)
+            acute -= loads.get(day - timedelta(days=ACUTE_LOAD_DAYS - 1), 0)
+            chronic -= loads.get(day - timedelta(days=CHRONIC_LOAD_DAYS - 1), 0)
+        players.append({'id': p.id, 'name': p.name, 'dorsal': p.dorsal, **series})
+    return {'dates': [d.isoformat() for d in dates], 'players': players}
+
+@app.route('/api/team/<int:id>/training_load')
+@login_required
+def api_team_training_load(id):
+    """Carga de entrenamiento del equipo: ?start_date=&end_date= (YYYY-MM-DD, por defecto la temporada)."""
+    team = Team.query.get_or_404(id)
+    if not _can_edit_team(team): return jsonify({'error': 'Unauthorized'}), 403
+    try:
+        start_dt, end_dt = _parse_date_range(request.args)
+    except ValueError:
+        return jsonify({'error': 'Fechas inválidas (YYYY-MM-DD)'}), 400
+    start = (start_dt or season_start()).date()
+    end = (end_dt - timedelta(days=1)).date() if end_dt else datetime.utcnow().date()
+    if end < start or (end - start).days > 366:
+        return jsonify({'error': 'Rango de fechas inválido (máximo un año)'}), 400
+    return jsonify(team_training_load(team, start, end))
+
+@app.route('/api/session/<int:session_id>/rpe', methods=['POST'])
+@login_required
+def api_session_rpe(session_id):
+    """Guarda el RPE (0-10) de los jugadores de la sesión. Body: {rpe: {player_id: valor|null}}"""
+    session = TrainingSession.query.get_or_404(session_id)
+    if not _can_edit_team(session.team): return jsonify({'error': 'Unauthorized'}), 403
+    try:
+        apply_session_rpe(session, (request.get_json(silent=True) or {}).get('rpe'))
+    except (TypeError, ValueError, AttributeError) as e:
+        return jsonify({'error': str(e) or 'Datos inválidos'}), 400
+    refresh_session_load(session)
+    db.session.commit()
+    return jsonify({'status': 'ok'})
+
+def apply_session_rpe(session, rpe_map):
+    """Actualiza el RPE de la asistencia con un único UPDATE ... CASE. Valida antes de escribir. No hace commit."""
+    values = {}
+    for pid, value in rpe_map.items():
+        value = None if value in (None, '') else int(value)
+        if value is not None and not 0 <= value <= 10:
+            raise ValueError('El RPE debe estar entre 0 y 10')
+        values[int(pid)] = value
+    if values:
+        t = SessionAttendance.__table__
+        db.session.execute(t.update()
+                           .where(t.c.session_id == session.id, t.c.player_id.in_(list(values)))
+                           .values(rpe=case(values, value=t.c.player_id)))
 
 @app.route('/finish_session/<int:id>')
 @login_required
 def finish_session(id):
     session = TrainingSession.query.get_or_404(id)
+    if not _can_edit_team(session.team): return redirect('/')
     session.status = 'finished'
+    refresh_session_load(session)
     db.session.commit()
     return redirect('/my_teams')
 
+# --- MATRIZ JUGADOR × ACCIÓN (ESTADÍSTICAS DE EQUIPO) ---
+
+STATS_SHOT_NAMES = ('Tiro 1', 'Tiro 2', 'Tiro 3')
+
+def stats_match_ids(all_matches, filter_type, selected_match_ids=()):
+    """Ids de los partidos del filtro (last1/last5/last10/custom/all) sobre los partidos ya ordenados por fecha."""
+    if filter_type == 'last1':
+        filtered = all_matches[:1]
+    elif filter_type == 'last5':
+        filtered = all_matches[:5]
+    elif filter_type == 'last10':
+        filtered = all_matches[:10]
+    elif filter_type == 'custom' and selected_match_ids:
+        filtered = [m for m in all_matches if m.id in selected_match_ids]
+    else:
+        filtered = all_matches
+    return [m.id for m in filtered]
+
+def stats_action_ids(all_actions, show_type, custom_actions=None):
+    """Ids de las acciones del filtro all/attack/attack_no_shots/defense/custom."""
+    if show_type == 'attack':
+        return [a.id for a in all_actions if a.display_section == 'ATAQUE']
+    if show_type == 'attack_no_shots':
+        # Solo acciones de ATAQUE excluyendo los tiros (1, 2, 3 puntos)
+        return [a.id for a in all_actions if a.display_section == 'ATAQUE' and a.name not in STATS_SHOT_NAMES]
+    if show_type == 'defense':
+        return [a.id for a in all_actions if a.display_section == 'DEFENSA']
+    if show_type == 'custom' and custom_actions:
+        return list(custom_actions)
+    return [a.id for a in all_actions]
+
+def team_action_matrix(match_ids, registry):
+    """Matriz jugador × acción de esos partidos desde los conteos ya agregados de PlayerMatchStat
+    (una fila por partido, jugador y acción); los partidos pendientes de reconstruir se rehacen antes."""
+    if not match_ids:
+        return PlayerActionMatrix([], registry.ids)
+    ensure_matches_live(match_ids)
+    S = PlayerMatchStat
+    counts = db.session.query(S.match_id, S.player_id, S.action_id, S.n).filter(S.match_id.in_(match_ids)).all()
+    return PlayerActionMatrix(counts, registry.ids)
+
+# --- CACHÉ DEL PORTAL PÚBLICO ---
+# La página pública se guarda renderizada en un SQLite local compartido por los workers, con la versión de datos
+# del equipo con la que se generó. Una copia desfasada se sigue sirviendo mientras un único worker la regenera
+# en segundo plano; sin copia, solo uno renderiza y el resto espera su resultado.
+PUBLIC_CACHE_FILTERS = ('all', 'last1', 'last5', 'last10', 'custom')
+PUBLIC_CACHE_MIN_AGE_SECONDS = 5  # una copia más reciente se sirve aunque la versión haya cambiado
+PUBLIC_CACHE_MAX_AGE_SECONDS = 600  # y una al día se regenera igualmente pasado este tiempo
+PUBLIC_CACHE_STALE_SECONDS = 3600  # más antigua que esto ya no se sirve desfasada
+PUBLIC_CACHE_LOCK_SECONDS = 30
+PUBLIC_CACHE_WAIT_SECONDS = 5
+
+PublicPage = namedtuple('PublicPage', 'version created body')
+
+class PublicPageCache:
+    """Páginas renderizadas por clave en SQLite (modo WAL, una conexión por operación). refresh_until marca
+    que un worker la está regenerando. Si el fichero falla, la caché se comporta como vacía."""
+
+    def __init__(self, path):
+        self.path = path
+        self._ready = False
+
+    def _execute(self, sql, params=(), default=None, fetch=False):
+        try:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            try:
+                if not self._ready:
+                    conn.execute('PRAGMA journal_mode=WAL')
+                    conn.execute('CREATE TABLE IF NOT EXISTS public_page (key TEXT PRIMARY KEY, team_id INTEGER NOT NULL, '
+                                 'version INTEGER NOT NULL, created REAL NOT NULL, body TEXT, refresh_until REAL NOT NULL)')
+                    self._ready = True
+                cur = conn.execute(sql, params)
+                return cur.fetchone() if fetch else cur.rowcount
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            app.logger.warning(f'public cache: {e}')
+            return default
+
+    def get(self, key):
+        row = self._execute('SELECT version, created, body FROM public_page WHERE key = ?', (key,), fetch=True)
+        return PublicPage(*row) if row and row[2] is not None else None
+
+    def claim(self, key, team_id):
+        """True si este worker se queda con la regeneración de la clave (o si la caché no responde)."""
+        until = time.time() + PUBLIC_CACHE_LOCK_SECONDS
+        if self._execute('INSERT OR IGNORE INTO public_page (key, team_id, version, created, body, refresh_until) '
+                         'VALUES (?, ?, -1, 0, NULL, ?)', (key, team_id, until), default=1):
+            return True
+        return bool(self._execute('UPDATE public_page SET refresh_until = ? WHERE key = ? AND refresh_until < ?',
+                                  (until, key, time.time()), default=1))
+
+    def put(self, key, team_id, version, body):
+        self._execute('INSERT OR REPLACE INTO public_page (key, team_id, version, created, body, refresh_until) '
+                      'VALUES (?, ?, ?, ?, ?, 0)', (key, team_id, version, time.time(), body))
+
+    def release(self, key):
+        self._execute('UPDATE public_page SET refresh_until = 0 WHERE key = ?', (key,))
+
+    def prune(self, max_age_seconds):
+        return self._execute('DELETE FROM public_page WHERE created < ? AND refresh_until < ?',
+                             (time.time() - max_age_seconds, time.time()), default=0)
+
+public_page_cache = PublicPageCache(app.config['PUBLIC_CACHE_PATH'])
+
+def gallery_team_ids(drill_ids):
+    """Equipos que tienen alguno de esos ejercicios en la galería."""
+    t = team_gallery_drills
+    return set(db.session.execute(select(t.c.team_id).where(t.c.drill_id.in_(list(drill_ids)))).scalars())
+
+def bump_team_data(team_ids=None, user_id=None):
+    """Sube la versión de datos de los equipos (o de todos los del usuario): sus páginas públicas en caché
+    quedan desfasadas. No hace commit."""
+    t = Team.__table__
+    if user_id is not None:
+        condition = t.c.user_id == user_id
+    else:
+        team_ids = {tid for tid in (team_ids or ()) if tid}
+        if not team_ids:
+            return
+        condition = t.c.id.in_(team_ids)
+    db.session.execute(t.update().where(condition).values(data_version=t.c.data_version + 1))
+
+@sa_event.listens_for(db.session, 'before_flush')
+def _bump_public_team_data(session, flush_context, instances):
+    """Los cambios por ORM en equipos, plantilla, partidos, sesiones y galería suben la versión del equipo.
+    Las escrituras directas (eventos, puntos de entrenamiento, acciones) la suben en su propio helper."""
+    team_ids, drill_ids = set(), set()
+    changed = list(session.new) + list(session.deleted) + [o for o in session.dirty if session.is_modified(o)]
+    for obj in changed:
+        if isinstance(obj, Team):
+            team_ids.add(obj.id)
+        elif isinstance(obj, (Player, Match, TrainingSession, TeamGalleryItem)):
+            team_ids.add(obj.team_id)
+        elif isinstance(obj, Drill) and obj.id is not None:
+            # Las visitas no cambian la galería
+            if {a.key for a in sa_inspect(obj).attrs if a.history.has_changes()} - {'views'}:
+                drill_ids.add(obj.id)
+    if drill_ids:
+        team_ids |= gallery_team_ids(drill_ids)
+    bump_team_data(team_ids)
+
+def public_page_key(team, filter_type, selected_match_ids):
+    charts = ''.join('1' if v else '0' for v in (team.analytics_visible, team.chart_all_visible, team.chart_attack_visible,
+                                                 team.chart_attack_no_shots_visible, team.chart_defense_visible))
+    match_ids = ','.join(str(mid) for mid in sorted(set(selected_match_ids)))
+    return f'team:{team.id}|{filter_type}|{match_ids}|{charts}|{team.analytics_players_count or 5}'
+
+def _store_public_page(key, team, filter_type, selected_match_ids):
+    """Renderiza la página con la versión de datos leída antes de empezar y la guarda en la caché."""
+    version = team.data_version or 0
+    try:
+        body = _render_public_team_page(team, filter_type, selected_match_ids)
+    except Exception:
+        public_page_cache.release(key)
+        raise
+    public_page_cache.put(key, team.id, version, body)
+    return body
+
+def _refresh_public_page(key, team_id, filter_type, selected_match_ids):
+    try:
+        team = db.session.get(Team, team_id)
+        if team is None:
+            public_page_cache.release(key)
+            return
+        _store_public_page(key, team, filter_type, selected_match_ids)
+    except Exception as e:
+        app.logger.warning(f'public cache refresh {key}: {e}')
+
+@app.cli.command('prune-public-cache')
+@click.option('--hours', default=24, show_default=True, help='Borra las páginas generadas hace más de estas horas')
+def prune_public_cache_command(hours):
+    """Purga la caché del portal público."""
+    print(f'Páginas borradas: {public_page_cache.prune(hours * 3600)}')
+
 @app.route('/team/<int:id>/public')
 def public_team_ranking(id):
     team = Team.query.get_or_404(id)
@@ -2805,70 +4528,62 @@ def public_team_ranking(id):
     # Obtener parámetros de filtro de partidos
     filter_type = request.args.get('filter', 'all')
     selected_match_ids = request.args.getlist('match_ids', type=int)
-    
+    if filter_type not in PUBLIC_CACHE_FILTERS:
+        return _render_public_team_page(team, filter_type, selected_match_ids)
+    
+    key = public_page_key(team, filter_type, selected_match_ids)
+    cached = public_page_cache.get(key)
+    if cached:
+        age = time.time() - cached.created
+        if age < PUBLIC_CACHE_MIN_AGE_SECONDS or (cached.version == team.data_version and age < PUBLIC_CACHE_MAX_AGE_SECONDS):
+            return cached.body
+        if age < PUBLIC_CACHE_STALE_SECONDS:
+            # Desfasada: se sirve tal cual y un único worker la regenera en segundo plano
+            if public_page_cache.claim(key, team.id):
+                threading.Thread(target=copy_current_request_context(_refresh_public_page),
+                                 args=(key, team.id, filter_type, selected_match_ids), daemon=True).start()
+            return cached.body
+    
+    # Sin copia utilizable: renderiza quien se queda con la clave; el resto espera un poco a su resultado
+    if public_page_cache.claim(key, team.id):
+        return _store_public_page(key, team, filter_type, selected_match_ids)
+    seen = cached.created if cached else 0
+    deadline = time.time() + PUBLIC_CACHE_WAIT_SECONDS
+    while time.time() < deadline:
+        time.sleep(0.1)
+        fresh = public_page_cache.get(key)
+        if fresh and fresh.created > seen:
+            return fresh.body
+    return _render_public_team_page(team, filter_type, selected_match_ids)
+
+def _render_public_team_page(team, filter_type, selected_match_ids):
+    """HTML del portal público del equipo con el filtro de partidos indicado."""
     # Obtener todos los partidos del equipo
     all_matches = Match.query.filter_by(team_id=team.id).order_by(Match.date.desc()).all()
-    
-    # Determinar qué partidos incluir
-    if filter_type == 'last1':
-        filtered_matches = all_matches[:1]
-    elif filter_type == 'last5':
-        filtered_matches = all_matches[:5]
-    elif filter_type == 'last10':
-        filtered_matches = all_matches[:10]
-    elif filter_type == 'custom' and selected_match_ids:
-        filtered_matches = [m for m in all_matches if m.id in selected_match_ids]
-    else:
-        filtered_matches = all_matches
-    
-    match_ids = [m.id for m in filtered_matches]
+    match_ids = stats_match_ids(all_matches, filter_type, selected_match_ids)
     num_matches = len(match_ids)
     
-    # Obtener acciones del equipo
-    all_actions = ActionDefinition.query.filter_by(team_id=team.id).all()
-    if not all_actions:
-        all_actions = ActionDefinition.query.filter_by(user_id=team.user_id, team_id=None).all()
-    
-    shot_names = ['Tiro 1', 'Tiro 2', 'Tiro 3']
+    # Obtener acciones del equipo (registro en memoria del propietario) y la matriz jugador × acción
+    registry = get_action_registry(team.user_id)
+    all_actions = registry.for_team(team.id)
+    rows = team_action_matrix(match_ids, registry).total()
+    players = {p.id: p for p in Player.query.filter(Player.id.in_(list(rows))).all()} if rows else {}
     
     # Función auxiliar para calcular ranking por tipo
     def calculate_ranking(action_filter_type):
-        if action_filter_type == 'all':
-            action_ids = [a.id for a in all_actions]
-        elif action_filter_type == 'attack':
-            action_ids = [a.id for a in all_actions if a.display_section == 'ATAQUE']
-        elif action_filter_type == 'attack_no_shots':
-            action_ids = [a.id for a in all_actions if a.display_section == 'ATAQUE' and a.name not in shot_names]
-        elif action_filter_type == 'defense':
-            action_ids = [a.id for a in all_actions if a.display_section == 'DEFENSA']
-        else:
-            action_ids = [a.id for a in all_actions]
-        
+        action_ids = stats_action_ids(all_actions, action_filter_type)
         if not match_ids or not action_ids:
             return []
-        
-        # Calcular puntos
-        events = MatchEvent.query.filter(
-            MatchEvent.match_id.in_(match_ids),
-            MatchEvent.action_id.in_(action_ids)
-        ).all()
-        
-        player_stats = {}
-        for e in events:
-            if not e.player_id or not e.action_id:
-                continue
-            a = ActionDefinition.query.get(e.action_id)
-            if not a:
-                continue
-            if e.player_id not in player_stats:
-                player_stats[e.player_id] = 0.0
-            player_stats[e.player_id] += a.value
+        keep = matrix_mask(registry.ids, set(action_ids))
+        totals = matrix_dot(rows, matrix_masked(registry.values, keep))
         
         # Convertir a lista y ordenar
         ranking_data = []
-        for pid, total in player_stats.items():
-            player = Player.query.get(pid)
+        touched = matrix_touches(rows, keep)
+        for pid in (pid for pid in rows if pid in touched):
+            player = players.get(pid)
             if player:
+                total = totals[pid]
                 avg = round(total / num_matches, 2) if num_matches > 1 else total
                 ranking_data.append({
                     'name': player.name,
@@ -2893,6 +4608,10 @@ def public_team_ranking(id):
         if team.chart_defense_visible:
             charts['defense'] = {'title': 'LÍDERES EN DEFENSA', 'data': calculate_ranking('defense')}
     
+    # Ranking de entrenamientos de la temporada (desde los acumulados semanales)
+    training_ranking = training_leaderboard(team.id, 'season', limit=team.analytics_players_count or 5) \
+        if team.analytics_visible else []
+    
     # Obtener ejercicios de la galería ordenados con notas
     gallery_items = TeamGalleryItem.query.filter_by(team_id=team.id).order_by(TeamGalleryItem.display_order).all()
     drill_notes = {item.drill_id: item.note for item in gallery_items}
@@ -2918,6 +4637,7 @@ def public_team_ranking(id):
                           filter_type=filter_type,
                           selected_match_ids=selected_match_ids,
                           num_matches=num_matches,
+                          training_ranking=training_ranking,
                           gallery_drills=gallery_drills_ordered)
 
 @app.route('/team/<int:id>/stats')
@@ -2937,46 +4657,16 @@ def team_stats(id):
     
     # Determinar qué partidos incluir
     all_matches = Match.query.filter_by(team_id=team.id).order_by(Match.date.desc()).all()
-    
-    if filter_type == 'last1':
-        filtered_matches = all_matches[:1]
-    elif filter_type == 'last5':
-        filtered_matches = all_matches[:5]
-    elif filter_type == 'last10':
-        filtered_matches = all_matches[:10]
-    elif filter_type == 'custom' and selected_match_ids:
-        filtered_matches = [m for m in all_matches if m.id in selected_match_ids]
-    else:
-        filtered_matches = all_matches
-    
-    match_ids = [m.id for m in filtered_matches]
+    match_ids = stats_match_ids(all_matches, filter_type, selected_match_ids)
     num_matches = len(match_ids)
     
     # Obtener las acciones que se usaron en los partidos del equipo
-    # Primero buscamos acciones del equipo, si no hay, del usuario
-    all_actions = ActionDefinition.query.filter_by(team_id=team.id).order_by(ActionDefinition.display_section, ActionDefinition.display_order).all()
-    if not all_actions:
-        all_actions = ActionDefinition.query.filter_by(user_id=team.user_id, team_id=None).order_by(ActionDefinition.display_section, ActionDefinition.display_order).all()
-    
-    # Determinar qué acciones incluir según el filtro "show"
-    # Lista de nombres de tiros a excluir para la opción "sin puntos"
-    shot_names = ['Tiro 1', 'Tiro 2', 'Tiro 3']
-    
-    if show_type == 'all':
-        action_ids = [a.id for a in all_actions]
-    elif show_type == 'attack':
-        action_ids = [a.id for a in all_actions if a.display_section == 'ATAQUE']
-    elif show_type == 'attack_no_shots':
-        # Solo acciones de ATAQUE excluyendo los tiros (1, 2, 3 puntos)
-        action_ids = [a.id for a in all_actions if a.display_section == 'ATAQUE' and a.name not in shot_names]
-    elif show_type == 'defense':
-        action_ids = [a.id for a in all_actions if a.display_section == 'DEFENSA']
-    elif show_type == 'custom' and custom_actions:
-        action_ids = custom_actions
-    else:
-        action_ids = [a.id for a in all_actions]
+    # Primero buscamos acciones del equipo, si no hay, del usuario (registro en memoria del propietario)
+    registry = get_action_registry(team.user_id)
+    all_actions = registry.for_team(team.id)
+    action_ids = stats_action_ids(all_actions, show_type, custom_actions)
     
-    # Calcular estadísticas por jugador
+    # Calcular estadísticas por jugador: totales = matriz jugador × acción por el vector de valores filtrado
     player_stats = {}
     for player in team.players:
         player_stats[player.id] = {
@@ -2986,38 +4676,13 @@ def team_stats(id):
         }
     
     if match_ids:
-        # Primero: Obtener TODOS los jugadores que jugaron en esos partidos (sin filtro de acciones)
-        all_events = MatchEvent.query.filter(MatchEvent.match_id.in_(match_ids)).all()
-        players_with_events = set()
-        for e in all_events:
-            if e.player_id:
-                players_with_events.add(e.player_id)
-        
-        # Marcar como "jugó" a todos los que tienen eventos
-        for pid in players_with_events:
+        rows = team_action_matrix(match_ids, registry).total()
+        totals = matrix_dot(rows, matrix_masked(registry.values, matrix_mask(registry.ids, set(action_ids))))
+        # Todos los que tienen eventos en esos partidos (sin filtro de acciones) cuentan como que jugaron
+        for pid, total in totals.items():
             if pid in player_stats:
                 player_stats[pid]['matches_played'] = num_matches
-        
-        # Segundo: Calcular puntuaciones con el filtro de acciones
-        if action_ids:
-            events = MatchEvent.query.filter(
-                MatchEvent.match_id.in_(match_ids),
-                MatchEvent.action_id.in_(action_ids)
-            ).all()
-            
-            for e in events:
-                if not e.player_id or not e.action_id:
-                    continue
-                
-                if e.player_id not in player_stats:
-                    continue
-                
-                a = ActionDefinition.query.get(e.action_id)
-                if not a:
-                    continue
-                
-                ps = player_stats[e.player_id]
-                ps['total'] += a.value
+                player_stats[pid]['total'] = total
     
     # Calcular promedio si hay múltiples partidos
     for pid in player_stats:
@@ -3048,7 +4713,8 @@ def team_stats(id):
                          all_matches=all_matches,
                          selected_match_ids=selected_match_ids,
                          custom_actions=custom_actions,
-                         actions_by_section=actions_by_section)
+                         actions_by_section=actions_by_section,
+                         lineups=lineup_stats(Match.id.in_(match_ids), team.id, TEAM_STATS_MIN_UNIT_SECONDS) if match_ids else None)
 
 @app.route('/delete_player/<int:id>')
 @login_required
@@ -3093,6 +4759,134 @@ def delete_team(id):
         db.session.commit()
     return redirect('/my_teams')
 
+# --- USO DE EJERCICIOS (PLANIFICADOS, REALIZADOS, SALTADOS) ---
+
+DRILL_USAGE_FIELDS = ('times_planned', 'times_executed', 'times_skipped', 'duration_delta_sum', 'duration_samples')
+
+def _execution_usage(was_completed, actual_duration, planned_duration):
+    """Aportación de una ejecución a DrillUsage, en el orden de DRILL_USAGE_FIELDS."""
+    if not was_completed:
+        return (0, 0, 1, 0, 0)
+    if actual_duration is None:
+        return (0, 1, 0, 0, 0)
+    return (0, 1, 0, actual_duration - (planned_duration or 0), 1)
+
+def apply_drill_usage_delta(team_id, deltas):
+    """Suma {drill_id: (planificado, realizado, saltado, Δ minutos, muestras)} al uso del equipo:
+    un UPDATE con CASE para las filas que existen y un INSERT multi-fila para las nuevas. No hace commit."""
+    deltas = {did: d for did, d in deltas.items() if any(d)}
+    if not deltas:
+        return
+    t = DrillUsage.__table__
+    have = {did for (did,) in db.session.query(DrillUsage.drill_id).filter(
+        DrillUsage.team_id == team_id, DrillUsage.drill_id.in_(list(deltas))).all()}
+    if have:
+        db.session.execute(
+            t.update()
+            .where(t.c.team_id == team_id, t.c.drill_id.in_(list(have)))
+            .values({field: t.c[field] + case({did: deltas[did][i] for did in have}, value=t.c.drill_id)
+                     for i, field in enumerate(DRILL_USAGE_FIELDS)})
+        )
+    rows = [dict(zip(DRILL_USAGE_FIELDS, d), team_id=team_id, drill_id=did)
+            for did, d in deltas.items() if did not in have]
+    if rows:
+        db.session.execute(insert(DrillUsage), rows)
+
+def rebuild_drill_usage(team_id):
+    """Recalcula desde cero el uso de ejercicios del equipo con dos agregaciones GROUP BY: el plan
+    copiado al abrir cada sesión (planificados) y las ejecuciones registradas, con el ejercicio y la
+    duración planificada que guardan. Da lo mismo que los deltas de cada sesión. No hace commit."""
+    totals = {}
+    def add(drill_id, values):
+        acc = totals.setdefault(drill_id, [0] * len(DRILL_USAGE_FIELDS))
+        for i, v in enumerate(values):
+            acc[i] += int(v or 0)
+
+    for drill_id, n in db.session.query(SessionPlannedDrill.drill_id, func.sum(SessionPlannedDrill.n)) \
+            .join(TrainingSession, TrainingSession.id == SessionPlannedDrill.session_id) \
+            .filter(TrainingSession.team_id == team_id).group_by(SessionPlannedDrill.drill_id).all():
+        add(drill_id, (n, 0, 0, 0, 0))
+    done = SessionItemExecution.was_completed == True
+    timed = and_(done, SessionItemExecution.actual_duration.isnot(None))
+    for drill_id, executed, skipped, delta, samples in db.session.query(
+            SessionItemExecution.drill_id,
+            func.sum(case((done, 1), else_=0)),
+            func.sum(case((done, 0), else_=1)),
+            func.sum(case((timed, SessionItemExecution.actual_duration - func.coalesce(SessionItemExecution.planned_duration, 0)), else_=0)),
+            func.sum(case((timed, 1), else_=0))) \
+            .join(TrainingSession, TrainingSession.id == SessionItemExecution.session_id) \
+            .filter(TrainingSession.team_id == team_id, SessionItemExecution.drill_id.isnot(None)) \
+            .group_by(SessionItemExecution.drill_id).all():
+        add(drill_id, (0, executed, skipped, delta, samples))
+    DrillUsage.query.filter_by(team_id=team_id).delete(synchronize_session=False)
+    if totals:
+        db.session.execute(insert(DrillUsage), [dict(zip(DRILL_USAGE_FIELDS, v), team_id=team_id, drill_id=did)
+                                               for did, v in totals.items()])
+
+def _ensure_drill_usage(team_ids=None):
+    """Acumula una sola vez el histórico de los equipos aún sin DrillUsage (todos si team_ids=None)."""
+    pending = db.session.query(Team.id).filter(or_(Team.drill_usage_ready == False, Team.drill_usage_ready.is_(None)))
+    if team_ids is not None:
+        pending = pending.filter(Team.id.in_(list(team_ids)))
+    pending = [tid for (tid,) in pending.all()]
+    if not pending:
+        return
+    for tid in pending:
+        rebuild_drill_usage(tid)
+    db.session.execute(update(Team).where(Team.id.in_(pending)).values(drill_usage_ready=True))
+    db.session.commit()
+
+def drill_usage_totals():
+    """{drill_id: veces planificado} sumando todos los equipos; alimenta el orden "Más usados".
+    Solo lee DrillUsage: el histórico de equipos sin acumular se carga con `flask rebuild-drill-usage`."""
+    return {did: int(n or 0) for did, n in db.session.query(DrillUsage.drill_id, func.sum(DrillUsage.times_planned))
+            .group_by(DrillUsage.drill_id).all()}
+
+def team_drill_usage(team_ids):
+    """Uso de ejercicios agregado para los equipos indicados, ordenado por veces planificado:
+    [{drill_id, title, planned, executed, skipped, skip_rate, mean_delta}]. skip_rate es la fracción de
+    ejecuciones registradas que se saltaron; mean_delta los minutos medios de más (o de menos) respecto al plan."""
+    team_ids = list(team_ids)
+    if not team_ids:
+        return []
+    _ensure_drill_usage(team_ids)
+    rows = db.session.query(
+        Drill.id, Drill.title, *[func.sum(getattr(DrillUsage, f)) for f in DRILL_USAGE_FIELDS]
+    ).join(Drill, Drill.id == DrillUsage.drill_id).filter(DrillUsage.team_id.in_(team_ids)) \
+        .group_by(Drill.id, Drill.title).all()
+    usage = []
+    for drill_id, title, planned, executed, skipped, delta, samples in rows:
+        planned, executed, skipped = int(planned or 0), int(executed or 0), int(skipped or 0)
+        recorded = executed + skipped
+        usage.append({
+            'drill_id': drill_id, 'title': title or 'Sin título',
+            'planned': planned, 'executed': executed, 'skipped': skipped,
+            'skip_rate': round(skipped / recorded, 3) if recorded else None,
+            'mean_delta': round(int(delta or 0) / samples, 1) if samples else None,
+        })
+    usage.sort(key=lambda u: (-u['planned'], -u['executed'], u['title']))
+    return usage
+
+@app.route('/analytics/drills')
+@login_required
+def drill_usage_analytics():
+    """Uso de ejercicios en los equipos del usuario (owner o staff); ?team_id= filtra uno."""
+    teams = sorted(_user_teams(), key=lambda t: t.name)
+    team_id = request.args.get('team_id', type=int)
+    selected = [t for t in teams if t.id == team_id] if team_id else teams
+    usage = team_drill_usage([t.id for t in selected])
+    return render_template('drill_usage.html', teams=teams, team_id=team_id if len(selected) == 1 else None, usage=usage)
+
+@app.cli.command('rebuild-drill-usage')
+def rebuild_drill_usage_command():
+    """Recalcula DrillUsage de todos los equipos (una vez, al actualizar desde una versión sin él)."""
+    team_ids = [tid for (tid,) in db.session.query(Team.id).all()]
+    for tid in team_ids:
+        rebuild_drill_usage(tid)
+    db.session.execute(update(Team).values(drill_usage_ready=True))
+    db.session.commit()
+    print(f'Uso de ejercicios recalculado para {len(team_ids)} equipos')
+
 # --- CONFIGURACIÓN PARTIDO ---
 # Regla: las posiciones (grid_row, grid_col) solo aplican dentro del mismo bloque (display_section, is_positive).
 # Un botón de Ataque+ no puede moverse a Ataque-, Defensa+ ni Defensa-. Cualquier API de posición solo debe
@@ -3156,13 +4950,14 @@ def game_config():
                         r = 1
                 used.add((r, c))
                 a.grid_row, a.grid_col = r, c
+        bump_action_config(current_user.id)
         db.session.commit()
         flash('Configuración guardada')
         return redirect('/game_config')
-    actions = get_actions_for_user(current_user.id, include_hidden=True)
+    actions = _query_actions_for_user(current_user.id, include_hidden=True)
     if not actions:
         copy_actions_from_admin_to_user(current_user.id)
-        actions = get_actions_for_user(current_user.id, include_hidden=True)
+        actions = _query_actions_for_user(current_user.id, include_hidden=True)
     # Asignar grid por defecto a acciones de sistema que no lo tengan (p. ej. tras migración)
     need_save = False
     for a in actions:
@@ -3174,19 +4969,21 @@ def game_config():
                     need_save = True
                     break
     if need_save:
+        bump_action_config(current_user.id, live=False)
         db.session.commit()
-        actions = get_actions_for_user(current_user.id, include_hidden=True)
+        actions = _query_actions_for_user(current_user.id, include_hidden=True)
     # Migrar acciones antiguas sin display_section al conjunto estándar
     if actions and not any(getattr(a, 'display_section', None) for a in actions):
         for a in ActionDefinition.query.filter_by(user_id=current_user.id, team_id=None).all():
             db.session.delete(a)
+        bump_action_config(current_user.id)
         db.session.commit()
         copy_actions_from_admin_to_user(current_user.id)
-        actions = get_actions_for_user(current_user.id, include_hidden=True)
+        actions = _query_actions_for_user(current_user.id, include_hidden=True)
     # Garantizar que siempre haya acciones para mostrar (p. ej. admin sin acciones aún)
     if not actions:
         create_default_actions_for_user(current_user.id)
-        actions = get_actions_for_user(current_user.id, include_hidden=True)
+        actions = _query_actions_for_user(current_user.id, include_hidden=True)
     # Posiciones fijas por bloque (documento Excel): huecos que existen; los botones los rellenan e intercambian
     SLOTS_ATAQUE = [(1, 1), (2, 1), (2, 2), (3, 1), (3, 2), (4, 1), (4, 2)]   # 7 huecos; (1,1) doble ancho
     SLOTS_DEFENSA = [(1, 1), (1, 2), (2, 1), (2, 2), (3, 1), (3, 2)]           # 6 huecos
@@ -3207,9 +5004,10 @@ def game_config():
     if needs_reset:
         for a in ActionDefinition.query.filter_by(user_id=current_user.id, team_id=None).all():
             db.session.delete(a)
+        bump_action_config(current_user.id)
         db.session.commit()
         create_default_actions_for_user(current_user.id)
-        actions = get_actions_for_user(current_user.id, include_hidden=True)
+        actions = _query_actions_for_user(current_user.id, include_hidden=True)
         by_block = defaultdict(list)
         for a in actions:
             by_block[_block_key(a)].append(a)
@@ -3226,8 +5024,9 @@ def game_config():
                 sorted_actions[i].grid_row, sorted_actions[i].grid_col = r, c
                 migrate_pos = True
     if migrate_pos:
+        bump_action_config(current_user.id, live=False)
         db.session.commit()
-        actions = get_actions_for_user(current_user.id, include_hidden=True)
+        actions = _query_actions_for_user(current_user.id, include_hidden=True)
     rankings = RankingDefinition.query.filter_by(user_id=current_user.id).filter(RankingDefinition.team_id.is_(None)).all()
     blocks_with_slots = [
         ('Ataque +', 'ATAQUE', True, SLOTS_ATAQUE),
@@ -3247,6 +5046,7 @@ def game_config_add():
     is_pos = (val > 0)
     new_act = ActionDefinition(name=_truncate_action_name(name or ''), value=val, is_positive=is_pos, user_id=current_user.id, team_id=None)
     db.session.add(new_act)
+    bump_action_config(current_user.id, live=False)
     db.session.commit()
     flash('Acción creada')
     return redirect('/game_config')
@@ -3269,6 +5069,7 @@ def game_config_reset():
     """Resetea las acciones del usuario a los valores por defecto."""
     for a in ActionDefinition.query.filter_by(user_id=current_user.id, team_id=None).all():
         db.session.delete(a)
+    bump_action_config(current_user.id)
     db.session.commit()
     create_default_actions_for_user(current_user.id)
     flash('Acciones reseteadas a valores por defecto')
@@ -3293,6 +5094,7 @@ def api_action_update(id):
     can_edit_desc = (act.custom_slot is not None) or current_user.is_admin
     if can_edit_desc and 'description' in data:
         act.description = (str(data.get('description') or '')[:255])
+    bump_action_config(current_user.id)
     db.session.commit()
     return jsonify({'status': 'ok', 'action': {'id': act.id, 'name': act.name, 'value': act.value, 'description': act.description or '', 'visible': act.visible}})
 
@@ -3343,6 +5145,7 @@ def api_game_config_positions():
                     r = 1
             used.add((r, c))
             a.grid_row, a.grid_col = r, c
+    bump_action_config(current_user.id, live=False)
     db.session.commit()
     return jsonify({'status': 'ok', 'updated': len(ids_ok)})
 
@@ -3432,6 +5235,527 @@ def match_tracker(id):
     saved_period = match.current_period if match.current_period else 1
     return render_template('tracker.html', match=match, actions=actions, all_actions=all_actions, saved_period=saved_period, saved_lineup=saved_lineup)
 
+# --- MARCADOR EN VIVO (AGREGADO POR PARTIDO Y JUGADOR) ---
+
+LIVE_STAT_FIELDS = ('val', 'ata', 'def', 'fouls', 'points')
+
+def _action_live_contribution(action):
+    """Lo que suma un evento con esta acción al marcador del jugador, en el orden de LIVE_STAT_FIELDS."""
+    value = action.value or 0.0
+    return (value,
+            value if action.display_section == 'ATAQUE' else 0.0,
+            value if action.display_section == 'DEFENSA' else 0.0,
+            1 if action.name == 'Falta' else 0,
+            action.score_value or 0)
+
+def _match_live_period(period):
+    try:
+        return max(1, int(period or 1))
+    except (TypeError, ValueError):
+        return 1
+
+def match_event_deltas(events, registry, sign=1):
+    """Aportación de eventos (player_id, action_id, opponent_points, period) al marcador en vivo, con signo:
+    ({(periodo, jugador): valores en el orden de LIVE_STAT_FIELDS}, {periodo: puntos del rival},
+    {(periodo, jugador o None para el rival): ±número de eventos})."""
+    deltas, rival, counts = {}, {}, {}
+    for player_id, action_id, opponent_points, period in events:
+        period = _match_live_period(period)
+        if opponent_points:
+            rival[period] = rival.get(period, 0) + sign * opponent_points
+            counts[(period, None)] = counts.get((period, None), 0) + sign
+            continue
+        if not player_id or not action_id:
+            continue
+        # Una acción de otro usuario (edición a mano) no está en el registro: se lee igual que al reconstruir
+        action = registry.get(int(action_id)) or db.session.get(ActionDefinition, int(action_id))
+        if not action:
+            continue
+        key = (period, int(player_id))
+        acc = deltas.setdefault(key, [0] * len(LIVE_STAT_FIELDS))
+        for i, v in enumerate(_action_live_contribution(action)):
+            acc[i] += sign * v
+        counts[key] = counts.get(key, 0) + sign
+    return deltas, rival, counts
+
+def apply_match_events(match, events, sign=1):
+    """Suma (sign=1) o resta (sign=-1) eventos (player_id, action_id, opponent_points, period) al marcador
+    en vivo, a los parciales y al resultado del partido. Devuelve los jugadores afectados. No hace commit."""
+    deltas, rival, counts = match_event_deltas(events, get_action_registry(match.user_id), sign)
+    apply_match_live_deltas(match.id, deltas, rival, counts)
+    apply_player_match_counts(match.id, match_event_counts(events, sign))
+    bump_team_data([match.team_id])
+    return list(dict.fromkeys(pid for _, pid in deltas))
+
+def match_event_counts(events, sign=1):
+    """{(jugador, acción): ±n} de eventos (player_id, action_id, opponent_points, period), para PlayerMatchStat."""
+    counts = {}
+    for player_id, action_id, opponent_points, _ in events:
+        if opponent_points or not player_id or not action_id:
+            continue
+        key = (int(player_id), int(action_id))
+        counts[key] = counts.get(key, 0) + sign
+    return counts
+
+def apply_player_match_counts(match_id, counts):
+    """Suma los conteos {(jugador, acción): ±n} a PlayerMatchStat y borra las filas que se quedan a 0. No hace commit."""
+    t = PlayerMatchStat.__table__
+    for (player_id, action_id), n in counts.items():
+        if n:
+            _add_to_row(t, {'match_id': match_id, 'player_id': player_id, 'action_id': action_id}, {'n': n})
+    if any(n < 0 for n in counts.values()):
+        db.session.execute(t.delete().where(t.c.match_id == match_id, t.c.n <= 0))
+
+def _add_to_row(table, keys, delta):
+    """UPDATE atómico (col = col + delta) de la fila con esas claves y, si aún no existe, INSERT."""
+    result = db.session.execute(table.update().where(*(table.c[k] == v for k, v in keys.items()))
+                                .values({f: table.c[f] + d for f, d in delta.items()}))
+    if not result.rowcount:
+        db.session.execute(table.insert().values(**keys, **delta))
+
+def apply_match_live_deltas(match_id, deltas, rival=None, counts=None):
+    """deltas: {(periodo, jugador): valores en el orden de LIVE_STAT_FIELDS}; rival: {periodo: puntos};
+    counts: {(periodo, jugador o None para el rival): ±eventos}. Actualiza MatchPlayerLive, los parciales por
+    periodo (MatchPeriodLive, MatchPeriodPlayerLive, borrando las filas que se quedan sin eventos, como al
+    reconstruir) y match.result_us/result_them con UPDATEs atómicos, insertando las filas que falten, y marca
+    el +/- del partido para recalcular. No hace commit."""
+    rival, counts = rival or {}, counts or {}
+    tp, tpp = MatchPeriodLive.__table__, MatchPeriodPlayerLive.__table__
+    players, periods = {}, {period: [0, them, 0] for period, them in rival.items()}
+    for (period, _), n in counts.items():
+        periods.setdefault(period, [0, 0, 0])[2] += n
+    for (period, player_id), values in deltas.items():
+        delta = dict(zip(LIVE_STAT_FIELDS, values))
+        acc = players.setdefault(player_id, [0] * len(LIVE_STAT_FIELDS))
+        for i, v in enumerate(values):
+            acc[i] += v
+        periods.setdefault(period, [0, 0, 0])[0] += delta['points']
+        _add_to_row(tpp, {'match_id': match_id, 'period': period, 'player_id': player_id},
+                    {'val': delta['val'], 'points': delta['points'], 'events': counts.get((period, player_id), 0)})
+    for player_id, values in players.items():
+        _add_to_row(MatchPlayerLive.__table__, {'match_id': match_id, 'player_id': player_id},
+                    dict(zip(LIVE_STAT_FIELDS, values)))
+    for period, (us, them, n) in periods.items():
+        _add_to_row(tp, {'match_id': match_id, 'period': period}, {'points_us': us, 'points_them': them, 'events': n})
+    if any(n < 0 for n in counts.values()):
+        db.session.execute(tpp.delete().where(tpp.c.match_id == match_id, tpp.c.events <= 0))
+        db.session.execute(tp.delete().where(tp.c.match_id == match_id, tp.c.events <= 0))
+    us = sum(us for us, _, _ in periods.values())
+    them = sum(them for _, them, _ in periods.values())
+    # Cualquier evento (también un cambio de quinteto) deja el +/- del partido por recalcular
+    db.session.execute(update(Match).where(Match.id == match_id).values(
+        result_us=func.coalesce(Match.result_us, 0) + us,
+        result_them=func.coalesce(Match.result_them, 0) + them,
+        lineup_ready=False),
+        execution_options={'synchronize_session': False})
+    _expire_matches([match_id], ['result_us', 'result_them', 'lineup_ready'])
+
+def _expire_matches(match_ids, attrs):
+    """Tras un UPDATE directo, los Match ya cargados en la sesión vuelven a leer esas columnas."""
+    for m in db.session.identity_map.values():
+        if isinstance(m, Match) and m.id in match_ids:
+            db.session.expire(m, attrs)
+
+def match_score_totals(match_ids):
+    """{match_id: (puntos propios, puntos del rival)} calculados desde los eventos, con dos GROUP BY."""
+    ours = dict(db.session.query(MatchEvent.match_id, func.sum(func.coalesce(ActionDefinition.score_value, 0)))
+                .join(ActionDefinition, ActionDefinition.id == MatchEvent.action_id)
+                .filter(MatchEvent.match_id.in_(match_ids), MatchEvent.player_id.isnot(None),
+                        func.coalesce(MatchEvent.opponent_points, 0) == 0)
+                .group_by(MatchEvent.match_id).all())
+    rival = dict(db.session.query(MatchEvent.match_id, func.sum(MatchEvent.opponent_points))
+                 .filter(MatchEvent.match_id.in_(match_ids)).group_by(MatchEvent.match_id).all())
+    return {mid: (int(ours.get(mid) or 0), int(rival.get(mid) or 0)) for mid in match_ids}
+
+def rebuild_match_live(match_ids):
+    """Recalcula desde los eventos el marcador en vivo, los conteos por acción, los parciales por periodo y
+    el resultado (result_us, result_them) de los partidos: GROUP BY por (partido, jugador), por (partido, jugador,
+    acción), por (partido, periodo, jugador), por (partido, periodo) y los de match_score_totals. No hace commit."""
+    match_ids = list(match_ids)
+    if not match_ids:
+        return
+    t = MatchPlayerLive.__table__
+    db.session.execute(t.delete().where(t.c.match_id.in_(match_ids)))
+    rebuild_player_match_counts(match_ids)
+    rebuild_match_periods(match_ids)
+    A = ActionDefinition
+    rows = db.session.query(
+        MatchEvent.match_id, MatchEvent.player_id,
+        func.sum(A.value),
+        func.sum(case((A.display_section == 'ATAQUE', A.value), else_=0.0)),
+        func.sum(case((A.display_section == 'DEFENSA', A.value), else_=0.0)),
+        func.sum(case((A.name == 'Falta', 1), else_=0)),
+        func.sum(func.coalesce(A.score_value, 0)),
+    ).join(A, A.id == MatchEvent.action_id) \
+        .filter(MatchEvent.match_id.in_(match_ids), MatchEvent.player_id.isnot(None),
+                func.coalesce(MatchEvent.opponent_points, 0) == 0) \
+        .group_by(MatchEvent.match_id, MatchEvent.player_id).all()
+    if rows:
+        db.session.execute(t.insert(), [
+            dict(zip(LIVE_STAT_FIELDS, (float(v or 0), float(at or 0), float(df or 0), int(f or 0), int(pts or 0))),
+                 match_id=mid, player_id=pid)
+            for mid, pid, v, at, df, f, pts in rows])
+    totals = match_score_totals(match_ids)
+    db.session.execute(update(Match).where(Match.id.in_(match_ids)).values(
+        result_us=case({mid: us for mid, (us, _) in totals.items()}, value=Match.id),
+        result_them=case({mid: them for mid, (_, them) in totals.items()}, value=Match.id),
+        live_ready=True), execution_options={'synchronize_session': False})
+    _expire_matches(match_ids, ['result_us', 'result_them', 'live_ready'])
+
+def rebuild_player_match_counts(match_ids):
+    """PlayerMatchStat desde los eventos con un INSERT ... SELECT agrupado. No hace commit."""
+    t = PlayerMatchStat.__table__
+    db.session.execute(t.delete().where(t.c.match_id.in_(match_ids)))
+    db.session.execute(t.insert().from_select(
+        ['match_id', 'player_id', 'action_id', 'n'],
+        select(MatchEvent.match_id, MatchEvent.player_id, MatchEvent.action_id, func.count(MatchEvent.id))
+        .where(MatchEvent.match_id.in_(match_ids), MatchEvent.player_id.isnot(None), MatchEvent.action_id.isnot(None),
+               func.coalesce(MatchEvent.opponent_points, 0) == 0)
+        .group_by(MatchEvent.match_id, MatchEvent.player_id, MatchEvent.action_id)))
+
+def rebuild_match_periods(match_ids):
+    """Parciales por periodo desde los eventos (una fila por periodo con acciones de jugador o puntos del rival;
+    los cambios de quinteto no crean periodo). No hace commit."""
+    tp, tpp = MatchPeriodLive.__table__, MatchPeriodPlayerLive.__table__
+    db.session.execute(tp.delete().where(tp.c.match_id.in_(match_ids)))
+    db.session.execute(tpp.delete().where(tpp.c.match_id.in_(match_ids)))
+    A = ActionDefinition
+    period = func.coalesce(MatchEvent.period, 1)
+    rows = db.session.query(
+        MatchEvent.match_id, period, MatchEvent.player_id,
+        func.sum(A.value), func.sum(func.coalesce(A.score_value, 0)), func.count(MatchEvent.id),
+    ).join(A, A.id == MatchEvent.action_id) \
+        .filter(MatchEvent.match_id.in_(match_ids), MatchEvent.player_id.isnot(None),
+                func.coalesce(MatchEvent.opponent_points, 0) == 0) \
+        .group_by(MatchEvent.match_id, period, MatchEvent.player_id).all()
+    periods = {(mid, per): [0, int(them or 0), n] for mid, per, them, n in db.session.query(
+        MatchEvent.match_id, period, func.sum(MatchEvent.opponent_points), func.count(MatchEvent.id))
+        .filter(MatchEvent.match_id.in_(match_ids), func.coalesce(MatchEvent.opponent_points, 0) != 0)
+        .group_by(MatchEvent.match_id, period).all()}
+    for mid, per, _, _, pts, n in rows:
+        acc = periods.setdefault((mid, per), [0, 0, 0])
+        acc[0] += int(pts or 0)
+        acc[2] += n
+    if rows:
+        db.session.execute(tpp.insert(), [
+            {'match_id': mid, 'period': per, 'player_id': pid, 'val': float(v or 0), 'points': int(pts or 0), 'events': n}
+            for mid, per, pid, v, pts, n in rows])
+    if periods:
+        db.session.execute(tp.insert(), [
+            {'match_id': mid, 'period': per, 'points_us': us, 'points_them': them, 'events': n}
+            for (mid, per), (us, them, n) in periods.items()])
+
+def invalidate_match_live(user_id):
+    """Los valores, nombres o acciones del usuario han cambiado: sus partidos se reconstruyen al leerlos
+    y los streams de los que tienen actividad reciente reciben un 'reset'. No hace commit."""
+    db.session.execute(update(Match).where(Match.user_id == user_id).values(live_ready=False, lineup_ready=False),
+                       execution_options={'synchronize_session': False})
+    t = MatchStreamEvent.__table__
+    recent = select(t.c.match_id).where(t.c.created_at >= datetime.utcnow() - MATCH_STREAM_RETENTION).distinct()
+    result = db.session.execute(t.insert().from_select(
+        ['match_id', 'kind', 'payload', 'created_at'],
+        select(Match.id, literal('reset'), literal('{}'), literal(datetime.utcnow()))
+        .where(Match.user_id == user_id, Match.id.in_(recent))))
+    if result.rowcount:
+        db.session.info['match_stream_notify'] = True
+
+def _ensure_match_live(match):
+    if not match.live_ready:
+        rebuild_match_live([match.id])
+        db.session.commit()
+
+def ensure_matches_live(match_ids):
+    """Reconstruye (y confirma) los partidos de la lista marcados como pendientes; una consulta si no hay ninguno."""
+    stale = [mid for (mid,) in db.session.query(Match.id).filter(Match.id.in_(match_ids), Match.live_ready == false()).all()]
+    if stale:
+        rebuild_match_live(stale)
+        db.session.commit()
+
+def _live_player_stats(row):
+    return {'val': round(row.val, 2), 'ata': round(row.ata, 2), 'def': round(row.defense, 2), 'fouls': row.fouls}
+
+def match_live_payload(match):
+    """Marcador en vivo completo: {'players': {id: ...}, 'score_home', 'score_away'} para los jugadores convocados."""
+    _ensure_match_live(match)
+    players = {}
+    for p in match.roster:
+        players[p.id] = {
+            'name': p.name, 'dorsal': p.dorsal, 'photo': p.photo_file,
+            'val': 0.0, 'ata': 0.0, 'def': 0.0, 'fouls': 0
+        }
+    
+    for row in MatchPlayerLive.query.filter_by(match_id=match.id).all():
+        if row.player_id not in players: continue
+        players[row.player_id].update(_live_player_stats(row))
+    return {'players': players, 'score_home': match.result_us or 0, 'score_away': match.result_them or 0}
+
+def match_event_order(descending=False):
+    """Orden de los eventos de un partido: momento del toque y, entre eventos del mismo lote, la secuencia del cliente."""
+    cols = (MatchEvent.timestamp, MatchEvent.seq, MatchEvent.id)
+    return [c.desc() for c in cols] if descending else list(cols)
+
+def _match_event_item(event_id, opponent_points, period, player, action):
+    """Una línea de 'últimas acciones' (mismo formato que /api/last_events)."""
+    if opponent_points:
+        return {'id': event_id, 'kind': 'rival', 'pts': opponent_points, 'period': period}
+    return {'id': event_id, 'kind': 'action', 'player': player or {}, 'action': action or {}, 'period': period}
+
+def match_last_events(match, n):
+    events = MatchEvent.query.filter_by(match_id=match.id, lineup=None) \
+        .order_by(*match_event_order(descending=True)).limit(n).all()
+    roster = {p.id: {'name': p.name, 'dorsal': p.dorsal} for p in match.roster}
+    actions_map = {a.id: {'name': a.name, 'value': a.value} for a in get_actions_for_team(match.team_id, match.user_id)}
+    return [_match_event_item(e.id, e.opponent_points, e.period, roster.get(e.player_id), actions_map.get(e.action_id))
+            for e in events]
+
+@app.cli.command('rebuild-match-live')
+@click.option('--match-id', type=int, default=None, help='Solo este partido')
+def rebuild_match_live_command(match_id):
+    """Recalcula el marcador en vivo (y los puntos del rival) desde los eventos."""
+    ids = [match_id] if match_id else [mid for (mid,) in db.session.query(Match.id).all()]
+    for i in range(0, len(ids), 200):
+        rebuild_match_live(ids[i:i + 200])
+    db.session.commit()
+    print(f'Marcador en vivo recalculado para {len(ids)} partidos')
+
+@app.cli.command('backfill-match-scores')
+@click.option('--verify', is_flag=True, help='Solo comprobar: lista los partidos cuyo resultado guardado no cuadra')
+def backfill_match_scores_command(verify):
+    """Compara result_us/result_them con lo que dicen los eventos y, salvo con --verify, corrige los que difieren."""
+    ids = [mid for (mid,) in db.session.query(Match.id).order_by(Match.id).all()]
+    wrong = []
+    for i in range(0, len(ids), 200):
+        chunk = ids[i:i + 200]
+        stored = {mid: (us or 0, them or 0) for mid, us, them in
+                  db.session.query(Match.id, Match.result_us, Match.result_them).filter(Match.id.in_(chunk)).all()}
+        for mid, real in match_score_totals(chunk).items():
+            if stored[mid] != real:
+                wrong.append(mid)
+                print(f'Partido {mid}: guardado {stored[mid][0]}-{stored[mid][1]}, eventos {real[0]}-{real[1]}')
+    if verify:
+        print(f'{len(wrong)} de {len(ids)} partidos con el resultado desfasado')
+        if wrong:
+            raise SystemExit(1)
+        return
+    for i in range(0, len(wrong), 200):
+        rebuild_match_live(wrong[i:i + 200])
+    db.session.commit()
+    print(f'{len(wrong)} de {len(ids)} partidos corregidos')
+
+# --- STREAM DEL PARTIDO EN VIVO (SERVER-SENT EVENTS) ---
+# Los endpoints de escritura dejan una fila en MatchStreamEvent dentro de su transacción. En cada proceso
+# un único hilo (MatchStreamHub) lee las filas nuevas de los partidos con suscriptores y las reparte a sus
+# colas: la base de datos ve una consulta por proceso y segundo, no una por espectador.
+
+MATCH_STREAM_POLL_SECONDS = 1.0
+MATCH_STREAM_HEARTBEAT_SECONDS = 15
+MATCH_STREAM_MAX_AGE_SECONDS = 30 * 60   # el cliente reconecta solo (con Last-Event-ID) y el worker se libera
+MATCH_STREAM_RETENTION = timedelta(hours=48)
+MATCH_STREAM_LAST_EVENTS = 10
+MATCH_STREAM_MAX_BACKLOG = 200           # más cambios pendientes que esto: se envía un snapshot en su lugar
+
+def _live_delta_payload(match, player_ids):
+    """Estado absoluto (no incrementos) de los jugadores afectados y del marcador: reenviarlo es idempotente."""
+    if not match.live_ready:
+        rebuild_match_live([match.id])
+    player_ids = [int(pid) for pid in player_ids if pid]
+    players = {}
+    if player_ids:
+        for row in MatchPlayerLive.query.filter(MatchPlayerLive.match_id == match.id,
+                                                MatchPlayerLive.player_id.in_(player_ids)).all():
+            players[row.player_id] = _live_player_stats(row)
+    return {'players': players, 'score_home': match.result_us or 0, 'score_away': match.result_them or 0}
+
+def publish_match_change(match_id, kind, payload):
+    """Encola un cambio para los streams del partido. Va en la transacción del llamador; no hace commit."""
+    db.session.add(MatchStreamEvent(match_id=match_id, kind=kind, payload=json.dumps(payload)))
+    db.session.info['match_stream_notify'] = True
+
+def publish_match_event(match, kind, event, player_ids=()):
+    """Publica un evento creado ('event'), editado ('edit') o borrado ('undo') con el marcador resultante."""
+    db.session.flush()
+    payload = _live_delta_payload(match, player_ids)
+    if kind == 'undo':
+        payload['event_id'] = event.id
+    else:
+        db.session.expire(event, ['player', 'action'])  # tras editar, las relaciones siguen a los ids nuevos
+        player = {'name': event.player.name, 'dorsal': event.player.dorsal} if event.player else None
+        action = {'name': event.action.name, 'value': event.action.value} if event.action else None
+        payload['event'] = _match_event_item(event.id, event.opponent_points, event.period, player, action)
+    publish_match_change(match.id, kind, payload)
+
+def publish_match_events_batch(match, rows, registry, player_ids):
+    """Publica como un solo mensaje 'events' los eventos de un lote (filas ya insertadas, con id)."""
+    roster = {p.id: {'name': p.name, 'dorsal': p.dorsal} for p in match.roster}
+    items = []
+    for row in rows:
+        if row['lineup'] is not None:
+            continue
+        action = registry.get(row['action_id'])
+        items.append(_match_event_item(row['id'], row['opponent_points'], row['period'], roster.get(row['player_id']),
+                                       {'name': action.name, 'value': action.value} if action else None))
+    payload = _live_delta_payload(match, player_ids)
+    payload['events'] = items
+    publish_match_change(match.id, 'events', payload)
+
+class MatchStreamHub:
+    """Suscriptores SSE de este proceso por partido y el hilo que les reparte los cambios nuevos.
+    El hilo arranca con el primer suscriptor y termina cuando no queda ninguno."""
+
+    def __init__(self, poll_seconds):
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._subscribers = {}
+        self._thread = None
+        self._last_id = 0
+
+    def subscribe(self, match_id):
+        """Registra una cola para el partido. Llamar dentro de un contexto de aplicación."""
+        q = queue.Queue()
+        with self._lock:
+            self._subscribers.setdefault(match_id, set()).add(q)
+            if self._thread is None:
+                # El cursor se fija antes de que el suscriptor lea su backlog: no se pierde nada entre ambos
+                self._last_id = db.session.query(func.coalesce(func.max(MatchStreamEvent.id), 0)).scalar()
+                self._thread = threading.Thread(target=self._run, name='match-stream-hub', daemon=True)
+                self._thread.start()
+        return q
+
+    def unsubscribe(self, match_id, q):
+        with self._lock:
+            subs = self._subscribers.get(match_id)
+            if subs is not None:
+                subs.discard(q)
+                if not subs:
+                    del self._subscribers[match_id]
+
+    def notify(self):
+        """Despierta al hilo sin esperar al siguiente sondeo (cambios hechos en este mismo proceso)."""
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    return
+            try:
+                # Sin filtrar por partido: el cursor es único y un suscriptor que llega entre dos sondeos
+                # debe recibir los cambios de su partido posteriores al cursor, no solo los siguientes
+                with app.app_context():
+                    rows = db.session.query(MatchStreamEvent.id, MatchStreamEvent.match_id,
+                                            MatchStreamEvent.kind, MatchStreamEvent.payload) \
+                        .filter(MatchStreamEvent.id > self._last_id) \
+                        .order_by(MatchStreamEvent.id).limit(500).all()
+            except Exception as e:
+                app.logger.warning(f'match stream: {e}')
+                rows = []
+            for row in rows:
+                with self._lock:
+                    subs = list(self._subscribers.get(row.match_id, ()))
+                for q in subs:
+                    q.put(tuple(row))
+                self._last_id = row.id
+            if len(rows) < 500:
+                self._wake.wait(self.poll_seconds)
+                self._wake.clear()
+
+match_stream_hub = MatchStreamHub(MATCH_STREAM_POLL_SECONDS)
+
+@sa_event.listens_for(db.session, 'after_commit')
+def _notify_match_stream(session):
+    if session.info.pop('match_stream_notify', False):
+        match_stream_hub.notify()
+
+@sa_event.listens_for(db.session, 'after_rollback')
+def _discard_match_stream_notify(session):
+    session.info.pop('match_stream_notify', None)
+
+def _sse(kind, data, event_id=None):
+    head = f'id: {event_id}\n' if event_id is not None else ''
+    return f'{head}event: {kind}\ndata: {data if isinstance(data, str) else json.dumps(data)}\n\n'
+
+def _match_stream(match_id, last_id):
+    """Generador del stream: snapshot o backlog desde last_id y después los cambios del hub,
+    con un comentario de latido cada MATCH_STREAM_HEARTBEAT_SECONDS."""
+    q = None
+    try:
+        with app.app_context():
+            q = match_stream_hub.subscribe(match_id)
+            backlog, first = [], None
+            if last_id is not None:
+                # Si se purgaron cambios posteriores a last_id el backlog ya no basta
+                oldest = db.session.query(func.min(MatchStreamEvent.id)).scalar()
+                if oldest is None or last_id < oldest - 1:
+                    last_id = None
+                else:
+                    backlog = db.session.query(MatchStreamEvent.id, MatchStreamEvent.match_id,
+                                               MatchStreamEvent.kind, MatchStreamEvent.payload) \
+                        .filter(MatchStreamEvent.match_id == match_id, MatchStreamEvent.id > last_id) \
+                        .order_by(MatchStreamEvent.id).limit(MATCH_STREAM_MAX_BACKLOG + 1).all()
+            if last_id is None or len(backlog) > MATCH_STREAM_MAX_BACKLOG:
+                last_id = db.session.query(func.coalesce(func.max(MatchStreamEvent.id), 0)).scalar()
+                match = db.session.get(Match, match_id)
+                if match is None:
+                    return
+                snapshot = match_live_payload(match)
+                snapshot['events'] = match_last_events(match, MATCH_STREAM_LAST_EVENTS)
+                snapshot['period'] = match.current_period or 1
+                snapshot['lineup'] = json.loads(match.court_lineup) if match.court_lineup else []
+                backlog = []
+                first = _sse('snapshot', snapshot, last_id)
+        yield 'retry: 3000\n\n'
+        if first:
+            yield first
+        for row_id, _, kind, payload in backlog:
+            yield _sse(kind, payload, row_id)
+            last_id = row_id
+        deadline = time.monotonic() + MATCH_STREAM_MAX_AGE_SECONDS
+        while time.monotonic() < deadline:
+            try:
+                row_id, _, kind, payload = q.get(timeout=MATCH_STREAM_HEARTBEAT_SECONDS)
+            except queue.Empty:
+                yield ': ping\n\n'
+                continue
+            if row_id <= last_id:
+                continue
+            last_id = row_id
+            yield _sse(kind, payload, row_id)
+    finally:
+        if q is not None:
+            match_stream_hub.unsubscribe(match_id, q)
+
+@app.route('/api/match/<int:match_id>/stream')
+@login_required
+def api_match_stream(match_id):
+    """SSE con los cambios del partido: snapshot al conectar y luego 'event', 'events' (lote), 'undo', 'edit',
+    'state' y 'reset'.
+    Acepta Last-Event-ID (o ?last_event_id=) para reanudar sin perder cambios."""
+    match = Match.query.get_or_404(match_id)
+    if match.user_id != current_user.id:
+        st = TeamStaff.query.filter_by(team_id=match.team_id, email=current_user.email, status='accepted').first()
+        if not st: return jsonify({'error': 'No autorizado'}), 403
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_id = int(last_id) if last_id not in (None, '') else None
+    except ValueError:
+        return jsonify({'error': 'Last-Event-ID inválido'}), 400
+    response = Response(_match_stream(match.id, last_id), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # nginx no debe acumular el stream
+    return response
+
+@app.cli.command('prune-match-stream')
+@click.option('--hours', type=int, default=int(MATCH_STREAM_RETENTION.total_seconds() // 3600),
+              help='Conservar los cambios de las últimas N horas')
+def prune_match_stream_command(hours):
+    """Borra los cambios antiguos del stream de partidos (los clientes que vuelvan reciben un snapshot)."""
+    t = MatchStreamEvent.__table__
+    result = db.session.execute(t.delete().where(t.c.created_at < datetime.utcnow() - timedelta(hours=hours)))
+    db.session.commit()
+    print(f'{result.rowcount} cambios de stream borrados')
+
 @app.route('/api/add_event', methods=['POST'])
 @login_required
 def api_add_event():
@@ -3449,11 +5773,119 @@ def api_add_event():
         action_id = None
     event = MatchEvent(match_id=match_id, player_id=player_id, action_id=action_id, opponent_points=opponent_points, game_minute=game_minute, period=period)
     db.session.add(event)
-    if opponent_points:
-        match.result_them = (match.result_them or 0) + opponent_points
+    apply_match_events(match, [(player_id, action_id, opponent_points, period)])
+    publish_match_event(match, 'event', event, [player_id])
     db.session.commit()
     return jsonify({'status': 'ok', 'event_id': event.id, 'opponent_points': opponent_points})
 
+MATCH_BATCH_MAX_EVENTS = 200
+MATCH_BATCH_MAX_CLOCK_SKEW = timedelta(hours=6)   # marcas de tiempo del cliente más antiguas se ignoran
+
+def _batch_event_time(ts, now):
+    """Momento del toque según el cliente (ms desde epoch), si es plausible; si no, la hora de llegada."""
+    try:
+        when = datetime.utcfromtimestamp(float(ts) / 1000.0)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return now
+    return when if now - MATCH_BATCH_MAX_CLOCK_SKEW <= when <= now else now
+
+@app.route('/api/match/<int:match_id>/events:batch', methods=['POST'])
+@login_required
+def api_match_events_batch(match_id):
+    """Registra un lote de eventos del tracker en una sola transacción.
+
+    Body: {device_id, events: [{seq, player_id, action_id, opponent_points, period, game_minute, ts}, ...]}.
+    Un cambio de quinteto es {seq, lineup: [ids en pista], period, ts} y queda en el mismo flujo de eventos.
+    (device_id, seq) identifica cada toque: los ya registrados se confirman sin volver a insertarse, así que
+    reenviar el lote tras un corte es seguro. Los eventos nuevos se insertan con un INSERT multifila y se
+    ordenan por su secuencia; los inválidos se rechazan uno a uno.
+    """
+    match = Match.query.get_or_404(match_id)
+    if match.user_id != current_user.id:
+        st = TeamStaff.query.filter_by(team_id=match.team_id, email=current_user.email, status='accepted').first()
+        if not st: return jsonify({'error': 'No autorizado'}), 403
+    data = request.get_json(silent=True) or {}
+    device_id = data.get('device_id')
+    events = data.get('events') or []
+    if not isinstance(device_id, str) or not device_id or len(device_id) > 64:
+        return jsonify({'error': 'device_id obligatorio (máx. 64 caracteres)'}), 400
+    if not isinstance(events, list):
+        return jsonify({'error': 'events debe ser una lista'}), 400
+    if len(events) > MATCH_BATCH_MAX_EVENTS:
+        return jsonify({'error': f'Máximo {MATCH_BATCH_MAX_EVENTS} eventos por lote'}), 400
+    seqs = []
+    for ev in events:
+        seq = ev.get('seq') if isinstance(ev, dict) else None
+        if not isinstance(seq, int) or isinstance(seq, bool) or seq < 0:
+            return jsonify({'error': 'Cada evento necesita un seq entero >= 0'}), 400
+        seqs.append(seq)
+
+    done = dict(db.session.query(MatchEvent.seq, MatchEvent.id).filter(
+        MatchEvent.match_id == match.id, MatchEvent.device_id == device_id,
+        MatchEvent.seq.in_(set(seqs))).all()) if seqs else {}
+
+    registry = get_action_registry(match.user_id)
+    roster_ids = {pid for (pid,) in db.session.query(match_roster.c.player_id).filter(match_roster.c.match_id == match.id).all()}
+    now = datetime.utcnow()
+    rows, rejected, duplicates = [], [], []
+    for ev, seq in sorted(zip(events, seqs), key=lambda x: x[1]):
+        if seq in done:
+            duplicates.append(seq)
+            continue
+        try:
+            opponent_points = int(ev.get('opponent_points') or 0)
+            period = int(ev.get('period') or 1)
+            game_minute = int(ev.get('game_minute') or 0)
+        except (TypeError, ValueError):
+            rejected.append({'seq': seq, 'error': 'Datos inválidos'})
+            continue
+        row = {'match_id': match.id, 'device_id': device_id, 'seq': seq, 'period': period,
+               'game_minute': game_minute, 'timestamp': _batch_event_time(ev.get('ts'), now),
+               'player_id': None, 'action_id': None, 'opponent_points': 0, 'lineup': None}
+        if 'lineup' in ev:
+            lineup = ev.get('lineup')
+            if (not isinstance(lineup, list) or len(lineup) > 5
+                    or not all(isinstance(pid, int) and pid in roster_ids for pid in lineup)):
+                rejected.append({'seq': seq, 'error': 'Quinteto inválido'})
+                continue
+            row['lineup'] = lineup_key(lineup)
+        elif opponent_points > 0:
+            row['opponent_points'] = opponent_points
+        else:
+            player_id, action_id = ev.get('player_id'), ev.get('action_id')
+            if (not isinstance(player_id, int) or isinstance(player_id, bool)
+                    or not isinstance(action_id, int) or isinstance(action_id, bool)):
+                rejected.append({'seq': seq, 'error': 'Datos inválidos'})
+                continue
+            if player_id not in roster_ids:
+                rejected.append({'seq': seq, 'error': 'Jugador no convocado'})
+                continue
+            if registry.get(action_id) is None:
+                rejected.append({'seq': seq, 'error': 'Acción desconocida'})
+                continue
+            row['player_id'], row['action_id'] = player_id, action_id
+        rows.append(row)
+        done[seq] = None
+
+    created = []
+    if rows:
+        t = MatchEvent.__table__
+        inserted = dict(db.session.execute(t.insert().returning(t.c.seq, t.c.id), rows).all())
+        for row in rows:
+            row['id'] = inserted[row['seq']]
+            created.append({'seq': row['seq'], 'event_id': row['id']})
+        player_ids = apply_match_events(match, [(r['player_id'], r['action_id'], r['opponent_points'], r['period'])
+                                                for r in rows])
+        publish_match_events_batch(match, rows, registry, player_ids)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Otro envío concurrente del mismo lote ganó la carrera: el cliente reintentará
+        db.session.rollback()
+        return jsonify({'error': 'Envío concurrente, reintenta'}), 409
+    return jsonify({'status': 'ok', 'acked': sorted(duplicates + [c['seq'] for c in created]),
+                    'created': created, 'duplicates': duplicates, 'rejected': rejected})
+
 @app.route('/api/undo_event', methods=['POST'])
 @login_required
 def api_undo_event():
@@ -3461,10 +5893,7 @@ def api_undo_event():
     event_id = data.get('event_id')
     event = MatchEvent.query.get(event_id)
     if event:
-        if getattr(event, 'opponent_points', 0):
-            m = Match.query.get(event.match_id)
-            if m: m.result_them = max(0, (m.result_them or 0) - event.opponent_points)
-        db.session.delete(event)
+        _undo_match_event(event)
         db.session.commit()
         return jsonify({'status': 'ok'})
     return jsonify({'error': 'Error'}), 400
@@ -3477,33 +5906,8 @@ def api_match_live_stats(match_id):
         st = TeamStaff.query.filter_by(team_id=match.team_id, email=current_user.email, status='accepted').first()
         if not st: return jsonify({'error': 'No autorizado'}), 403
     
-    players = {}
-    for p in match.roster:
-        players[p.id] = {
-            'name': p.name, 'dorsal': p.dorsal, 'photo': p.photo_file,
-            'val': 0.0, 'ata': 0.0, 'def': 0.0, 'fouls': 0
-        }
-    
-    score_home = 0
-    score_away = 0
-    
-    for e in match.events:
-        opp = getattr(e, 'opponent_points', 0)
-        if opp:
-            score_away += opp
-            continue
-        if not e.player_id or not e.action_id: continue
-        a = ActionDefinition.query.get(e.action_id)
-        if not a or e.player_id not in players: continue
-        
-        players[e.player_id]['val'] += a.value
-        if a.display_section == 'ATAQUE': players[e.player_id]['ata'] += a.value
-        elif a.display_section == 'DEFENSA': players[e.player_id]['def'] += a.value
-        
-        if a.name == 'Falta': players[e.player_id]['fouls'] += 1
-        if a.score_value: score_home += a.score_value
-    
-    return jsonify({'players': players, 'score_home': score_home, 'score_away': score_away})
+    # Lectura del agregado: O(jugadores) en lugar de recorrer los eventos
+    return jsonify(match_live_payload(match))
 
 @app.route('/api/match/<int:match_id>/save_state', methods=['POST'])
 @login_required
@@ -3515,6 +5919,7 @@ def api_match_save_state(match_id):
     data = request.json
     match.current_period = data.get('period', 1)
     match.court_lineup = json.dumps(data.get('lineup', []))
+    publish_match_change(match.id, 'state', {'period': match.current_period, 'lineup': data.get('lineup', [])})
     db.session.commit()
     return jsonify({'status': 'ok'})
 
@@ -3525,18 +5930,7 @@ def api_last_events():
     n = request.args.get('n', 3, type=int)
     match = Match.query.get_or_404(match_id) if match_id else None
     if not match: return jsonify({'error': 'No match'}), 404
-    events = MatchEvent.query.filter_by(match_id=match_id).order_by(MatchEvent.timestamp.desc()).limit(n).all()
-    roster = {p.id: {'name': p.name, 'dorsal': p.dorsal} for p in match.roster}
-    actions_map = {a.id: {'name': a.name, 'value': a.value} for a in get_actions_for_team(match.team_id, match.user_id)}
-    out = []
-    for e in events:
-        if getattr(e, 'opponent_points', 0):
-            out.append({'id': e.id, 'kind': 'rival', 'pts': e.opponent_points, 'period': e.period})
-        else:
-            p = roster.get(e.player_id, {})
-            a = actions_map.get(e.action_id, {})
-            out.append({'id': e.id, 'kind': 'action', 'player': p, 'action': a, 'period': e.period})
-    return jsonify({'events': out})
+    return jsonify({'events': match_last_events(match, n)})
 
 @app.route('/api/edit_event', methods=['POST'])
 @login_required
@@ -3546,18 +5940,246 @@ def api_edit_event():
     event = MatchEvent.query.get(event_id)
     if not event: return jsonify({'error': 'Not found'}), 404
     if data.get('delete'):
-        if getattr(event, 'opponent_points', 0):
-            m = Match.query.get(event.match_id)
-            if m: m.result_them = max(0, (m.result_them or 0) - event.opponent_points)
-        db.session.delete(event)
+        _undo_match_event(event)
         db.session.commit()
         return jsonify({'status': 'ok', 'deleted': True})
     player_id = data.get('player_id')
     action_id = data.get('action_id')
+    _edit_match_event(event, player_id, action_id)
+    db.session.commit()
+    return jsonify({'status': 'ok'})
+
+def _undo_match_event(event):
+    """Borra un evento descontándolo del marcador en vivo y lo publica en el stream. No hace commit."""
+    match = db.session.get(Match, event.match_id)
+    if match:
+        apply_match_events(match, [(event.player_id, event.action_id, event.opponent_points, event.period)], -1)
+    db.session.delete(event)
+    if match:
+        publish_match_event(match, 'undo', event, [event.player_id])
+
+def _edit_match_event(event, player_id=None, action_id=None):
+    """Cambia jugador y/o acción de un evento moviendo su aportación en el marcador en vivo. No hace commit."""
+    if player_id is None and action_id is None:
+        return
+    match = db.session.get(Match, event.match_id)
+    old_player_id = event.player_id
+    if not getattr(event, 'opponent_points', 0):
+        apply_match_events(match, [(event.player_id, event.action_id, 0, event.period)], -1)
     if player_id is not None: event.player_id = int(player_id)
     if action_id is not None: event.action_id = int(action_id)
+    if not getattr(event, 'opponent_points', 0):
+        apply_match_events(match, [(event.player_id, event.action_id, 0, event.period)])
+    publish_match_event(match, 'edit', event, [old_player_id, event.player_id])
+
+# --- PARCIALES POR PERIODO Y EVOLUCIÓN DEL MARCADOR ---
+
+MATCH_TIMELINE_POINTS = 60       # puntos por defecto de la serie del marcador
+MATCH_TIMELINE_MAX_POINTS = 500
+
+def match_period_label(period, quarters):
+    quarters = quarters or 4
+    if period <= quarters:
+        return f'Q{period}'
+    return 'OT' if period == quarters + 1 else f'OT{period - quarters}'
+
+def match_period_splits(match):
+    """Parciales del partido desde el agregado: {'periods': [{period, label, us, them, us_total, them_total}],
+    'players': {player_id: {period: {'val', 'points'}}}}. Salen siempre los periodos reglamentarios
+    y las prórrogas que tengan eventos."""
+    _ensure_match_live(match)
+    scores = {r.period: (r.points_us, r.points_them)
+              for r in MatchPeriodLive.query.filter_by(match_id=match.id).all()}
+    periods, us_total, them_total = [], 0, 0
+    for period in range(1, max([match.quarters or 4, *scores]) + 1):
+        us, them = scores.get(period, (0, 0))
+        us_total += us
+        them_total += them
+        periods.append({'period': period, 'label': match_period_label(period, match.quarters),
+                        'us': us, 'them': them, 'us_total': us_total, 'them_total': them_total})
+    players = {}
+    for r in MatchPeriodPlayerLive.query.filter_by(match_id=match.id).all():
+        players.setdefault(r.player_id, {})[r.period] = {'val': round(r.val, 2), 'points': r.points}
+    return {'periods': periods, 'players': players}
+
+def _downsample_timeline(series, limit):
+    """Reduce la serie a unos `limit` puntos repartidos a lo largo del partido, conservando el primero,
+    el último y el final de cada periodo (así los parciales del gráfico siguen siendo exactos)."""
+    if len(series) <= limit:
+        return series
+    last = len(series) - 1
+    keep = {0, last}
+    keep.update(i for i in range(last) if series[i]['period'] != series[i + 1]['period'])
+    step = last / (limit - 1)
+    keep.update(round(k * step) for k in range(limit))
+    return [series[i] for i in sorted(keep)]
+
+def match_timeline(match, limit=MATCH_TIMELINE_POINTS):
+    """Evolución del marcador: un punto por cada evento que anota (n = anotaciones hasta ese punto),
+    ya reducida a `limit` puntos. Solo se leen los eventos que suman puntos, en el orden del partido."""
+    A = ActionDefinition
+    scored = func.coalesce(A.score_value, 0)
+    opp = func.coalesce(MatchEvent.opponent_points, 0)
+    rows = db.session.query(func.coalesce(MatchEvent.period, 1), opp, case((opp == 0, scored), else_=0)) \
+        .outerjoin(A, A.id == MatchEvent.action_id) \
+        .filter(MatchEvent.match_id == match.id, or_(opp != 0, and_(MatchEvent.player_id.isnot(None), scored != 0))) \
+        .order_by(func.coalesce(MatchEvent.period, 1), *match_event_order()).all()
+    series = [{'n': 0, 'period': 1, 'us': 0, 'them': 0}]
+    us = them = 0
+    for n, (period, opp_points, points) in enumerate(rows, 1):
+        us += int(points or 0)
+        them += int(opp_points or 0)
+        series.append({'n': n, 'period': period, 'us': us, 'them': them})
+    return _downsample_timeline(series, max(2, limit))
+
+@app.route('/api/match/<int:match_id>/timeline')
+@login_required
+def api_match_timeline(match_id):
+    """Serie del marcador ya reducida (?points=N) y parciales por periodo, para gráficos y exportaciones."""
+    match = Match.query.get_or_404(match_id)
+    if match.user_id != current_user.id:
+        st = TeamStaff.query.filter_by(team_id=match.team_id, email=current_user.email, status='accepted').first()
+        if not st: return jsonify({'error': 'No autorizado'}), 403
+    limit = min(MATCH_TIMELINE_MAX_POINTS, request.args.get('points', MATCH_TIMELINE_POINTS, type=int))
+    splits = match_period_splits(match)
+    return _cacheable_json({
+        'match_id': match.id,
+        'score': {'us': match.result_us or 0, 'them': match.result_them or 0},
+        'periods': splits['periods'],
+        'points': match_timeline(match, limit),
+    })
+
+# --- QUINTETOS Y +/- (CAMBIOS DE QUINTETO EN EL FLUJO DE EVENTOS) ---
+
+LINEUP_MAX_GAP_SECONDS = 300   # pausas más largas entre eventos (descansos) no cuentan como tiempo en pista
+LINEUP_MIN_SECONDS_RATING = 60 # por debajo de un minuto en pista no se da rating neto
+
+TEAM_STATS_MIN_UNIT_SECONDS = 120  # quintetos con menos tiempo juntos no salen en las estadísticas del equipo
+
+def lineup_key(player_ids):
+    """Quinteto como texto compacto: ids sin repetir, ordenados y separados por comas."""
+    return ','.join(str(pid) for pid in sorted(set(player_ids)))
+
+def parse_lineup(value):
+    return tuple(int(pid) for pid in value.split(',') if pid) if value else ()
+
+def compute_match_lineups(match_ids):
+    """+/- y tiempo en pista por jugador y por quinteto de cinco, en una pasada lineal por los eventos de
+    cada partido (en el orden del partido). Cada cambio de quinteto fija quién está en pista; el tiempo
+    entre dos eventos se suma a los que estaban en pista (recortado a LINEUP_MAX_GAP_SECONDS) y cada
+    canasta suma a favor o en contra. Reescribe MatchLineupStat y marca lineup_ready. No hace commit."""
+    match_ids = list(match_ids)
+    if not match_ids:
+        return
+    A = ActionDefinition
+    rows = db.session.query(
+        MatchEvent.match_id, MatchEvent.timestamp, MatchEvent.lineup, MatchEvent.player_id,
+        func.coalesce(MatchEvent.opponent_points, 0), func.coalesce(A.score_value, 0),
+    ).outerjoin(A, A.id == MatchEvent.action_id) \
+        .filter(MatchEvent.match_id.in_(match_ids)) \
+        .order_by(MatchEvent.match_id, func.coalesce(MatchEvent.period, 1), *match_event_order()).all()
+    t = MatchLineupStat.__table__
+    db.session.execute(t.delete().where(t.c.match_id.in_(match_ids)))
+    stats = []
+    for match_id, events in groupby(rows, key=lambda r: r[0]):
+        acc, units, last_ts = {}, (), None
+        for _, ts, lineup, player_id, opp_points, score in events:
+            if units and last_ts is not None and ts is not None:
+                gap = min(max((ts - last_ts).total_seconds(), 0.0), LINEUP_MAX_GAP_SECONDS)
+                for unit in units:
+                    acc[unit][0] += gap
+            if ts is not None:
+                last_ts = ts
+            if lineup is not None:
+                on_court = parse_lineup(lineup)
+                units = [str(pid) for pid in on_court] + ([lineup_key(on_court)] if len(on_court) == 5 else [])
+                for unit in units:
+                    acc.setdefault(unit, [0.0, 0, 0])
+                continue
+            points_for = score if player_id and not opp_points else 0
+            if units and (points_for or opp_points):
+                for unit in units:
+                    acc[unit][1] += points_for
+                    acc[unit][2] += opp_points
+        stats.extend({'match_id': match_id, 'unit': unit, 'size': unit.count(',') + 1,
+                      'seconds': seconds, 'points_for': pf, 'points_against': pa}
+                     for unit, (seconds, pf, pa) in acc.items())
+    if stats:
+        db.session.execute(t.insert(), stats)
+    db.session.execute(update(Match).where(Match.id.in_(match_ids)).values(lineup_ready=True),
+                       execution_options={'synchronize_session': False})
+    _expire_matches(match_ids, ['lineup_ready'])
+
+def _lineup_row(unit, seconds, points_for, points_against, matches, names):
+    seconds = float(seconds or 0)
+    plus_minus = int(points_for or 0) - int(points_against or 0)
+    ids = parse_lineup(unit)
+    return {
+        'unit': unit, 'player_ids': list(ids), 'names': [names.get(pid, '?') for pid in ids], 'matches': matches,
+        'minutes': round(seconds / 60, 1), 'points_for': int(points_for or 0), 'points_against': int(points_against or 0),
+        'plus_minus': plus_minus,
+        # Rating neto: +/- por cada 40 minutos en pista
+        'net_rating': round(plus_minus * 2400 / seconds, 1) if seconds >= LINEUP_MIN_SECONDS_RATING else None,
+    }
+
+def lineup_stats(match_filter, team_id, min_unit_seconds=0):
+    """+/- agregado de los partidos que cumplen match_filter: {'players': [...], 'units': [...]}.
+    Los partidos con eventos nuevos se recalculan primero; el resto sale de MatchLineupStat con un GROUP BY,
+    así que el coste no depende del número de eventos de la temporada."""
+    stale = [mid for (mid,) in db.session.query(Match.id).filter(match_filter, Match.lineup_ready == false()).all()]
+    if stale:
+        compute_match_lineups(stale)
+        db.session.commit()
+    L = MatchLineupStat
+    rows = db.session.query(L.unit, L.size, func.sum(L.seconds), func.sum(L.points_for), func.sum(L.points_against),
+                            func.count(L.match_id)) \
+        .join(Match, Match.id == L.match_id).filter(match_filter).group_by(L.unit, L.size).all()
+    names = dict(db.session.query(Player.id, Player.name).filter_by(team_id=team_id).all())
+    players, units = [], []
+    for unit, size, seconds, pf, pa, matches in rows:
+        if size == 1:
+            players.append(_lineup_row(unit, seconds, pf, pa, matches, names))
+        elif (seconds or 0) >= min_unit_seconds:
+            units.append(_lineup_row(unit, seconds, pf, pa, matches, names))
+    players.sort(key=lambda r: (-r['plus_minus'], -r['minutes']))
+    units.sort(key=lambda r: (-r['plus_minus'], -r['minutes']))
+    return {'players': players, 'units': units}
+
+def match_lineup_stats(match):
+    return lineup_stats(Match.id == match.id, match.team_id)
+
+def team_lineup_stats(team_id, since=None, min_unit_seconds=0):
+    """+/- de la temporada (desde `since`) del equipo, por jugador y por quinteto."""
+    match_filter = and_(Match.team_id == team_id, *([Match.date >= since] if since else []))
+    return lineup_stats(match_filter, team_id, min_unit_seconds)
+
+@app.route('/api/match/<int:match_id>/lineups')
+@login_required
+def api_match_lineups(match_id):
+    match = Match.query.get_or_404(match_id)
+    if match.user_id != current_user.id:
+        st = TeamStaff.query.filter_by(team_id=match.team_id, email=current_user.email, status='accepted').first()
+        if not st: return jsonify({'error': 'No autorizado'}), 403
+    return _cacheable_json(match_lineup_stats(match))
+
+@app.route('/api/team/<int:id>/lineups')
+@login_required
+def api_team_lineups(id):
+    """+/- de la temporada por jugador y quinteto (?min_minutes=N filtra quintetos con poco tiempo juntos)."""
+    team = Team.query.get_or_404(id)
+    if not _can_edit_team(team): return jsonify({'error': 'No autorizado'}), 403
+    min_minutes = max(0, request.args.get('min_minutes', 0, type=int))
+    return _cacheable_json(team_lineup_stats(team.id, season_start(), min_unit_seconds=min_minutes * 60))
+
+@app.cli.command('rebuild-match-lineups')
+@click.option('--match-id', type=int, default=None, help='Solo este partido')
+def rebuild_match_lineups_command(match_id):
+    """Recalcula el +/- por jugador y quinteto de los partidos desde sus eventos."""
+    ids = [match_id] if match_id else [mid for (mid,) in db.session.query(Match.id).all()]
+    for i in range(0, len(ids), 200):
+        compute_match_lineups(ids[i:i + 200])
     db.session.commit()
-    return jsonify({'status': 'ok'})
+    print(f'+/- recalculado para {len(ids)} partidos')
 
 @app.route('/match_stats/<int:id>')
 @login_required
@@ -3567,60 +6189,71 @@ def match_stats(id):
     for player in match.roster:
         stats[player.id] = { 'name': player.name, 'dorsal': player.dorsal, 'photo': player.photo_file, 'total_val': 0.0, 'actions': {} }
     
-    events_list = match.events
-    for event in events_list:
-        if getattr(event, 'opponent_points', 0): continue
-        pid = event.player_id
-        aid = event.action_id
-        if not pid or not aid: continue
-        action_def = ActionDefinition.query.get(aid)
-        if pid in stats and action_def:
-            current_count = stats[pid]['actions'].get(action_def.name, 0)
-            stats[pid]['actions'][action_def.name] = current_count + 1
-            stats[pid]['total_val'] += action_def.value
+    # Matriz jugador × acción del partido: conteos por nombre, valoración y rankings como productos con vectores
+    registry = get_action_registry(match.user_id)
+    rows = team_action_matrix([match.id], registry).total()
+    totals = matrix_dot(rows, registry.values)
+    for pid, row in rows.items():
+        if pid not in stats: continue
+        for i, n in enumerate(row):
+            if n:
+                name = registry.names[i]
+                stats[pid]['actions'][name] = stats[pid]['actions'].get(name, 0) + n
+        stats[pid]['total_val'] = totals[pid]
             
     actions_list = get_actions_for_team(match.team_id, match.user_id)
     action_names = [a.name for a in actions_list]
     rankings = get_rankings_for_team(match.team_id, match.user_id)
-    for pid, p_data in stats.items():
-        p_data['rankings'] = {}
-        for r in rankings:
-            score = 0
-            for ing in r.ingredients:
-                score += p_data['actions'].get(ing.name, 0)
-            p_data['rankings'][r.name] = score
-
-    return render_template('match_stats.html', match=match, stats=stats, action_names=action_names, rankings=rankings)
+    for r in rankings:
+        # Peso de cada acción = cuántos ingredientes del ranking llevan su nombre
+        uses = {}
+        for ing in r.ingredients:
+            uses[ing.name] = uses.get(ing.name, 0) + 1
+        scores = matrix_dot(rows, [uses.get(name, 0) for name in registry.names])
+        for pid, p_data in stats.items():
+            p_data.setdefault('rankings', {})[r.name] = scores.get(pid, 0)
+    for p_data in stats.values():
+        p_data.setdefault('rankings', {})
+
+    on_court = {r['player_ids'][0]: r for r in match_lineup_stats(match)['players']}
+    return render_template('match_stats.html', match=match, stats=stats, action_names=action_names, rankings=rankings,
+                           splits=match_period_splits(match), on_court=on_court)
+
+MATCHES_PAGE_SIZE = 20
 
 @app.route('/matches')
 @login_required
 def matches_list():
-    matches = Match.query.filter_by(user_id=current_user.id).order_by(Match.date.desc()).all()
+    """Historial de partidos paginado: el resultado sale de la propia fila (result_us/result_them) y si hay
+    eventos de los agregados por partido, todo mantenido en cada escritura de eventos; una consulta por página."""
+    page = max(1, request.args.get('page', 1, type=int))
+    has_events = or_(select(PlayerMatchStat.id).where(PlayerMatchStat.match_id == Match.id).exists(),
+                     select(MatchPeriodLive.id).where(MatchPeriodLive.match_id == Match.id, MatchPeriodLive.points_them != 0).exists())
+    query = db.session.query(Match, has_events.label('has_events')) \
+        .filter(Match.user_id == current_user.id) \
+        .order_by(Match.date.desc(), Match.id.desc()) \
+        .offset((page - 1) * MATCHES_PAGE_SIZE).limit(MATCHES_PAGE_SIZE + 1)
+    rows = query.all()
+    # Partidos cuyas acciones cambiaron de valor desde la última escritura: se recalculan solo los de la página
+    stale = [m.id for m, _ in rows if not m.live_ready]
+    if stale:
+        rebuild_match_live(stale)
+        db.session.commit()
+        rows = query.all()
+    has_next = len(rows) > MATCHES_PAGE_SIZE
+    rows = rows[:MATCHES_PAGE_SIZE]
     match_info = []
-    for m in matches:
-        has_events = len(m.events) > 0
+    for m, events_exist in rows:
         current_p = m.current_period if m.current_period else 1
         period_label = f"Q{current_p}" if current_p <= m.quarters else "OT"
-        score_home = 0
-        score_away = 0
-        for e in m.events:
-            opp_points = getattr(e, 'opponent_points', 0)
-            if opp_points:
-                score_away += opp_points
-                continue
-            if not e.action_id:
-                continue
-            a = ActionDefinition.query.get(e.action_id)
-            if a and a.score_value:
-                score_home += a.score_value
         match_info.append({
             'match': m,
-            'has_events': has_events,
+            'has_events': bool(events_exist),
             'period_label': period_label,
-            'score_home': score_home,
-            'score_away': score_away
+            'score_home': m.result_us or 0,
+            'score_away': m.result_them or 0
         })
-    return render_template('matches_list.html', match_info=match_info)
+    return render_template('matches_list.html', match_info=match_info, page=page, has_next=has_next)
 
 @app.route('/analytics')
 @login_required
@@ -3649,7 +6282,7 @@ def delete_match(id):
 @login_required
 def match_log(id):
     match = Match.query.get_or_404(id)
-    events = MatchEvent.query.filter_by(match_id=match.id).order_by(MatchEvent.timestamp.desc()).all()
+    events = MatchEvent.query.filter_by(match_id=match.id, lineup=None).order_by(*match_event_order(descending=True)).all()
     actions = get_actions_for_team(match.team_id, match.user_id)
     return render_template('match_log.html', match=match, events=events, actions=actions)
 
@@ -3663,16 +6296,48 @@ def edit_match_event():
     event = MatchEvent.query.get(event_id)
     if event:
         if delete_flag == 'yes':
-            if getattr(event, 'opponent_points', 0):
-                m = Match.query.get(event.match_id)
-                if m: m.result_them = max(0, (m.result_them or 0) - event.opponent_points)
-            db.session.delete(event)
+            _undo_match_event(event)
         else:
-            if new_player_id: event.player_id = int(new_player_id)
-            if new_action_id: event.action_id = int(new_action_id)
+            _edit_match_event(event, new_player_id or None, new_action_id or None)
         db.session.commit()
     return redirect(url_for('match_log', id=event.match_id))
 
+EXPORT_COUNTER_KEYS = ('tiros_2', 'tiros_3', 'tiros_1', 'rebotes', 'asist', 'robos', 'tapones', 'tiros_2_fallados',
+                       'tiros_3_fallados', 'tiros_1_fallados', 'balones_perdidos', 'tapones_recibidos', 'faltas')
+
+def export_counter_keys(action):
+    """Contadores del acta a los que suma cada evento de esta acción (uno de positivos y uno de negativos como mucho)."""
+    keys = []
+    # Contadores específicos - POSITIVOS
+    if action.name == 'Tiro 2' and action.value > 0:
+        keys.append('tiros_2')
+    elif action.name == 'Tiro 3' and action.value > 0:
+        keys.append('tiros_3')
+    elif action.name == 'Tiro 1' and action.value > 0:
+        keys.append('tiros_1')
+    elif 'Reb' in action.name:
+        keys.append('rebotes')
+    elif action.name == 'Asist':
+        keys.append('asist')
+    elif action.name == 'Robo':
+        keys.append('robos')
+    elif action.name == 'Tapón' and action.value > 0:
+        keys.append('tapones')
+    # Contadores específicos - NEGATIVOS
+    if action.name == 'Tiro 2' and action.value < 0:
+        keys.append('tiros_2_fallados')
+    elif action.name == 'Tiro 3' and action.value < 0:
+        keys.append('tiros_3_fallados')
+    elif action.name == 'Tiro 1' and action.value < 0:
+        keys.append('tiros_1_fallados')
+    elif 'Bal.Per' in action.name or 'Balón Perdido' in action.name:
+        keys.append('balones_perdidos')
+    elif 'Tapón Rec' in action.name:
+        keys.append('tapones_recibidos')
+    elif action.name == 'Falta':
+        keys.append('faltas')
+    return tuple(keys)
+
 @app.route('/export/match/<int:id>')
 @login_required
 def export_match(id):
@@ -3685,108 +6350,45 @@ def export_match(id):
     if not is_owner and not is_staff:
         return redirect('/')
     
-    # Obtener todos los eventos del partido
-    events = MatchEvent.query.filter_by(match_id=match.id).order_by(MatchEvent.period, MatchEvent.timestamp).all()
-    score_home = 0
-    score_away = 0
-    
-    # Calcular estadísticas por jugador
+    # Estadísticas por jugador: valoración desde MatchPlayerLive y contadores desde la matriz jugador × acción
+    registry = get_action_registry(match.user_id)
+    rows = team_action_matrix([match.id], registry).total()
+    counters = [export_counter_keys(registry.get(aid)) for aid in registry.ids]
+    live = {row.player_id: row for row in MatchPlayerLive.query.filter_by(match_id=match.id).all()}
     player_stats = {}
     for player in team.players:
-        player_stats[player.id] = {
-            'player': player,
-            'val': 0.0,
-            'ata': 0.0,
-            'def': 0.0,
-            'tiros_2': 0,
-            'tiros_3': 0,
-            'tiros_1': 0,
-            'rebotes': 0,
-            'asist': 0,
-            'robos': 0,
-            'tapones': 0,
-            'tiros_2_fallados': 0,
-            'tiros_3_fallados': 0,
-            'tiros_1_fallados': 0,
-            'balones_perdidos': 0,
-            'tapones_recibidos': 0,
-            'faltas': 0
-        }
-    
-    # Procesar eventos
-    for e in events:
-        opp_points = getattr(e, 'opponent_points', 0)
-        if opp_points:
-            score_away += opp_points
-            continue
-        if not e.player_id or not e.action_id:
-            continue
-        
-        if e.player_id not in player_stats:
-            continue
-        
-        a = ActionDefinition.query.get(e.action_id)
-        if not a:
-            continue
-        
-        ps = player_stats[e.player_id]
-        ps['val'] += a.value
-
-        if a.score_value:
-            score_home += a.score_value
-        
-        if a.display_section == 'ATAQUE':
-            ps['ata'] += a.value
-        elif a.display_section == 'DEFENSA':
-            ps['def'] += a.value
-        
-        # Contadores específicos - POSITIVOS
-        if a.name == 'Tiro 2' and a.value > 0:
-            ps['tiros_2'] += 1
-        elif a.name == 'Tiro 3' and a.value > 0:
-            ps['tiros_3'] += 1
-        elif a.name == 'Tiro 1' and a.value > 0:
-            ps['tiros_1'] += 1
-        elif 'Reb' in a.name:
-            ps['rebotes'] += 1
-        elif a.name == 'Asist':
-            ps['asist'] += 1
-        elif a.name == 'Robo':
-            ps['robos'] += 1
-        elif a.name == 'Tapón' and a.value > 0:
-            ps['tapones'] += 1
-        
-        # Contadores específicos - NEGATIVOS
-        if a.name == 'Tiro 2' and a.value < 0:
-            ps['tiros_2_fallados'] += 1
-        elif a.name == 'Tiro 3' and a.value < 0:
-            ps['tiros_3_fallados'] += 1
-        elif a.name == 'Tiro 1' and a.value < 0:
-            ps['tiros_1_fallados'] += 1
-        elif 'Bal.Per' in a.name or 'Balón Perdido' in a.name:
-            ps['balones_perdidos'] += 1
-        elif 'Tapón Rec' in a.name:
-            ps['tapones_recibidos'] += 1
-        elif a.name == 'Falta':
-            ps['faltas'] += 1
+        ps = player_stats[player.id] = {'player': player, 'val': 0.0, 'ata': 0.0, 'def': 0.0}
+        ps.update({key: 0 for key in EXPORT_COUNTER_KEYS})
+        row = live.get(player.id)
+        if row:
+            ps.update(val=row.val, ata=row.ata)
+            ps['def'] = row.defense
+        for i, n in enumerate(rows.get(player.id, ())):
+            if n:
+                for key in counters[i]:
+                    ps[key] += n
+    score_home = match.result_us or 0
+    score_away = match.result_them or 0
     
     # Ordenar por valoración
     ranking = sorted(player_stats.values(), key=lambda x: x['val'], reverse=True)
     ranking = [r for r in ranking if r['val'] != 0 or r['tiros_2'] != 0 or r['tiros_3'] != 0]  # Solo jugadores con actividad
     
-    # Preparar eventos con detalles
+    # Preparar eventos con detalles (el acta jugada a jugada sí recorre los eventos)
+    events = MatchEvent.query.filter_by(match_id=match.id, lineup=None).order_by(MatchEvent.period, *match_event_order()).all()
+    players = {p.id: p for p in team.players}
     events_data = []
     for idx, e in enumerate(events, 1):
         if not e.player_id or not e.action_id:
             continue
         
-        player = Player.query.get(e.player_id)
-        action = ActionDefinition.query.get(e.action_id)
+        player = players.get(e.player_id) or db.session.get(Player, e.player_id)
+        action = registry.get(e.action_id)
         
         if not player or not action:
             continue
         
-        period_label = f'Q{e.period}' if e.period <= 4 else 'OT' if e.period == 5 else f'OT{e.period - 4}'
+        period_label = match_period_label(e.period or 1, match.quarters)
         
         events_data.append({
             'orden': idx,
@@ -3802,7 +6404,8 @@ def export_match(id):
                           ranking=ranking, 
                           events=events_data,
                           score_home=score_home,
-                          score_away=score_away)
+                          score_away=score_away,
+                          splits=match_period_splits(match))
 
 @app.route('/court_mode/<int:id>')
 @login_required
@@ -3818,7 +6421,8 @@ def court_mode(id):
         TrainingSession.team_id.in_([t.id for t in my_teams])
     ).first()
     
-    return render_template('court_mode.html', plan=plan, teams=my_teams, active_session=active_session)
+    return render_template('court_mode.html', plan=plan, teams=my_teams, active_session=active_session,
+                           scoring_strategies=SCORING_STRATEGY_LABELS)
 
 def generar_icono_banana(nombre, simbolo):
     path = os.path.join(app.config['UPLOAD_FOLDER'], nombre)
@@ -4,14 +4,20 @@ Rutas configuradas para /var/www/basketball-coach (estándar en producción)
 """
 import os
 
+# Workers gevent: los streams SSE del marcador (/api/match/<id>/stream) mantienen la conexión abierta
+# y con workers "sync" cada espectador bloquearía un worker entero. Con preload_app la app se importa
+# en el máster, así que hay que parchear antes de que se carguen threading/queue/socket.
+from gevent import monkey
+monkey.patch_all()
+
 # Directorio base de la aplicación
 APP_DIR = "/var/www/basketball-coach"
 
 # Configuración del servidor
 bind = "127.0.0.1:8000"
 workers = 2  # Para 1GB RAM, 2 workers es suficiente
-worker_class = "sync"
-worker_connections = 1000
+worker_class = "gevent"
+worker_connections = 1000  # conexiones simultáneas por worker (incluidos los streams abiertos)
 timeout = 120
 keepalive = 5
 max_requests = 1000
@@ -0,0 +1,112 @@
+"""Motor de puntuación de la gamificación de entrenamientos.
+
+Convierte los resultados brutos de un ejercicio ({player_id: raw_score}) en puntos
+con una estrategia con nombre. Cada cálculo es una sola pasada sobre los resultados
+ordenados una vez; no depende de la base de datos ni de Flask.
+"""
+import math
+
+MAX_POINTS = 15
+MIN_POINTS = 1
+DEFAULT_STRATEGY = 'ladder'
+
+# Criterio: qué resultado es mejor. Se aceptan las dos grafías que han usado los clientes.
+HIGHER_IS_BETTER = {'high': True, 'higher': True, 'low': False, 'lower': False}
+
+
+def normalize_criteria(criteria):
+    """Devuelve 'high' o 'low'; por defecto 'high' (mayor es mejor)."""
+    return 'low' if HIGHER_IS_BETTER.get((criteria or '').lower(), True) is False else 'high'
+
+
+def _ordered(raw_scores, criteria):
+    """Lista [(player_id, valor)] de mejor a peor; en 'low' se invierte el signo para ordenar igual."""
+    sign = 1 if normalize_criteria(criteria) == 'high' else -1
+    return sorted(((pid, sign * float(raw)) for pid, raw in raw_scores.items()),
+                  key=lambda x: x[1], reverse=True)
+
+
+def _scale(fraction, max_points, min_points):
+    """Lleva una fracción en [0, 1] al rango de puntos."""
+    return int(round(min_points + (max_points - min_points) * min(1.0, max(0.0, fraction))))
+
+
+def ladder(raw_scores, criteria='high', max_points=MAX_POINTS, min_points=MIN_POINTS):
+    """Escalera lineal: 15 al primero, 14 al segundo... y mínimo 1. Los empates se deshacen por orden."""
+    return {pid: max(min_points, max_points - pos)
+            for pos, (pid, _) in enumerate(_ordered(raw_scores, criteria))}
+
+
+def dense_rank(raw_scores, criteria='high', max_points=MAX_POINTS, min_points=MIN_POINTS):
+    """Ranking denso: los empatados comparten puntos y el siguiente valor distinto baja solo uno."""
+    points, rank, prev = {}, -1, None
+    for pid, value in _ordered(raw_scores, criteria):
+        if value != prev:
+            rank += 1
+            prev = value
+        points[pid] = max(min_points, max_points - rank)
+    return points
+
+
+def percentile(raw_scores, criteria='high', max_points=MAX_POINTS, min_points=MIN_POINTS):
+    """Percentil: fracción de rivales superados (los empates cuentan medio) escalada al rango de puntos."""
+    ordered = _ordered(raw_scores, criteria)
+    n = len(ordered)
+    if n == 1:
+        return {ordered[0][0]: max_points}
+    points = {}
+    i = 0
+    while i < n:
+        # Grupo de empatados [i, j)
+        j = i
+        while j < n and ordered[j][1] == ordered[i][1]:
+            j += 1
+        beaten = n - j
+        tied = j - i - 1
+        fraction = (beaten + 0.5 * tied) / (n - 1)
+        for pid, _ in ordered[i:j]:
+            points[pid] = _scale(fraction, max_points, min_points)
+        i = j
+    return points
+
+
+def zscore(raw_scores, criteria='high', max_points=MAX_POINTS, min_points=MIN_POINTS, clamp=2.0):
+    """Z-score normalizado: (x - media) / desviación, recortado a ±clamp y escalado al rango de puntos.
+    Si todos empatan (desviación 0) todos reciben el máximo."""
+    ordered = _ordered(raw_scores, criteria)
+    n = len(ordered)
+    mean = sum(v for _, v in ordered) / n
+    std = math.sqrt(sum((v - mean) ** 2 for _, v in ordered) / n)
+    if std == 0:
+        return {pid: max_points for pid, _ in ordered}
+    return {pid: _scale(((v - mean) / std + clamp) / (2 * clamp), max_points, min_points)
+            for pid, v in ordered}
+
+
+STRATEGIES = {
+    'ladder': ladder,
+    'dense': dense_rank,
+    'percentile': percentile,
+    'zscore': zscore,
+}
+
+STRATEGY_LABELS = {
+    'ladder': 'Escalera (15, 14, 13...)',
+    'dense': 'Ranking con empates',
+    'percentile': 'Percentil',
+    'zscore': 'Distancia a la media (z-score)',
+}
+
+
+def compute_points(raw_scores, strategy=DEFAULT_STRATEGY, criteria='high'):
+    """Calcula {player_id: puntos} para los resultados de un ejercicio.
+
+    Los resultados a None se ignoran. Lanza ValueError si la estrategia no existe.
+    """
+    func = STRATEGIES.get(strategy or DEFAULT_STRATEGY)
+    if func is None:
+        raise ValueError(f'Estrategia de puntuación desconocida: {strategy}')
+    scores = {pid: raw for pid, raw in raw_scores.items() if raw is not None}
+    if not scores:
+        return {}
+    return func(scores, criteria)
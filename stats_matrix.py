@@ -0,0 +1,58 @@
+"""Motor de estadísticas de partidos: matriz jugador × acción por partido.
+
+La base de datos devuelve los conteos ya agregados (match_id, player_id, action_id, n) del rollup por partido;
+aquí se guardan como filas densas por jugador (una columna por acción, en el orden del registro de
+acciones) y totales, medias, secciones y rankings salen como productos matriz-vector. No depende de la
+base de datos ni de Flask.
+"""
+
+
+class PlayerActionMatrix:
+    """Conteos por partido: matches[match_id][player_id] = [n por columna]. Las acciones fuera de
+    action_ids (de otro usuario o ya borradas) se ignoran."""
+
+    def __init__(self, counts, action_ids):
+        self.action_ids = list(action_ids)
+        self.column = {aid: i for i, aid in enumerate(self.action_ids)}
+        self.matches = {}
+        width = len(self.action_ids)
+        for match_id, player_id, action_id, n in counts:
+            col = self.column.get(action_id)
+            if col is None or player_id is None:
+                continue
+            row = self.matches.setdefault(match_id, {}).setdefault(player_id, [0] * width)
+            row[col] += n
+
+    def total(self, match_ids=None):
+        """Suma de las matrices de esos partidos (todos si match_ids es None): {player_id: [n por columna]}."""
+        rows = {}
+        for match_id in (self.matches if match_ids is None else match_ids):
+            for player_id, row in self.matches.get(match_id, {}).items():
+                acc = rows.get(player_id)
+                if acc is None:
+                    rows[player_id] = list(row)
+                else:
+                    for i, n in enumerate(row):
+                        if n:
+                            acc[i] += n
+        return rows
+
+
+def dot(rows, vector):
+    """Producto matriz-vector: {player_id: sum(n * peso)} para las filas dadas."""
+    return {player_id: sum(n * w for n, w in zip(row, vector) if n) for player_id, row in rows.items()}
+
+
+def touches(rows, vector):
+    """Jugadores con algún evento en las columnas de peso distinto de 0 (con una máscara: en el filtro)."""
+    return {player_id for player_id, row in rows.items() if any(n and w for n, w in zip(row, vector))}
+
+
+def mask(action_ids, keep):
+    """Vector 1/0 de las columnas cuyo id está en keep."""
+    return [1.0 if aid in keep else 0.0 for aid in action_ids]
+
+
+def masked(vector, keep_mask):
+    """Producto elemento a elemento: el vector con las columnas fuera del filtro a 0."""
+    return [w * k for w, k in zip(vector, keep_mask)]